@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline end-to-end benchmark of the Auto-Manipulator.
+
+The lattice of a demo image is loaded into the simulator, a few random bulk
+sites become dopants and every dopant is sent a few bonds away. The paths are
+planned with planning.Replanner. The manipulation loop runs with the
+simulated scan and feedback devices (no Swift, no Keithley) until all atoms
+arrived or the simulated time is used up. Reported are the atoms moved per minute of simulated beam time and
+the wall-clock time per loop step.
+
+    python benchmark_manipulation.py [image.npy] [--streaming] [--misjumps] [--drift] [--image-feedback]
+
+With --misjumps, 10 % of the jumps end on a wrong neighbour and the path of
+the atom is repaired.
+With --drift, the sample drifts by a few pixels every ~20 s.
+With --image-feedback, the jumps are detected in the frames (1 s of beam
+time each) by jump_detector.ImageJumpDetector instead of being reported by
+the simulated Keithley.
+"""
+
+# python standard classes
+import os
+import sys
+import time
+import threading
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import shortest_path
+
+# specific application classes
+from nionswift_plugin.atmenmanip import auto_manipulator as am
+from nionswift_plugin.atmenmanip import detection
+from nionswift_plugin.atmenmanip import jump_detector
+from nionswift_plugin.atmenmanip import lattice as lat
+from nionswift_plugin.atmenmanip import planning
+from nionswift_plugin.atmenmanip import simulator
+
+
+def plan_paths(lattice, sources, hops, rng):
+    """Every source is sent to a random free bulk site hops bonds away, the paths are planned in turn."""
+    graph = csr_matrix((np.ones(len(lattice.indices)), lattice.indices, lattice.indptr),
+                       shape=(len(lattice), len(lattice)))
+    distances = shortest_path(graph, unweighted=True, indices=sources)
+    # sites at the image border are not reliably bonded
+    degrees = lattice.degrees()
+    free = degrees == degrees.max()
+    free[sources] = False
+    for source in sources:
+        free[lattice.neighbours(source)] = False
+    paths = []
+    for i, source in enumerate(sources):
+        candidates = np.flatnonzero((distances[i] == hops) & free)
+        if not len(candidates):
+            continue
+        target = int(rng.choice(candidates))
+        # no target next to another atom
+        free[target] = False
+        free[lattice.neighbours(target)] = False
+        paths.append(np.array((source, target), dtype=np.int32))
+    lattice.paths = paths
+    replanner = planning.Replanner(lattice)
+    for i, path in enumerate(paths):
+        replanner.plan(i, path[0])
+    return lattice.paths
+
+
+if __name__ == "__main__":
+    path = os.path.join(os.path.dirname(__file__), "GonQF_01.npy")
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    if args:
+        path = args[0]
+    streaming = "--streaming" in sys.argv
+    misjump_probability = 0.1 if "--misjumps" in sys.argv else 0.0
+    drift_rate = 0.05 if "--drift" in sys.argv else 0.0
+    image_feedback = "--image-feedback" in sys.argv
+    sigma = 9
+    noise_tolerance = 1e-5
+    maxlength = 50
+    number_dopants = 5
+    hops = 4
+    beam_time = 600 # simulated seconds
+
+    rng = np.random.default_rng(0)
+    sample = simulator.SimulatedSample.from_image(np.load(path), sigma, noise_tolerance, maxlength,
+                                                  number_dopants=number_dopants, seed=0)
+    feedback = simulator.SimulatedFeedback(sample, jump_rate=0.5, drift_rate=drift_rate, misjump_probability=misjump_probability)
+    # with image feedback, the jumps happen while the frames are recorded
+    stem = simulator.SimulatedSTEM(sample, physics=feedback if image_feedback else None)
+
+    # the manipulator works on the lattice detected in a simulated frame
+    _, maxima = detection.detect_maxima(sample.render(), sigma, noise_tolerance)
+    lattice = lat.Lattice.from_maxima(maxima, maxlength)
+    sources = np.array([lattice.nearest_site(*sample.lattice.coords[d]) for d in sample.dopants])
+    lattice.add_sources(sources)
+    lattice.paths = plan_paths(lattice, sources, hops, rng)
+    print("{:d} sites, {:d} bonds, {:d} paths with {:d} jumps".format(len(lattice), lattice.number_bonds,
+                                            len(lattice.paths), sum(len(p) - 1 for p in lattice.paths)))
+
+    feedback_device = jump_detector.ImageJumpDetector(stem, lattice) if image_feedback else feedback
+    manipulator = am.AutoManipulator(lattice, None, None, streaming=streaming, sigma=sigma,
+                                     scan_device=stem, feedback_device=feedback_device)
+    thread = threading.Thread(target=manipulator.run)
+    starttime = time.perf_counter()
+    thread.start()
+    # the run ends when all atoms are moved or one stalled for max_retries steps, at the latest
+    # after the simulated beam time
+    while thread.is_alive() and feedback.simulated_time < beam_time:
+        thread.join(0.01)
+    manipulator.stop()
+    thread.join()
+    duration = time.perf_counter() - starttime
+
+    steps = manipulator.frame_number - 1
+    print("{:d} steps, {:d} jumps, {:d} atoms moved in {:.0f} s simulated beam time".format(
+            steps, feedback.jumps, manipulator.atoms_moved, feedback.simulated_time))
+    print("{:.2f} atoms moved per minute, {:.2f} ms wall-clock time per step".format(
+            manipulator.atoms_moved / max(feedback.simulated_time, 1e-9) * 60,
+            duration / max(steps, 1) * 1e3))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Peak memory of the panel's "Determine Maxima" for a large float64 frame.
+
+"before" is the former process_and_show: a deep copy of the source xdata as
+placeholder data item, imgrecoglib's Picture blurring the frame (in float64)
+and the filtered frame set as the item's data. Without imgrecoglib the
+Picture step is replaced by a float64 ndimage blur and the same maxima search.
+"after" runs AtomManipDelegate.process_and_show itself: the pipeline's
+float32 blur and maxima, the "Filtered" data item and the RGB overlay data
+item with the maxima drawn in. Swift is replaced by a minimal host whose data
+items keep the data they are given, as Swift's do.
+
+Every variant runs in a fresh process. Reported are the increase of the peak
+resident set size after the frame was created and the data held by the new
+data items.
+
+    python benchmark_memory.py [size]
+"""
+
+# python standard classes
+import sys
+import copy
+import time
+import uuid
+import resource
+import contextlib
+import multiprocessing
+import numpy as np
+from scipy import ndimage
+
+# specific application classes
+from nionswift_plugin.atmenmanip import detection
+from nionswift_plugin.atmenmanip import main
+try:
+    from imgrecoglib import irl_interface as ir
+except ImportError:
+    ir = None
+
+
+class XData:
+    """Data and metadata as the panel uses them."""
+
+    def __init__(self, data, intensity_calibration=None, dimensional_calibrations=None, metadata=None):
+        self.data = data
+        self.intensity_calibration = intensity_calibration
+        self.dimensional_calibrations = list(dimensional_calibrations or [None] * np.ndim(data))
+        self.metadata = dict(metadata or {})
+
+    @property
+    def data_shape(self):
+        return self.data.shape
+
+
+class DataItem:
+
+    def __init__(self, xdata, title=''):
+        self.xdata = xdata
+        self.title = title
+        self.uuid = uuid.uuid4()
+
+    @property
+    def data(self):
+        return self.xdata.data
+
+    def set_data(self, data):
+        self.xdata = XData(data, self.xdata.intensity_calibration, self.xdata.dimensional_calibrations,
+                           self.xdata.metadata)
+
+
+class Library:
+
+    @contextlib.contextmanager
+    def data_ref_for_data_item(self, data_item):
+        yield data_item
+
+
+class DocumentController:
+
+    def __init__(self, source):
+        self.target_data_item = source
+        self.library = Library()
+        self.data_items = []
+
+    def create_data_item_from_data_and_metadata(self, xdata, title=''):
+        data_item = DataItem(xdata, title)
+        self.data_items.append(data_item)
+        return data_item
+
+
+class API:
+
+    def create_data_and_metadata(self, data, intensity_calibration=None, dimensional_calibrations=None,
+                                 metadata=None):
+        return XData(data, intensity_calibration, dimensional_calibrations, metadata)
+
+    def queue_task(self, task):
+        task()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def before(dc, source, sigma, noise_tolerance):
+    processed = dc.create_data_item_from_data_and_metadata(copy.deepcopy(source.xdata),
+                                                           title='Local Maxima of ' + source.title)
+    if ir is not None:
+        picobj = ir.Picture(source.data, source.title, sigma, noise_tolerance)
+        picobj.blur_image()
+        picobj.detect_maxima()
+        maxima, filtered = picobj.maxima[-1], picobj.pic_filtered[-1]
+    else:
+        filtered = ndimage.gaussian_filter(source.data, sigma, truncate=detection.TRUNCATE)
+        maxima = detection.find_maxima(filtered, sigma, detection.absolute_threshold(source.data, noise_tolerance))
+    processed.set_data(filtered)
+    return len(maxima)
+
+
+def after(dc, source, sigma, noise_tolerance):
+    delegate = main.AtomManipDelegate(API())
+    delegate.dc = dc
+    delegate.source_data_item = source
+    delegate.sigma, delegate.noise_tolerance = sigma, noise_tolerance
+    delegate.process_and_show()
+    delegate.jobs.wait()
+    delegate.close()
+    return len(delegate.maxima)
+
+
+def run(variant, size, sigma, noise_tolerance, queue):
+    frame = np.random.default_rng(0).random((size, size))
+    source = DataItem(XData(frame, metadata=dict(hardware_source=dict(pixel_time_us=2))), title='Frame')
+    dc = DocumentController(source)
+    baseline = peak_rss_mb()
+    starttime = time.time()
+    number_maxima = (before if variant == "before" else after)(dc, source, sigma, noise_tolerance)
+    held_mb = sum(item.data.nbytes for item in dc.data_items) / 2**20
+    queue.put((peak_rss_mb() - baseline, held_mb, time.time() - starttime, number_maxima))
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 4096
+    sigma = 9
+    noise_tolerance = 1e-5
+    ctx = multiprocessing.get_context("spawn")
+    print("Frame {:d}x{:d} float64 ({:.0f} MB){}".format(size, size, size*size*8/2**20,
+                                                         "" if ir is not None else ", without imgrecoglib"))
+    for variant in ("before", "after"):
+        queue = ctx.Queue()
+        p = ctx.Process(target=run, args=(variant, size, sigma, noise_tolerance, queue))
+        p.start()
+        extra_mb, held_mb, duration, number_maxima = queue.get()
+        p.join()
+        print("{:>8s}: peak RSS +{:7.1f} MB, data items {:7.1f} MB, {:6.2f} s, {:d} maxima".format(
+              variant, extra_mb, held_mb, duration, number_maxima))
@@ -0,0 +1,3 @@
+# -*- coding: utf-8 -*-
+# the demo scripts need the full lab setup (cv2, the frames of the microscope)
+collect_ignore = ["atmenmanip_demo"]
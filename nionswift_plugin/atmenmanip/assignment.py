@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Assignment of targets to sources ahead of the path finding.
+
+The cost of sending a source to a target is the number of jumps along the
+bond graph, found by one BFS per source that runs in compiled code for all
+sources at once. The assignment then minimises either the total number of
+jumps (Hungarian algorithm) or the longest path (bottleneck assignment).
+"""
+
+# standard libraries
+import numpy as np
+
+# third party libraries
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.optimize import linear_sum_assignment
+
+
+def bond_graph(lattice):
+    n = len(lattice)
+    return sparse.csr_matrix((np.ones(len(lattice.indices), dtype=np.int8), lattice.indices, lattice.indptr),
+                             shape=(n, n))
+
+
+def hop_distances(lattice, sources, targets=None):
+    """Number of jumps from every source to every target (all sites if targets is None), inf if unreachable."""
+    if lattice.index is not None and targets is not None:
+        distances = lattice.index.hop_distances(sources, targets)
+        if distances is not None:
+            return distances
+    distances = csgraph.shortest_path(bond_graph(lattice), unweighted=True,
+                                      indices=np.asarray(sources, dtype=np.int32))
+    if targets is not None:
+        distances = distances[:, np.asarray(targets, dtype=np.int32)]
+    return distances
+
+
+def _perfect_matching(allowed):
+    """Column of every row in a perfect matching using only allowed pairs, None if there is none."""
+    matching = csgraph.maximum_bipartite_matching(sparse.csr_matrix(allowed), perm_type='column')
+    return None if np.any(matching < 0) else matching
+
+
+def bottleneck_assignment(cost):
+    """Assignment with the smallest possible largest cost, and the smallest sum among those."""
+    if cost.shape[0] > cost.shape[1]:
+        raise ValueError("More sources ({:d}) than targets ({:d})".format(*cost.shape))
+    values = np.unique(cost[np.isfinite(cost)])
+    lo, hi = 0, len(values) - 1
+    if hi < 0 or _perfect_matching(cost <= values[hi]) is None:
+        raise ValueError("Some sources cannot reach any free target")
+    # smallest threshold that still allows a perfect matching
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if _perfect_matching(cost <= values[mid]) is not None:
+            hi = mid
+        else:
+            lo = mid + 1
+    limited = np.where(cost <= values[lo], cost, np.inf)
+    return linear_sum_assignment(np.where(np.isfinite(limited), limited, cost.size * (values[-1] + 1)))
+
+
+def assign(lattice, sources, targets, objective='sum'):
+    """
+    Targets reordered so that targets[i] is the target of sources[i].
+
+    objective is 'sum' (fewest jumps in total) or 'makespan' (shortest
+    longest path). Returns the sources, the assigned targets and the number
+    of jumps of every atom.
+    """
+    sources = np.asarray(sources, dtype=np.int32)
+    targets = np.asarray(targets, dtype=np.int32)
+    if len(sources) != len(targets):
+        raise ValueError("Number of sources ({:d}) and targets ({:d}) differ".format(len(sources),
+                                                                                    len(targets)))
+    if len(sources) == 0:
+        return sources, targets, np.empty(0)
+    cost = hop_distances(lattice, sources, targets)
+    if objective == 'makespan':
+        rows, cols = bottleneck_assignment(cost)
+    elif objective == 'sum':
+        finite = np.isfinite(cost)
+        if not np.all(np.any(finite, axis=1)):
+            raise ValueError("Some sources cannot reach any free target")
+        rows, cols = linear_sum_assignment(np.where(finite, cost, cost[finite].sum() + 1))
+    else:
+        raise ValueError("Unknown objective '{}'".format(objective))
+    jumps = cost[rows, cols]
+    if not np.all(np.isfinite(jumps)):
+        raise ValueError("Some sources cannot reach any free target")
+    return sources[rows], targets[cols], jumps
@@ -5,139 +5,404 @@ Created on Fri Aug  3 15:14:25 2018
 
 @author: postla
 """
-# hardware classes
-from keithley_multimeter import keithley2000
 # specific application classes
-try:
-    from pathfindlib import pfl_interface as oopf
-    from pathfindlib import create_crystal as cc
-except:
-    import pfl_interface as oopf
-    import create_crystal as cc
+from . import tracking
+from . import devices
+from . import drift
+from . import planning
+from . import instrumentation
+from . import jump_detector
 # python standard classes
 import numpy as np
 from matplotlib import pyplot as plt
 import logging
+import threading
+import concurrent.futures
 import time
 
-#TODO: rewrite code to OOP
 sim_mode = True
 try:
-    keithley = keithley2000.KEITHLEY2000()
+    keithley = devices.KeithleyFeedback()
     logging.info("Connected to feedback-responding device")
 except:
     keithley = None
     logging.info("Something went wrong! Error #001")
 
-def AM(paths, api, document_controller):
-    if not keithley:
-        return
-        logging.info("No feedback-responding device")
-    # init
-    superscan = None
-    if sim_mode:
-        hwsrc = "usim_scan_device"
-    else:
-        hwsrc = "scan_controller"
-    superscan = api.get_hardware_source_by_id(hwsrc, "1")
+
+class AutoManipulator:
+    """
+    Walks the atoms along the paths of a lattice.Lattice.
+
+    In streaming mode, frames are taken from a tracking.FrameStream and the
+    sites around the current probe target are re-located in every frame, so
+    the probe follows the actual atom positions.
+
+    With drift_correction, every frame is registered against a reference and
+    the whole lattice is shifted by the measured drift, so a "d" from the
+    feedback device no longer ends the run. The reference is the frame the
+    lattice was detected in, if given (reference_shift is the drift already
+    applied to the lattice since, e.g. by an earlier run), and otherwise the
+    first frame of the run.
+
+    With image_feedback, jumps are detected in the frames by a
+    jump_detector.ImageJumpDetector instead of waiting for the Keithley.
+
+    With replan, every "j" is checked in the next frame: the atom is searched
+    among its old site and the neighbours of it. If it landed on another site
+    than planned, its path (and any later path that now conflicts) is repaired
+    by planning.Replanner. The frame is used again for the next step.
+
+    Waiting for data items and feedback is event driven; stop() interrupts a
+    running loop at the next wait.
+
+    The microscope is accessed through a devices.ScanDevice and a
+    devices.FeedbackDevice. They default to Swift's scan hardware source and
+    the Keithley; with the devices of the simulator module and no
+    document_controller, the loop runs offline without Swift.
+    """
+
+    def __init__(self, lattice, api, document_controller, streaming=False, tracker=None, sigma=None,
+                 scan_device=None, feedback_device=None, drift_correction=True,
+                 replan=True, image_feedback=False, reference=None, reference_shift=None):
+        self.lattice = lattice
+        self.api = api
+        self.document_controller = document_controller
+        if scan_device is None:
+            scan_device = devices.SwiftScanDevice(api, sim_mode=sim_mode)
+        self.scan_device = scan_device
+        if feedback_device is None:
+            feedback_device = jump_detector.ImageJumpDetector(scan_device, lattice) if image_feedback else keithley
+        self.feedback_device = feedback_device
+
+        self.streaming = streaming
+        self.stream = None
+        self.tracker = tracker
+        if streaming and tracker is None:
+            self.tracker = tracking.SiteTracker(lattice, sigma=sigma)
+        self.drift_tracker = drift.DriftTracker(lattice, sigma=sigma) if drift_correction else None
+        if self.drift_tracker is not None and reference is not None:
+            self.drift_tracker.set_reference(reference, reference_shift)
+        self.replanner = planning.Replanner(lattice) if replan else None
+        self.locator = self.tracker if self.tracker is not None else tracking.SiteTracker(lattice, sigma=sigma)
+        self._pending = None # frame of the last jump check, used again by the next step
+        self._drifted = False # feedback reported a drift since the last frame
+        self._before = None # last frame before the step and the drift shift at that time
+        self.change_threshold = 0.5 # change of a site that counts, relative to the dopant's contrast
+        self.reverify_after = 2 # timeouts in a row after which the atom is looked for anyway
+        self.max_retries = 10 # steps in a row without progress after which the run stops
+        self.retries = 0
+
+        self.frame_number = 1
+        self.atoms_moved = 0
+        self.point_region = None
+        self.current_path_idx = 0
+        self.current_position_in_sitelist = 0
+        self.current_sitelist = None
+
+        self.stop_event = threading.Event()
+        self._wake = threading.Event()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def stop(self):
+        self.stop_event.set()
+        self._wake.set()
+        if self.feedback_device is not None:
+            self.feedback_device.cancel()
+
+    # Wait until the future is done or stop() was called
+    def wait_for(self, future, timeout=None):
+        self._wake.clear()
+        future.add_done_callback(lambda f: self._wake.set())
+        if self.stop_event.is_set():
+            return None
+        self._wake.wait(timeout)
+        if future.done():
+            return future.result()
+        return None
+
+    # Site the atom is on and site the probe is pulling it to
+    def current_sites(self):
+        path = self.lattice.paths[self.current_path_idx]
+        return path[self.current_position_in_sitelist], self.current_sitelist[self.current_position_in_sitelist]
+
+    def record(self):
+        if self.streaming:
+            # after a drift, frames started before it would shift the lattice back
+            frame = self.stream.get_fresh(timeout=3) if self._drifted else self.stream.get(timeout=3)
+            self._drifted = False
+            return [frame] if frame is not None else []
+        return self.scan_device.record()
+
+    def correct(self, xdata_list):
+        if xdata_list and self.drift_tracker is not None:
+            # the first channel is registered, the others are recorded simultaneously
+            self.drift_tracker.update(xdata_list[0].data)
+
+    # Peak intensity of the sites, the lattice coordinates were offset by drift since the frame
+    def site_peaks(self, xdata, sites, offset=0):
+        # blurred to about the width of a column only, a wide blur mixes in the neighbours
+        _, peaks = tracking.relocate(xdata.data, self.lattice.coords[sites] - offset, self.locator.radius,
+                                     self.locator.radius / 4)
+        return peaks
+
+    # Site among site and its neighbours the (brighter) dopant moved to, None if that is unclear
+    def locate_atom(self, xdata, site):
+        candidates = np.concatenate(([site], self.lattice.neighbours(site)))
+        # neighbours held by the other atoms are bright as well
+        candidates = candidates[~np.isin(candidates, self.replanner.occupied(self.current_path_idx))]
+        peaks = self.site_peaks(xdata, candidates)
+        if self._before is None:
+            return int(candidates[np.argmax(peaks)])
+        # only sites that changed since the frame before the step count, an unplanned
+        # dopant next to the path is as bright as the atom but stays as it is
+        before_xdata, before_shift = self._before
+        before = self.site_peaks(before_xdata, candidates, self.drift_shift() - before_shift)
+        change = peaks - before
+        contrast = max(before[0] - np.median(before[1:]), 1e-12) if len(before) > 1 else abs(before[0]) + 1e-12
+        if -change[0] < self.change_threshold * contrast:
+            return int(site)
+        if len(change) < 2 or change[1:].max() < self.change_threshold * contrast:
+            return None
+        return int(candidates[1 + np.argmax(change[1:])])
+
+    def drift_shift(self):
+        return self.drift_tracker.shift.copy() if self.drift_tracker is not None else np.zeros(2)
+
+    @instrumentation.timed('verify jump')
+    def verify_jump(self):
+        image_feedback = isinstance(self.feedback_device, jump_detector.ImageJumpDetector)
+        if image_feedback and self.feedback_device.last_frame:
+            # the frame the jump was seen in
+            xdata_list = self.feedback_device.last_frame
+        elif self.streaming:
+            # frames started before the jump are of no use
+            frame = self.stream.get_fresh(timeout=3)
+            xdata_list = [frame] if frame is not None else []
+        else:
+            xdata_list = self.record()
+        self.correct(xdata_list)
+        self._pending = xdata_list
+        if not xdata_list:
+            self.current_position_in_sitelist += 1
+            self.retries = 0
+            return
+        atom, target = self.current_sites()
+        landed = self.locate_atom(xdata_list[0], atom)
+        if landed == target:
+            self.current_position_in_sitelist += 1
+            self.retries = 0
+            instrumentation.count('jumps')
+        elif landed == atom:
+            logging.info("Atom did not move from site {:d}".format(int(atom)))
+        elif landed is None:
+            logging.info("Atom left site {:d}, but no neighbour took it".format(int(atom)))
+        else:
+            self.retries = 0
+            instrumentation.count('misjumps')
+            with instrumentation.span('repair') as span:
+                repaired = self.replanner.repair(self.current_path_idx, landed)
+            logging.info("Atom jumped to site {:d} instead of {:d}, repaired path(s) {} in {:.1f} ms".format(
+                                    landed, int(target), repaired, span.duration*1e3))
+            self.current_sitelist = self.lattice.paths[self.current_path_idx][1:]
+            self.current_position_in_sitelist = 0
+
+    @instrumentation.timed('track')
+    def track(self, xdata):
+        # re-locate the atom's site, the target site and their neighbours
+        indices = self.tracker.sites_near(*self.current_sites())
+        self.tracker.update(xdata.data, indices)
+
+    def show_frame(self, xdata, timeout=3):
+        done = threading.Event()
+        data_item = None
+        def create_data_item():
+            nonlocal data_item
+            data_item = self.document_controller.create_data_item_from_data_and_metadata(xdata)
+            done.set()
+        self.api.queue_task(create_data_item)
+        if not done.wait(timeout):
+            logging.info("Data item for frame {:.0f} did not appear within {:.0f} s".format(
+                                                                            self.frame_number, timeout))
+        return data_item
 
     # auxiliary function
-    def runmap(stop_event, frametimeout, jump_threshold=0.15, drift_threshold=0.1):
-        frame_number = 1
-        while not stop_event.wait(0.1):
-            xdata_list = superscan.record()
-            for xdata in xdata_list:
-                data_item = None
-                def create_data_item():
-                    nonlocal data_item
-                    data_item = document_controller.create_data_item_from_data_and_metadata(xdata)
-                api.queue_task(create_data_item)
-                starttime = time.time()
-                while data_item is None and not time.time() - starttime > 3: # only wait 3s maximum for data item to appear
-                    time.sleep(0.2)
-                metadata_dict = data_item.metadata
-                metadata_dict.setdefault('Auto-Manipulator', dict())['frame_number'] = frame_number
-                #metadata_dict.setdefault('Auto-Manipulator', dict())['tractor_time'] = frametimeout
-                #metadata_dict.setdefault('Auto-Manipulator', dict())['autodetect_jumps'] = autodetect_checked
-
-                pp_dem_xy = current_sitelist[current_position_in_sitelist].coords
-                probe_position_demand = (pp_dem_xy[1], pp_dem_xy[0])
-                probe_position_hw = superscan._hardware_source.probe_position
-                
-                #todo do not use target data item
-                tdi = document_controller.target_data_item
-                
-                # Position point region
-                if probe_position_hw:
-                    for point_region in tdi.graphics:
-                        if ("probe" in point_region.label) or ("Probe" in point_region.label):
-                            break
-                else:
-                    point_region = tdi.add_point_region(0, 0)
-                point_region.set_property("position", probe_position_demand)
-                point_region.set_property('is_position_locked', True)
-                point_region.label = 'Probe position'
+    def runmap(self, frametimeout, jump_threshold=0.15, drift_threshold=0.1):
+        with instrumentation.span('step') as step:
+            feedback, latency = self._runmap(frametimeout)
+        logging.info("Step {:.0f}: {:s}, total {:.1f} ms".format(self.frame_number - 1,
+                        ", ".join("{:s} {:.1f} ms".format(k, v*1e3) for k, v in latency.items()),
+                        step.duration*1e3))
+        return feedback
 
-                # Write data_item
-                try:
-                    channel_name = data_item.get_metadata_value('stem.scan.channel_name')
-                except KeyError:
-                    channel_name = ''
-                data_item.title = 'Tractor beam ({:s}) frame {:.0f}, {:s}'.format(channel_name,
-                                                                                        frame_number,
-                                                                            time.strftime('%H-%M-%S h'))
-                metadata_dict.setdefault('Auto-Manipulator', dict())['probe_position'] = {
-                                            'y': probe_position_hw.y, 'x': probe_position_hw.x }
-                data_item.set_metadata(metadata_dict)
-                
-            frame_number += 1
-            
-            # HARDWARE input: set probe position
-            probe_position_hw = point_region.position
-                    # probe_position_hw = point_region_demand
-                    #
-                    #   !!! Might need this:
-                    # superscan._hardware_source.probe_position = probe_position
-            
-            # HARDWARE action
-            feedback =  keithley.waitforjump(20)
-            return feedback
-    
-    
-    current_path_idx = 0
-    current_position_in_sitelist = 0
-    try:
-        current_path = paths[current_path_idx]
-        current_sitelist = current_path.sitelist[1:len(current_path)]
-        runthis = True
-    except:
-        runthis = False
-        print("Auto-Manipulator did not start.")
-  
-    # Icy Manipulator
-    while runthis:
-        feedback = runmap(stop_event=None, frametimeout=20, jump_threshold=0.15, drift_threshold=0.1)
-        if feedback == "j": # Jump detected
-            current_position_in_sitelist += 1
-        elif feedback == "d": # Drift detected
-            #todo implement drift correction
-            runthis = False            
-            pass
-        elif feedback == "to": # Timeout
-            #todo check! retry?
-            pass
+    def _runmap(self, frametimeout):
+        frame_number = self.frame_number
+        latency = dict()
+        if self._pending is not None:
+            xdata_list, self._pending = self._pending, None
         else:
+            with instrumentation.span('record') as span:
+                xdata_list = self.record()
+            latency['record'] = span.duration
+            with instrumentation.span('drift') as span:
+                self.correct(xdata_list)
+            latency['drift'] = span.duration
+        instrumentation.count('frames processed', len(xdata_list))
+        for xdata in xdata_list:
+            if self.streaming:
+                self.track(xdata)
+            if self.document_controller is None:
+                continue
+            with instrumentation.span('data item') as span:
+                data_item = self.show_frame(xdata)
+            latency['data item'] = span.duration
+            if data_item is None:
+                continue
+            metadata_dict = data_item.metadata
+            metadata_dict.setdefault('Auto-Manipulator', dict())['frame_number'] = frame_number
+            #metadata_dict.setdefault('Auto-Manipulator', dict())['tractor_time'] = frametimeout
+            #metadata_dict.setdefault('Auto-Manipulator', dict())['autodetect_jumps'] = autodetect_checked
+
+            pp_dem_xy = self.lattice.coords[self.current_sitelist[self.current_position_in_sitelist]]
+            probe_position_demand = (pp_dem_xy[1], pp_dem_xy[0])
+            probe_position_hw = self.scan_device.probe_position
+
+            #todo do not use target data item
+            tdi = self.document_controller.target_data_item
+
+            # Position point region
+            if probe_position_hw:
+                for point_region in tdi.graphics:
+                    if ("probe" in point_region.label) or ("Probe" in point_region.label):
+                        break
+            else:
+                point_region = tdi.add_point_region(0, 0)
+            point_region.set_property("position", probe_position_demand)
+            point_region.set_property('is_position_locked', True)
+            point_region.label = 'Probe position'
+            self.point_region = point_region
+
+            # Write data_item
+            try:
+                channel_name = data_item.get_metadata_value('stem.scan.channel_name')
+            except KeyError:
+                channel_name = ''
+            data_item.title = 'Tractor beam ({:s}) frame {:.0f}, {:s}'.format(channel_name,
+                                                                                    frame_number,
+                                                                        time.strftime('%H-%M-%S h'))
+            metadata_dict.setdefault('Auto-Manipulator', dict())['probe_position'] = {
+                                        'y': probe_position_hw.y, 'x': probe_position_hw.x }
+            data_item.set_metadata(metadata_dict)
+
+        self.frame_number += 1
+
+        # HARDWARE input: set probe position
+        self.scan_device.set_probe_target(*self.lattice.coords[self.current_sitelist[self.current_position_in_sitelist]])
+
+        # HARDWARE action
+        self._before = (xdata_list[0], self.drift_shift()) if xdata_list else None
+        self.feedback_device.set_sites(*self.current_sites(), xdata_list)
+        with instrumentation.span('feedback') as span:
+            feedback = self.wait_for(self._executor.submit(self.feedback_device.waitforjump, frametimeout))
+        latency['feedback'] = span.duration
+        return feedback, latency
+
+    # Make path idx the current one, atoms that already sit on their target
+    # (one-site paths) are skipped. False if no path is left.
+    def start_path(self, idx):
+        paths = self.lattice.paths
+        while idx < len(paths) and len(paths[idx]) < 2:
+            idx += 1
+        self.current_path_idx = idx
+        self.current_position_in_sitelist = 0
+        self.retries = 0
+        if idx >= len(paths):
+            return False
+        self.current_sitelist = paths[idx][1:]
+        return True
+
+    def run(self, stop_event=None, frametimeout=20):
+        if stop_event is not None:
+            self.stop_event = stop_event
+        if not self.feedback_device:
+            logging.info("No feedback-responding device")
+            return
+        runthis = self.current_path_idx < len(self.lattice.paths)
+        if not runthis:
+            print("Auto-Manipulator did not start.")
+        elif not self.start_path(self.current_path_idx):
             runthis = False
-            pass
-    
+            print("FINISHED!")
+
+        if self.replanner is not None:
+            self.replanner.prepare()
+        # the stream and the image feedback take the frames of a running acquisition
+        live = self.streaming or isinstance(self.feedback_device, jump_detector.ImageJumpDetector)
+        if live:
+            self.scan_device.start_streaming()
+
+        # Icy Manipulator
         try:
-            current_sitelist[current_position_in_sitelist]
-        except: # reached end of sitelist
-            current_path_idx += 1
-            current_position_in_sitelist = 0
-            try:
-                current_path = paths[current_path_idx]
-                current_sitelist = current_path.sitelist[1:len(current_path)]
-            except: # reached end of last path
-                runthis = False
-                print("FINISHED!")
+            if self.streaming:
+                self.stream = tracking.FrameStream(self.scan_device.grab_next_to_finish).start()
+                if isinstance(self.feedback_device, jump_detector.ImageJumpDetector):
+                    # one consumer of the live frames
+                    self.feedback_device.grab = self.record
+            while runthis and not self.stop_event.is_set():
+                feedback = self.runmap(frametimeout=frametimeout, jump_threshold=0.15, drift_threshold=0.1)
+                if feedback == "j": # Jump detected
+                    if self.replanner is not None:
+                        self.retries += 1 # until the jump is confirmed
+                        try:
+                            self.verify_jump()
+                        except ValueError as e:
+                            print("Auto-Manipulator stopped: {}".format(e))
+                            runthis = False
+                    else:
+                        self.current_position_in_sitelist += 1
+                        self.retries = 0
+                elif feedback == "d": # Drift detected
+                    # the next frame is registered and the lattice follows
+                    if self.drift_tracker is None:
+                        runthis = False
+                    self._drifted = True
+                elif feedback == "to": # Timeout
+                    self.retries += 1
+                    if self.replanner is not None and self.retries % self.reverify_after == 0:
+                        # the jump may have been missed
+                        try:
+                            self.verify_jump()
+                        except ValueError as e:
+                            print("Auto-Manipulator stopped: {}".format(e))
+                            runthis = False
+                else:
+                    runthis = False
+                    pass
+
+                if runthis and self.retries >= self.max_retries:
+                    print("Auto-Manipulator stopped: atom on site {:d} did not move in {:d} attempts".format(
+                                                                    int(self.current_sites()[0]), self.retries))
+                    runthis = False
+
+                try:
+                    self.current_sitelist[self.current_position_in_sitelist]
+                except: # reached end of sitelist
+                    self.atoms_moved += 1
+                    if not self.start_path(self.current_path_idx + 1): # reached end of last path
+                        runthis = False
+                        print("FINISHED!")
+        finally:
+            if self.stream is not None:
+                self.stream.stop()
+                self.stream = None
+            if live:
+                self.scan_device.stop_streaming()
+            self._executor.shutdown(wait=False)
+            if self.stop_event.is_set():
+                print("Auto-Manipulator stopped.")
+
+
+def AM(lattice, api, document_controller, streaming=False, sigma=None, scan_device=None, feedback_device=None,
+       image_feedback=False):
+    AutoManipulator(lattice, api, document_controller, streaming=streaming, sigma=sigma,
+                    scan_device=scan_device, feedback_device=feedback_device,
+                    image_feedback=image_feedback).run()
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Headless batch analysis of archived frames.
+
+Every .npy/.tif file below the input directories is memory-mapped (stacks
+give one frame per slice, compressed ones are decoded a page at a time) and
+run through maxima detection, bonding and substitutional detection
+(dopants.py) in a process pool. Only a few frames are in flight at any time,
+so the memory use is bounded by the number of workers and not by the size of
+the archive. One row per frame (counts, dopant positions and timings) is
+appended to a CSV file as soon as the frame is done. Frames that are already
+in the file are skipped, so an interrupted run is resumed by starting it
+again.
+
+With --pyramid, survey scans are searched coarse-to-fine
+(detection.detect_maxima_pyramid) and dopants are classified by the peak
+heights found on the way, so no full resolution blurred frame is made.
+
+    python -m nionswift_plugin.atmenmanip.batch frames/ -o results.csv --sigma 8 --noise-tolerance 5e-4
+"""
+
+# standard libraries
+import os
+import csv
+import sys
+import time
+import argparse
+import collections
+import concurrent.futures
+import numpy as np
+
+# third party libraries
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+    from PIL import Image
+
+# local libraries
+from . import detection
+from . import lattice
+from . import dopants
+
+EXTENSIONS = ('.npy', '.tif', '.tiff')
+COLUMNS = ('file', 'index', 'height', 'width', 'number_maxima', 'number_bonds', 'number_dopants',
+           'dopants_y', 'dopants_x', 'detection_time', 'bonds_time', 'dopants_time', 'total_time', 'error')
+
+
+class PageStack:
+    """
+    Frames of a TIFF stack that can't be memory-mapped (e.g. compressed).
+
+    Indexing decodes only the requested page, so reading all frames of a
+    stack reads the file once and not once per frame.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if tifffile is not None:
+            with tifffile.TiffFile(path) as tif:
+                number_pages, page_shape = len(tif.pages), tif.pages[0].shape
+        else:
+            with Image.open(path) as image:
+                number_pages, page_shape = getattr(image, 'n_frames', 1), np.asarray(image).shape
+        self.shape = (number_pages,) + tuple(page_shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError("page {} out of range".format(index))
+        index %= len(self)
+        if tifffile is not None:
+            with tifffile.TiffFile(self.path) as tif:
+                return tif.pages[index].asarray()
+        with Image.open(self.path) as image:
+            image.seek(index)
+            return np.asarray(image)
+
+
+def open_frames(path):
+    """Memory-mapped array of a file, (height, width) or (frames, height, width)."""
+    if path.lower().endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    if tifffile is not None:
+        try:
+            return tifffile.memmap(path, mode='r')
+        except ValueError: # compressed or not contiguous
+            pass
+    frames = PageStack(path)
+    return frames[0] if len(frames) == 1 else frames
+
+
+def find_files(inputs):
+    files = []
+    for path in inputs:
+        if os.path.isfile(path):
+            files.append(path)
+            continue
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            files.extend(os.path.join(root, name) for name in sorted(names) if name.lower().endswith(EXTENSIONS))
+    return files
+
+
+def list_frames(files):
+    """(file, index) of every frame, index is None for single frames."""
+    for path in files:
+        try:
+            shape = open_frames(path).shape
+        except (OSError, ValueError) as e:
+            print("Skipping {}: {}".format(path, e))
+            continue
+        if len(shape) == 2:
+            yield path, None
+        elif len(shape) == 3:
+            for index in range(shape[0]):
+                yield path, index
+        else:
+            print("Skipping {}: not a frame or stack of frames (shape {})".format(path, shape))
+
+
+def analyse_frame(path, index, sigma, noise_tolerance, maxlength, tile_size, dopant_threshold, pyramid=False):
+    """One result row (dict of COLUMNS) of a frame, runs in a worker process."""
+    row = dict(file=path, index='' if index is None else index)
+    starttime = time.perf_counter()
+    try:
+        frames = open_frames(path)
+        frame = frames if index is None else frames[index]
+        row['height'], row['width'] = frame.shape
+
+        t = time.perf_counter()
+        if pyramid:
+            sites, heights = detection.detect_maxima_pyramid(frame, sigma, noise_tolerance)
+        else:
+            # one worker per process, the frames are processed in parallel instead
+            if max(frame.shape) > tile_size:
+                blurred = detection.blur_tiled(frame, sigma, tile_size=tile_size, workers=1)
+            else:
+                blurred = detection.blur(frame, sigma)
+            maxima = detection.frame_maxima(frame, blurred, sigma, noise_tolerance, tile_size, workers=1)
+            sites = detection.refine_maxima(blurred, maxima, sigma)
+        row['detection_time'] = round(time.perf_counter() - t, 6)
+        row['number_maxima'] = len(sites)
+
+        t = time.perf_counter()
+        lat = lattice.Lattice(sites, lattice.find_bonds(sites, maxlength))
+        row['bonds_time'] = round(time.perf_counter() - t, 6)
+        row['number_bonds'] = lat.number_bonds
+
+        if dopant_threshold:
+            t = time.perf_counter()
+            if pyramid:
+                features = dict(contrast=dopants.relative_to_neighbours(heights, lat))
+            else:
+                features = dopants.intensity_features(frame, blurred, lat, sigma)
+            found = dopants.classify(features, dopant_threshold)
+            row['dopants_time'] = round(time.perf_counter() - t, 6)
+            row['number_dopants'] = len(found)
+            row['dopants_y'] = ' '.join('{:.2f}'.format(y) for y in lat.coords[found, 0])
+            row['dopants_x'] = ' '.join('{:.2f}'.format(x) for x in lat.coords[found, 1])
+    except Exception as e:
+        row['error'] = '{}: {}'.format(type(e).__name__, e)
+    row['total_time'] = round(time.perf_counter() - starttime, 6)
+    return row
+
+
+def frame_id(path, index):
+    return (os.path.abspath(path), '' if index is None else str(index))
+
+
+def read_done(output):
+    """Frames that were analysed without error by an earlier run."""
+    done = set()
+    if not os.path.exists(output):
+        return done
+    # a run that was killed while writing leaves an incomplete last line
+    with open(output, 'rb+') as f:
+        content = f.read()
+        if content and not content.endswith(b'\n'):
+            f.truncate(content.rfind(b'\n') + 1)
+    with open(output, newline='') as f:
+        for row in csv.DictReader(f):
+            if row.get('file') and not row.get('error'):
+                done.add(frame_id(row['file'], row['index'] or None))
+    return done
+
+
+def run(inputs, output, sigma, noise_tolerance, maxlength, tile_size=1024, dopant_threshold=2.0, workers=None,
+        in_flight=2, pyramid=False):
+    """
+    Analyse all frames of inputs that are not yet in output.
+
+    Sites brighter than dopant_threshold times their neighbours are dopants
+    (None skips the dopant detection). pyramid detects the maxima
+    coarse-to-fine. At most in_flight frames per worker are submitted at a
+    time. Returns the number of frames analysed in this run.
+    """
+    done = read_done(output)
+    frames = list_frames(find_files(inputs))
+    workers = workers or os.cpu_count() or 1
+    new_file = not os.path.exists(output) or os.path.getsize(output) == 0
+    number_frames = number_skipped = 0
+    starttime = time.time()
+    with open(output, 'a', newline='') as f, \
+         concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS, restval='')
+        if new_file:
+            writer.writeheader()
+        futures = collections.deque()
+        while True:
+            while len(futures) < workers * in_flight:
+                frame = next(frames, None)
+                while frame is not None and frame_id(*frame) in done:
+                    number_skipped += 1
+                    frame = next(frames, None)
+                if frame is None:
+                    break
+                futures.append(executor.submit(analyse_frame, os.path.abspath(frame[0]), frame[1], sigma,
+                                               noise_tolerance, maxlength, tile_size, dopant_threshold, pyramid))
+            if not futures:
+                break
+            finished, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                futures.remove(future)
+                row = future.result()
+                writer.writerow(row)
+                number_frames += 1
+                if row.get('error'):
+                    print("{} [{}]: {}".format(row['file'], row['index'], row['error']))
+            f.flush()
+    elapsed = time.time() - starttime
+    print("Analysed {:d} frames in {:.1f} s ({:d} skipped)".format(number_frames, elapsed, number_skipped))
+    return number_frames
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('inputs', nargs='+', help=".npy/.tif files or directories")
+    parser.add_argument('-o', '--output', default='atmenmanip_batch.csv')
+    parser.add_argument('--sigma', type=float, default=9)
+    parser.add_argument('--noise-tolerance', type=float, default=1e-5)
+    parser.add_argument('--maxlength', type=float, default=50, help="max. bond length in pixels")
+    parser.add_argument('--tile-size', type=int, default=1024)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--dopant-threshold', type=float, default=2.0,
+                        help="min. intensity of a dopant relative to its neighbours")
+    parser.add_argument('--no-dopants', dest='dopant_threshold', action='store_const', const=None,
+                        help="skip the substitutional detection")
+    parser.add_argument('--pyramid', action='store_true',
+                        help="find the maxima coarse-to-fine (large fields of view)")
+    args = parser.parse_args(argv)
+    run(args.inputs, args.output, args.sigma, args.noise_tolerance, args.maxlength, tile_size=args.tile_size,
+        dopant_threshold=args.dopant_threshold, workers=args.workers, pyramid=args.pyramid)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,582 @@
+# -*- coding: utf-8 -*-
+"""
+Gaussian blur and local maxima detection, whole-frame or tiled.
+
+A pixel of the blurred image is a maximum if it is the largest value within a
+window of radius ~sigma and rises above the lowest value in that window by more
+than noise_tolerance times the intensity range of the frame. Every step only
+looks at a bounded neighbourhood, so a frame can be split into overlapping
+tiles that give the same maxima as the whole frame.
+
+The integer maxima are refined to sub-pixel positions by Gaussian fits to
+all of them at once (refine_maxima).
+
+Large fields of view can be searched coarse-to-fine instead
+(detect_maxima_pyramid): candidates on a downsampled frame, refined in small
+windows at full resolution.
+
+noise_tolerance is not the one of imgrecoglib's Picture. All frames, tiled
+or not, are searched with the rule above, so a tuned value gives the same
+maxima whatever the frame size.
+"""
+
+# standard libraries
+import os
+import hashlib
+import threading
+import collections
+import concurrent.futures
+import numpy as np
+
+# third party libraries
+from scipy import ndimage
+from scipy import fft as sp_fft
+from scipy.spatial import cKDTree
+
+TRUNCATE = 4.0 # Gaussian kernel is cut off at TRUNCATE*sigma
+
+
+def kernel_radius(sigma):
+    return int(TRUNCATE * float(sigma) + 0.5)
+
+
+def window_radius(sigma):
+    return max(1, int(round(sigma)))
+
+
+def frame_key(data):
+    """Cheap content hash of a frame, used to recognise unchanged source data."""
+    data = np.ascontiguousarray(data)
+    digest = hashlib.blake2b(memoryview(data).cast('B'), digest_size=16)
+    digest.update(str((data.shape, data.dtype.str)).encode())
+    return digest.hexdigest()
+
+
+def gaussian_kernel1d(sigma):
+    """Normalised 1D Gaussian, same weights as scipy.ndimage.gaussian_filter."""
+    r = kernel_radius(sigma)
+    x = np.arange(-r, r + 1)
+    phi = np.exp(-0.5 / float(sigma)**2 * x**2)
+    return phi / phi.sum()
+
+
+class BlurEngine:
+    """
+    Gaussian blur that picks separable or FFT convolution.
+
+    Kernel spectra are cached per (padded shape, sigma) with LRU eviction, so
+    repeated blurs of frames of the same size only cost two FFTs.
+    """
+
+    def __init__(self, max_kernels=8):
+        self.max_kernels = max_kernels
+        self._kernels = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def choose_method(shape, sigma):
+        # separable cost grows with the kernel length, FFT cost with log(pixels)
+        taps = 2 * kernel_radius(sigma) + 1
+        return 'fft' if 2 * taps > np.log2(max(np.prod(shape), 2)) else 'separable'
+
+    def blur(self, image, sigma, method=None):
+        """Blurred float32 copy of image. The input is never converted or copied as a whole."""
+        image = np.asarray(image)
+        if method is None:
+            method = self.choose_method(image.shape, sigma)
+        if method == 'separable':
+            return ndimage.gaussian_filter(image, sigma, output=np.float32, truncate=TRUNCATE)
+        return self._fft_blur(image, sigma)
+
+    def kernel_fft(self, shape, sigma):
+        key = (tuple(shape), float(sigma))
+        with self._lock:
+            if key in self._kernels:
+                self._kernels.move_to_end(key)
+                return self._kernels[key]
+        k = gaussian_kernel1d(sigma)
+        r = len(k) // 2
+        ky = np.zeros(shape[0])
+        kx = np.zeros(shape[1])
+        # centre the kernel on index 0 (circular)
+        ky[np.arange(-r, r + 1) % shape[0]] = k
+        kx[np.arange(-r, r + 1) % shape[1]] = k
+        spectrum = np.outer(sp_fft.fft(ky), sp_fft.rfft(kx)).astype(np.complex64)
+        with self._lock:
+            self._kernels[key] = spectrum
+            while len(self._kernels) > self.max_kernels:
+                self._kernels.popitem(last=False)
+        return spectrum
+
+    def _fft_blur(self, image, sigma):
+        r = kernel_radius(sigma)
+        # mirror padding reproduces the 'reflect' boundary of gaussian_filter
+        shape = [sp_fft.next_fast_len(n + 2 * r, real=True) for n in image.shape]
+        padded = pad_symmetric(image, [(r, s - n - r) for n, s in zip(image.shape, shape)], np.float32)
+        spectrum = sp_fft.rfft2(padded, workers=-1)
+        spectrum *= self.kernel_fft(shape, sigma)
+        blurred = sp_fft.irfft2(spectrum, s=shape, workers=-1)
+        return np.ascontiguousarray(blurred[r:r + image.shape[0], r:r + image.shape[1]], dtype=np.float32)
+
+
+def pad_symmetric(image, pad_width, dtype):
+    """np.pad(image, pad_width, mode='symmetric') written directly into a new array of dtype."""
+    (b0, a0), (b1, a1) = pad_width
+    h, w = image.shape
+    if max(b0, a0) > h or max(b1, a1) > w:
+        return np.pad(np.asarray(image, dtype=dtype), pad_width, mode='symmetric')
+    out = np.empty((b0 + h + a0, b1 + w + a1), dtype=dtype)
+    out[b0:b0 + h, b1:b1 + w] = image
+    out[:b0, b1:b1 + w] = out[b0:2 * b0, b1:b1 + w][::-1]
+    out[b0 + h:, b1:b1 + w] = out[b0 + h - a0:b0 + h, b1:b1 + w][::-1]
+    out[:, :b1] = out[:, b1:2 * b1][:, ::-1]
+    out[:, b1 + w:] = out[:, b1 + w - a1:b1 + w][:, ::-1]
+    return out
+
+
+_default_engine = BlurEngine()
+
+
+def blur(image, sigma, engine=None, method=None):
+    return (engine or _default_engine).blur(image, sigma, method)
+
+
+def find_maxima(blurred, sigma, threshold):
+    """(N, 2) array of (y, x) maxima of a blurred image, in raster order.
+
+    threshold is the absolute rise above the window minimum.
+    """
+    size = 2 * window_radius(sigma) + 1
+    maxf = ndimage.maximum_filter(blurred, size=size, mode='nearest')
+    minf = ndimage.minimum_filter(blurred, size=size, mode='nearest')
+    mask = (blurred == maxf) & (blurred - minf > threshold)
+    # on plateaus only keep the first pixel in raster order
+    earlier = np.zeros_like(mask)
+    earlier[1:, :] |= mask[:-1, :]
+    earlier[:, 1:] |= mask[:, :-1]
+    earlier[1:, 1:] |= mask[:-1, :-1]
+    earlier[1:, :-1] |= mask[:-1, 1:]
+    mask &= ~earlier
+    return np.argwhere(mask)
+
+
+def absolute_threshold(image, noise_tolerance):
+    image = np.asarray(image)
+    return noise_tolerance * float(np.max(image) - np.min(image))
+
+
+def detect_maxima(image, sigma, noise_tolerance, engine=None):
+    """Blur the whole frame and detect its maxima. Returns (blurred, maxima)."""
+    blurred = blur(image, sigma, engine)
+    return blurred, find_maxima(blurred, sigma, absolute_threshold(image, noise_tolerance))
+
+
+def frame_maxima(image, blurred, sigma, noise_tolerance, tile_size=1024, workers=None):
+    """
+    Maxima of an already blurred frame as the panel finds them.
+
+    Frames larger than tile_size are searched on tiles, which gives the same
+    maxima as the whole frame.
+    """
+    threshold = absolute_threshold(image, noise_tolerance)
+    if max(np.shape(blurred)) > tile_size:
+        return find_maxima_tiled(blurred, sigma, threshold, tile_size, workers)
+    return find_maxima(blurred, sigma, threshold)
+
+
+# Tiled processing
+def _tiles(shape, tile_size, margin):
+    for y0 in range(0, shape[0], tile_size):
+        for x0 in range(0, shape[1], tile_size):
+            core = (y0, min(y0 + tile_size, shape[0]), x0, min(x0 + tile_size, shape[1]))
+            padded = (max(core[0] - margin, 0), min(core[1] + margin, shape[0]),
+                      max(core[2] - margin, 0), min(core[3] + margin, shape[1]))
+            yield core, padded
+
+
+def _crop_core(array, core, padded):
+    cy, cx = core[0] - padded[0], core[2] - padded[2]
+    return array[cy:cy + core[1] - core[0], cx:cx + core[3] - core[2]]
+
+
+def _blur_tile(tile, sigma, method, engine, core, padded):
+    return _crop_core(blur(tile, sigma, engine, method), core, padded)
+
+
+def _maxima_tile(tile, sigma, threshold, core, padded):
+    maxima = find_maxima(tile, sigma, threshold)
+    maxima += (padded[0], padded[2])
+    inside = ((maxima[:, 0] >= core[0]) & (maxima[:, 0] < core[1]) &
+              (maxima[:, 1] >= core[2]) & (maxima[:, 1] < core[3]))
+    return maxima[inside]
+
+
+def _map_tiles(func, image, margin, tile_size, workers, use_processes, *args):
+    workers = workers or os.cpu_count() or 1
+    if use_processes:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    with executor:
+        futures = dict()
+        for core, padded in _tiles(image.shape, tile_size, margin):
+            tile = image[padded[0]:padded[1], padded[2]:padded[3]]
+            futures[executor.submit(func, tile, *args, core, padded)] = core
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+
+
+def blur_tiled(image, sigma, tile_size=512, workers=None, use_processes=False, engine=None, method=None):
+    """
+    Same result as blur, on overlapping tiles in parallel.
+
+    Only the separable blur is local and gives the same pixels on a tile as
+    on the whole frame. If the whole frame would be blurred with an FFT (or
+    method is 'fft'), it is done in one FFT (which is multi-threaded itself)
+    instead of tiles. method='separable' always tiles.
+    """
+    image = np.asarray(image)
+    method = method or BlurEngine.choose_method(image.shape, sigma)
+    if method == 'fft':
+        return blur(image, sigma, engine, 'fft')
+    if use_processes:
+        engine = None # every process keeps its own kernel cache
+    blurred = np.empty(image.shape, dtype=np.float32)
+    for core, blurred_core in _map_tiles(_blur_tile, image, kernel_radius(sigma), tile_size, workers,
+                                         use_processes, sigma, method, engine):
+        blurred[core[0]:core[1], core[2]:core[3]] = blurred_core
+    return blurred
+
+
+def find_maxima_tiled(blurred, sigma, threshold, tile_size=512, workers=None, use_processes=False):
+    """Maxima search on overlapping tiles of an already blurred frame."""
+    maxima = [tile_maxima for core, tile_maxima in
+              _map_tiles(_maxima_tile, np.asarray(blurred), window_radius(sigma) + 1, tile_size, workers,
+                         use_processes, sigma, threshold)]
+    return merge_maxima(maxima)
+
+
+def detect_maxima_tiled(image, sigma, noise_tolerance, tile_size=512, workers=None, use_processes=False,
+                        engine=None):
+    """
+    Same result as detect_maxima, computed on overlapping tiles in parallel.
+
+    Tiles overlap by the kernel radius for the blur and by the maxima window
+    for the search, maxima are only kept in the core of the tile they were
+    found in and merged afterwards.
+    """
+    image = np.asarray(image)
+    blurred = blur_tiled(image, sigma, tile_size, workers, use_processes, engine)
+    maxima = find_maxima_tiled(blurred, sigma, absolute_threshold(image, noise_tolerance),
+                               tile_size, workers, use_processes)
+    return blurred, maxima
+
+
+def merge_maxima(maxima_list):
+    """Concatenate maxima of several tiles, drop duplicates and sort in raster order."""
+    if len(maxima_list) == 0:
+        return np.empty((0, 2), dtype=np.intp)
+    return np.unique(np.concatenate(maxima_list), axis=0)
+
+
+# Sub-pixel refinement
+def _patches(image, maxima, r):
+    """(N, k, k) patches around the maxima (shifted inwards at the border) and their pixel coordinates."""
+    k = 2 * r + 1
+    y0 = np.clip(maxima[:, 0] - r, 0, max(image.shape[0] - k, 0))
+    x0 = np.clip(maxima[:, 1] - r, 0, max(image.shape[1] - k, 0))
+    ys = y0[:, np.newaxis, np.newaxis] + np.arange(min(k, image.shape[0]))[np.newaxis, :, np.newaxis]
+    xs = x0[:, np.newaxis, np.newaxis] + np.arange(min(k, image.shape[1]))[np.newaxis, np.newaxis, :]
+    return image[ys, xs].astype(np.float64), ys, xs
+
+
+def quadratic_peaks(image, maxima):
+    """Vertex of a parabola through every maximum and its two neighbours along y and x."""
+    image = np.asarray(image)
+    maxima = np.asarray(maxima, dtype=np.intp).reshape(-1, 2)
+    offsets = []
+    for axis in (0, 1):
+        step = np.zeros(2, dtype=np.intp)
+        step[axis] = 1
+        n = image.shape[axis]
+        lower = np.maximum(maxima - step, 0)
+        upper = np.minimum(maxima + step, np.array(image.shape) - 1)
+        left = image[lower[:, 0], lower[:, 1]].astype(np.float64)
+        center = image[maxima[:, 0], maxima[:, 1]].astype(np.float64)
+        right = image[upper[:, 0], upper[:, 1]].astype(np.float64)
+        denominator = left - 2 * center + right
+        with np.errstate(invalid='ignore', divide='ignore'):
+            offset = np.where(denominator < 0, 0.5 * (left - right) / denominator, 0.0)
+        # no neighbour on one side at the frame border
+        offset[(maxima[:, axis] == 0) | (maxima[:, axis] == n - 1)] = 0.0
+        offsets.append(np.clip(offset, -0.5, 0.5))
+    return maxima + np.stack(offsets, axis=1)
+
+
+def refine_maxima(image, maxima, sigma, iterations=10):
+    """
+    Sub-pixel (y, x) of all maxima by fitting 2D Gaussians to the (blurred) image.
+
+    All peaks are fitted at once: a Levenberg-Marquardt step of the model
+    A exp(-((y-y0)^2 + (x-x0)^2) / (2 s^2)) + B is solved for the stacked
+    patches (radius sigma) as a batch of 5x5 systems. Fits that do not
+    converge to within a pixel of the maximum fall back to the quadratic
+    estimate. Returns an (N, 2) float array.
+    """
+    image = np.asarray(image)
+    maxima = np.asarray(maxima, dtype=np.intp).reshape(-1, 2)
+    estimate = quadratic_peaks(image, maxima)
+    if len(maxima) == 0:
+        return estimate
+    r = window_radius(sigma)
+    patches, ys, xs = _patches(image, maxima, r)
+    n = len(maxima)
+    values = patches.reshape(n, -1)
+    ys = np.broadcast_to(ys, patches.shape).reshape(n, -1).astype(np.float64)
+    xs = np.broadcast_to(xs, patches.shape).reshape(n, -1).astype(np.float64)
+
+    # parameters: amplitude, y0, x0, width, background
+    background = values.min(axis=1)
+    params = np.stack((values.max(axis=1) - background, estimate[:, 0], estimate[:, 1],
+                       np.full(n, float(sigma)), background), axis=1)
+
+    def residuals_and_jacobian(p):
+        dy = ys - p[:, 1, None]
+        dx = xs - p[:, 2, None]
+        s2 = p[:, 3, None]**2
+        g = np.exp(-(dy**2 + dx**2) / (2 * s2))
+        model = p[:, 0, None] * g + p[:, 4, None]
+        jacobian = np.stack((g, p[:, 0, None] * g * dy / s2, p[:, 0, None] * g * dx / s2,
+                             p[:, 0, None] * g * (dy**2 + dx**2) / (s2 * p[:, 3, None]), np.ones_like(g)), axis=2)
+        return values - model, jacobian
+
+    residuals, jacobian = residuals_and_jacobian(params)
+    cost = np.sum(residuals**2, axis=1)
+    damping = np.full(n, 1e-3)
+    for _ in range(iterations):
+        jtj = np.einsum('npi,npj->nij', jacobian, jacobian)
+        jtr = np.einsum('npi,np->ni', jacobian, residuals)
+        diagonal = np.einsum('nii->ni', jtj)
+        system = jtj + (damping[:, None] * diagonal)[:, :, None] * np.eye(5)
+        # singular systems (flat patches) are not updated
+        system += np.eye(5) * 1e-12
+        step = np.linalg.solve(system, jtr[:, :, None])[:, :, 0]
+        trial = params + step
+        trial[:, 3] = np.abs(trial[:, 3])
+        trial_residuals, trial_jacobian = residuals_and_jacobian(trial)
+        trial_cost = np.sum(trial_residuals**2, axis=1)
+        better = trial_cost < cost
+        params[better] = trial[better]
+        residuals[better] = trial_residuals[better]
+        jacobian[better] = trial_jacobian[better]
+        cost[better] = trial_cost[better]
+        damping = np.where(better, damping * 0.1, damping * 10)
+
+    refined = params[:, 1:3]
+    good = (np.all(np.isfinite(params), axis=1) & np.all(np.abs(refined - maxima) <= 1, axis=1) &
+            (params[:, 0] > 0) & (params[:, 3] > 0.2 * sigma) & (params[:, 3] < 5 * sigma))
+    return np.where(good[:, None], refined, estimate)
+
+
+# Coarse-to-fine detection
+def pyramid_factor(sigma, min_sigma=2.0):
+    """Largest power of two by which a frame can be downsampled keeping sigma >= min_sigma."""
+    factor = 1
+    while sigma / (2 * factor) >= min_sigma:
+        factor *= 2
+    return factor
+
+
+def downsample(image, factor, strip_rows=256):
+    """Means of factor x factor blocks, read in strips so that a memory-mapped frame is never loaded whole."""
+    image = np.asarray(image)
+    shape = -(-np.array(image.shape) // factor)
+    coarse = np.empty(shape, dtype=np.float32)
+    step = strip_rows * factor
+    for y0 in range(0, image.shape[0], step):
+        strip = image[y0:y0 + step].astype(np.float32)
+        # partial blocks at the border are padded with their edge values
+        pad = (-strip.shape[0] % factor, -strip.shape[1] % factor)
+        if any(pad):
+            strip = np.pad(strip, ((0, pad[0]), (0, pad[1])), mode='edge')
+        blocks = strip.reshape(strip.shape[0] // factor, factor, strip.shape[1] // factor, factor)
+        coarse[y0 // factor:y0 // factor + blocks.shape[0]] = blocks.mean(axis=(1, 3))
+    return coarse
+
+
+def _window_moments(image, positions, sigma):
+    """
+    Gaussian weighted moments of the windows (radius 3 sigma, minus the
+    window minimum) around the positions: the value of the blurred image and
+    its height above the window minimum, the zeroth moment, the gradient and
+    the Hessian (hyy, hxx, hyx) of the blurred image, the latter two up to a
+    common positive factor.
+    """
+    r = int(np.ceil(3 * sigma))
+    k = 2 * r + 1
+    s2 = float(sigma)**2
+    centers = np.rint(positions).astype(np.intp)
+    y0 = np.clip(centers[:, 0] - r, 0, max(image.shape[0] - k, 0))
+    x0 = np.clip(centers[:, 1] - r, 0, max(image.shape[1] - k, 0))
+    ys = y0[:, np.newaxis, np.newaxis] + np.arange(min(k, image.shape[0]))[np.newaxis, :, np.newaxis]
+    xs = x0[:, np.newaxis, np.newaxis] + np.arange(min(k, image.shape[1]))[np.newaxis, np.newaxis, :]
+    windows = image[ys, xs].astype(np.float64)
+    minima = windows.min(axis=(1, 2))
+    windows -= minima[:, np.newaxis, np.newaxis]
+    dy = ys - positions[:, 0, np.newaxis, np.newaxis]
+    dx = xs - positions[:, 1, np.newaxis, np.newaxis]
+    gaussian = np.exp(-(dy**2 + dx**2) / (2 * s2))
+    weights = gaussian * windows
+    m0 = weights.sum(axis=(1, 2))
+    m1 = np.stack((np.sum(weights * dy, axis=(1, 2)), np.sum(weights * dx, axis=(1, 2))), axis=1)
+    myy, mxx, myx = (np.sum(weights * dy * dy, axis=(1, 2)), np.sum(weights * dx * dx, axis=(1, 2)),
+                     np.sum(weights * dy * dx, axis=(1, 2)))
+    # gradient m1 / s2 and Hessian (m2 / s2 - m0) / s2 of the blurred image, up to a common factor
+    heights = m0 / gaussian.sum(axis=(1, 2))
+    return heights + minima, heights, m0, m1, (myy / s2 - m0, mxx / s2 - m0, myx / s2)
+
+
+def mean_shift_peaks(image, starts, sigma, iterations=10, tolerance=0.01, chunk_size=1024):
+    """
+    Maxima of the blurred image (Gaussian sigma) next to the start positions,
+    computed from windows of the unblurred image only.
+
+    The Gaussian weighted moments of a window (radius 3 sigma, minus the
+    window minimum) around a position give the gradient and Hessian of the
+    blurred image there. Positions take Newton steps where the blurred image
+    is concave and mean shift steps (to the weighted centroid) elsewhere.
+    Returns the (N, 2) float positions, the Gaussian weighted intensity
+    above the window minimum (the local height of the blurred image) of every
+    peak and whether the blurred image is concave there.
+    """
+    image = np.asarray(image)
+    positions = np.asarray(starts, dtype=np.float64).reshape(-1, 2).copy()
+    heights = np.zeros(len(positions))
+    concave = np.zeros(len(positions), dtype=bool)
+    for c in range(0, len(positions), chunk_size):
+        p = positions[c:c + chunk_size]
+        active = np.ones(len(p), dtype=bool)
+        for _ in range(iterations):
+            indices = np.flatnonzero(active)
+            _, heights[c + indices], m0, m1, (hyy, hxx, hyx) = _window_moments(image, p[indices], sigma)
+            determinant = hyy * hxx - hyx**2
+            concave[c + indices] = (determinant > 0) & (hyy < 0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                newton = -np.stack((hxx * m1[:, 0] - hyx * m1[:, 1], hyy * m1[:, 1] - hyx * m1[:, 0]),
+                                   axis=1) / determinant[:, None]
+                shift = np.where(concave[c + indices, None], newton, m1 / m0[:, None])
+            shift[~np.all(np.isfinite(shift), axis=1)] = 0
+            shift = np.clip(shift, -sigma, sigma)
+            p[indices] = np.clip(p[indices] + shift, 0, np.array(image.shape) - 1)
+            active[indices[np.all(np.abs(shift) < tolerance, axis=1)]] = False
+            if not active.any():
+                break
+        positions[c:c + chunk_size] = p
+    return positions, heights, concave
+
+
+def highest_in_window(image, positions, sigma):
+    """
+    True for the positions where the blurred image is not lower than at 8
+    points around them at the radius of the maxima window (find_maxima), so
+    not for points on a slope where the mean shift stopped in a flat area.
+    """
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    angles = np.arange(8) * np.pi / 4
+    ring = window_radius(sigma) * np.stack((np.sin(angles), np.cos(angles)), axis=1)
+    around = np.clip(positions[:, np.newaxis] + ring, 0, np.array(np.shape(image)) - 1).reshape(-1, 2)
+    values = _window_moments(image, positions, sigma)[0]
+    values_around = _window_moments(image, around, sigma)[0].reshape(-1, 8)
+    return values >= values_around.max(axis=1)
+
+
+def border_peaks(image, starts, sigma, engine=None):
+    """
+    Maxima of the blurred image next to the start positions, by steepest
+    ascent on blurred windows at full resolution.
+
+    For peaks at the frame border, where the windows of mean_shift_peaks are
+    cut off. Every window is blurred like the whole frame (it reaches the
+    kernel radius beyond the search area inside the frame), so the peaks are
+    those of detect_maxima. Returns the (N, 2) float positions, the heights as
+    mean_shift_peaks does and whether a peak is the largest value within the
+    maxima window (as find_maxima requires).
+    """
+    image = np.asarray(image)
+    shape = np.array(image.shape)
+    kr = kernel_radius(sigma)
+    margin = 2 * window_radius(sigma) + kr
+    r = int(np.ceil(3 * sigma))
+    w = window_radius(sigma)
+    positions = np.empty((len(starts), 2))
+    heights = np.empty(len(starts))
+    highest = np.empty(len(starts), dtype=bool)
+    for i, start in enumerate(np.rint(starts).astype(np.intp).reshape(-1, 2)):
+        low = np.maximum(start - margin, 0)
+        high = np.minimum(start + margin + 1, shape)
+        window = image[low[0]:high[0], low[1]:high[1]]
+        # the frames of a sweep differ in size at the border, the separable blur needs no kernel spectra
+        blurred = blur(window, sigma, engine, 'separable')
+        # within the kernel radius of a side inside the frame the blur differs from the whole frame's
+        inner_low = np.where(low > 0, kr, 0)
+        inner_high = np.where(high < shape, np.array(blurred.shape) - kr, blurred.shape)
+        p = start - low
+        while True:
+            y0, x0 = np.maximum(p - 1, inner_low)
+            y1, x1 = np.minimum(p + 2, inner_high)
+            neighbourhood = blurred[y0:y1, x0:x1]
+            step = np.array(np.unravel_index(np.argmax(neighbourhood), neighbourhood.shape)) + (y0, x0)
+            if blurred[tuple(step)] <= blurred[tuple(p)]:
+                break
+            p = step
+        positions[i] = quadratic_peaks(blurred, p[np.newaxis])[0] + low
+        lo, hi = np.maximum(p - r, 0), np.minimum(p + r + 1, window.shape)
+        heights[i] = blurred[tuple(p)] - window[lo[0]:hi[0], lo[1]:hi[1]].min()
+        lo, hi = np.maximum(p - w, 0), np.minimum(p + w + 1, blurred.shape)
+        highest[i] = blurred[tuple(p)] >= blurred[lo[0]:hi[0], lo[1]:hi[1]].max()
+    return positions, heights, highest
+
+
+def detect_maxima_pyramid(image, sigma, noise_tolerance, factor=None, engine=None):
+    """
+    Sub-pixel maxima of a large frame, found coarse-to-fine.
+
+    Candidates are the maxima of the frame downsampled by factor (by default
+    the largest power of two keeping the scaled sigma >= 2 px) and blurred
+    with the correspondingly smaller sigma. They are refined by mean shift in
+    small windows at full resolution, so apart from one pass of downsampling
+    time and memory scale with the number of atoms, not pixels. Within 3 sigma
+    of the frame border the mean shift windows are cut off, such candidates
+    are refined on blurred windows instead (border_peaks). Peaks that are not
+    the highest within the maxima window are dropped, e.g. where the mean
+    shift stopped in a flat area.
+    Returns the (N, 2) float positions and the peak heights (see
+    mean_shift_peaks).
+    """
+    image = np.asarray(image)
+    factor = factor or pyramid_factor(sigma)
+    coarse = downsample(image, factor)
+    # the block means already blur by a box of width factor (variance factor**2 / 12)
+    coarse_sigma = np.sqrt(max(sigma**2 - factor**2 / 12, (sigma / 2)**2)) / factor
+    blurred = blur(coarse, coarse_sigma, engine)
+    candidates = find_maxima(blurred, coarse_sigma, absolute_threshold(image, noise_tolerance))
+    if len(candidates) == 0:
+        return np.empty((0, 2)), np.empty(0)
+    starts = np.minimum(candidates * factor + (factor - 1) / 2, np.array(image.shape) - 1)
+    positions, heights, concave = mean_shift_peaks(image, starts, sigma)
+    shape = np.array(image.shape)
+    at_border = np.zeros(len(starts), dtype=bool)
+    for p in (starts, positions):
+        at_border |= np.any((p < 3 * sigma) | (p > shape - 1 - 3 * sigma), axis=1)
+    keep = concave & ~at_border
+    keep[keep] = highest_in_window(image, positions[keep], sigma)
+    if at_border.any():
+        positions[at_border], heights[at_border], keep[at_border] = border_peaks(image, starts[at_border],
+                                                                                 sigma, engine)
+    positions, heights = positions[keep], heights[keep]
+    # candidates that converged to the same peak
+    duplicates = cKDTree(positions).query_pairs(max(1.0, sigma / 4), output_type='ndarray')
+    keep = np.ones(len(positions), dtype=bool)
+    keep[duplicates.max(axis=1) if len(duplicates) else []] = False
+    order = np.lexsort((positions[keep, 1], positions[keep, 0]))
+    return positions[keep][order], heights[keep][order]
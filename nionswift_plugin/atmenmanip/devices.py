@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Scan and feedback device interfaces used by the Auto-Manipulator.
+
+A scan device delivers frames and takes the probe position, a feedback device
+reports what happened under the probe: "j" (jump), "d" (drift) or "to"
+(timeout). The Swift/Keithley implementations wrap the hardware, the
+simulator module provides offline replacements and jump_detector one that
+looks at the frames instead.
+"""
+
+# hardware classes
+try:
+    from keithley_multimeter import keithley2000
+except ImportError:
+    keithley2000 = None
+
+
+class ScanDevice:
+
+    def record(self):
+        """Record one frame, returns a list of xdata (one per channel)."""
+        raise NotImplementedError()
+
+    def grab_next_to_finish(self):
+        """Next frame of a running acquisition, returns a list of xdata."""
+        raise NotImplementedError()
+
+    def start_streaming(self):
+        """Make sure frames are acquired continuously for grab_next_to_finish."""
+        pass
+
+    def stop_streaming(self):
+        """Return to the state before start_streaming."""
+        pass
+
+    @property
+    def probe_position(self):
+        raise NotImplementedError()
+
+    def set_probe_target(self, y, x):
+        """Move the probe to the pixel (y, x) of the frames."""
+        raise NotImplementedError()
+
+
+class FeedbackDevice:
+
+    def set_sites(self, atom, target, xdata_list=None):
+        """Site of the atom and the site the probe pulls it to, with the last frame before the step."""
+        pass
+
+    def waitforjump(self, timeout):
+        """Block until something happens under the probe, returns "j", "d" or "to"."""
+        raise NotImplementedError()
+
+    def cancel(self):
+        """Return from a running waitforjump as soon as possible."""
+        pass
+
+
+class SwiftScanDevice(ScanDevice):
+
+    def __init__(self, api, sim_mode=True):
+        if sim_mode:
+            hwsrc = "usim_scan_device"
+        else:
+            hwsrc = "scan_controller"
+        self.superscan = api.get_hardware_source_by_id(hwsrc, "1")
+        self._was_playing = None
+
+    def record(self):
+        return self.superscan.record()
+
+    def grab_next_to_finish(self):
+        return self.superscan.grab_next_to_finish()
+
+    def start_streaming(self):
+        # without a running view grab_next_to_finish waits for a frame that never comes
+        self._was_playing = self.superscan.is_playing
+        if not self._was_playing:
+            self.superscan.start_playing()
+
+    def stop_streaming(self):
+        if self._was_playing is False:
+            self.superscan.stop_playing()
+        self._was_playing = None
+
+    @property
+    def probe_position(self):
+        return self.superscan._hardware_source.probe_position
+
+    def set_probe_target(self, y, x):
+        # The probe follows the 'Probe position' point region in Swift.
+        #   !!! Might need this:
+        # self.superscan._hardware_source.probe_position = probe_position
+        pass
+
+
+class KeithleyFeedback(FeedbackDevice):
+
+    def __init__(self):
+        if keithley2000 is None:
+            raise ImportError("keithley_multimeter is not installed")
+        self.keithley = keithley2000.KEITHLEY2000()
+
+    def waitforjump(self, timeout):
+        return self.keithley.waitforjump(timeout)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Drift estimation for the Auto-Manipulator.
+
+Every frame is registered against a reference frame by FFT phase correlation.
+The correlation peak is located with sub-pixel precision by a parabola fit,
+optionally refined by the sub-pixel displacement of a subset of lattice sites
+between the reference and the frame. The lattice coordinates are then moved
+in place, so the paths stay valid without detecting the lattice again.
+"""
+
+# standard libraries
+import numpy as np
+
+# third party libraries
+from scipy import fft as sp_fft
+
+# local libraries
+from . import tracking
+
+
+def hann_window(shape):
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1])).astype(np.float32)
+
+
+def parabola_peak(values):
+    """Offset of the vertex of a parabola through three values, within [-0.5, 0.5]."""
+    left, center, right = values
+    denominator = left - 2 * center + right
+    if denominator >= 0:
+        return 0.0
+    return float(np.clip(0.5 * (left - right) / denominator, -0.5, 0.5))
+
+
+def lowpass_spectrum(shape, sigma):
+    """rfft2 of a normalised Gaussian, suppresses the shot noise in the phase correlation."""
+    fy = sp_fft.fftfreq(shape[0])[:, np.newaxis]
+    fx = sp_fft.rfftfreq(shape[1])[np.newaxis, :]
+    return np.exp(-2 * np.pi**2 * sigma**2 * (fy**2 + fx**2)).astype(np.float32)
+
+
+def phase_correlation(reference_spectrum, spectrum, shape, lowpass=None):
+    """
+    Shift (dy, dx) of an image relative to a reference, given their rfft2 spectra.
+
+    Returns the shift and the height of the correlation peak, which compares
+    the quality of matches made with the same lowpass.
+    """
+    cross_power = reference_spectrum.conj() * spectrum
+    cross_power /= np.abs(cross_power) + 1e-12
+    if lowpass is not None:
+        cross_power *= lowpass
+    correlation = sp_fft.irfft2(cross_power, s=shape, workers=-1)
+    peak = np.unravel_index(np.argmax(correlation), shape)
+    shift = []
+    for axis, (p, n) in enumerate(zip(peak, shape)):
+        neighbours = [list(peak), list(peak), list(peak)]
+        neighbours[0][axis] = (p - 1) % n
+        neighbours[2][axis] = (p + 1) % n
+        offset = parabola_peak([correlation[tuple(q)] for q in neighbours])
+        # shifts beyond half the frame wrap around
+        shift.append(((p + n // 2) % n) - n // 2 + offset)
+    return np.array(shift), float(correlation[peak])
+
+
+class DriftTracker:
+    """
+    Registers frames against a reference and shifts the lattice accordingly.
+
+    The reference is the frame the lattice coordinates belong to, given to
+    set_reference() (e.g. the frame the lattice was detected in) or else the
+    first frame registered. shift is the total drift that was applied to the
+    lattice since then.
+    """
+
+    def __init__(self, lattice, sigma=None, refine=True, number_refine_sites=64, lowpass_sigma=2.0):
+        self.lattice = lattice
+        self.sigma = sigma
+        self.lowpass_sigma = lowpass_sigma
+        self.refine = refine
+        self.number_refine_sites = number_refine_sites
+        self.reference_spectrum = None
+        self.reference_positions = None
+        self.shape = None
+        self.window = None
+        self.lowpass = None
+        self._tracker = None
+        self.shift = np.zeros(2)
+
+    def spectrum(self, image):
+        image = np.asarray(image, dtype=np.float32)
+        if image.shape != self.shape:
+            self.shape = image.shape
+            self.window = hann_window(image.shape)
+            self.lowpass = lowpass_spectrum(image.shape, self.lowpass_sigma) if self.lowpass_sigma else None
+        return sp_fft.rfft2((image - image.mean()) * self.window, workers=-1)
+
+    def set_reference(self, image, shift=None):
+        """image is the reference, shift the drift already applied to the lattice since it was taken."""
+        self.shape = None
+        self.reference_spectrum = self.spectrum(image)
+        self.shift = np.zeros(2) if shift is None else np.array(shift, dtype=float)
+        self.reference_positions = None
+        if self.refine and len(self.lattice):
+            # the sites are located the same way in the reference and in the frames,
+            # so that the bias of the peak positions cancels
+            expected = self.lattice.coords[self.refine_sites()] - self.shift.astype(np.float32)
+            self.reference_positions, _ = self.locate(image, expected)
+
+    def refine_sites(self):
+        """Well separated, fully bonded sites used for the sub-pixel refinement."""
+        degrees = self.lattice.degrees()
+        # the most common coordination, a few sites with extra bonds are no lattice
+        bulk = np.flatnonzero(degrees == np.bincount(degrees).argmax()) if len(degrees) else degrees
+        step = max(1, len(bulk) // self.number_refine_sites)
+        return bulk[::step][:self.number_refine_sites]
+
+    def locate(self, image, expected):
+        if self._tracker is None:
+            self._tracker = tracking.SiteTracker(self.lattice, sigma=self.sigma)
+        return tracking.relocate(image, expected, self._tracker.radius, self._tracker.sigma, subpixel=True)
+
+    def register(self, image):
+        """Total shift of image relative to the reference (the first frame becomes the reference)."""
+        image = np.asarray(image)
+        if self.reference_spectrum is None or image.shape != self.shape:
+            self.set_reference(image)
+            return np.zeros(2), 1.0
+        shift, quality = phase_correlation(self.reference_spectrum, self.spectrum(image), self.shape,
+                                            self.lowpass)
+        if self.reference_positions is not None:
+            expected = self.reference_positions + shift
+            positions, _ = self.locate(image, expected)
+            residuals = positions - expected
+            # sites that were not found (e.g. at the frame border) are ignored
+            good = np.sum(residuals**2, axis=1) < (self._tracker.radius / 2)**2
+            if np.sum(good) >= 3:
+                shift += np.median(residuals[good], axis=0)
+        return shift, quality
+
+    def update(self, image):
+        """Register image and move all lattice sites by the drift since the last update."""
+        shift, quality = self.register(image)
+        self.lattice.shift_sites(shift - self.shift)
+        self.shift = shift
+        return shift, quality
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight timing of the plug-in's hot paths.
+
+Code is wrapped in named spans (a context manager or a decorator), whose
+durations are aggregated per name (count, total, min, max) and kept as events
+for a Chrome trace (chrome://tracing, Perfetto). Counters count things like
+regions added or frames processed. Everything goes to the module-level
+instance, so that all modules report to the same summary:
+
+    with instrumentation.span('blur'):
+        ...
+
+    @instrumentation.timed('path finding')
+    def plan(...):
+        ...
+
+    instrumentation.count('frames processed')
+    logging.info(instrumentation.summary())
+"""
+
+# standard libraries
+import os
+import json
+import time
+import functools
+import threading
+import contextlib
+import collections
+
+
+class Span:
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.start = time.perf_counter()
+        self.duration = None
+
+
+class Instrumentation:
+    """Span statistics, counters and the last max_events spans as trace events."""
+
+    def __init__(self, enabled=True, max_events=100000):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self.stats = dict() # name -> [count, total, min, max] in seconds
+        self.counters = collections.Counter()
+        self.events = collections.deque(maxlen=max_events)
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """Time the enclosed block, the yielded Span holds its duration afterwards."""
+        span = Span(name, args)
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - span.start
+            if self.enabled:
+                self._add(span)
+
+    def _add(self, span):
+        with self._lock:
+            stats = self.stats.get(span.name)
+            if stats is None:
+                self.stats[span.name] = [1, span.duration, span.duration, span.duration]
+            else:
+                stats[0] += 1
+                stats[1] += span.duration
+                stats[2] = min(stats[2], span.duration)
+                stats[3] = max(stats[3], span.duration)
+            self.events.append(('X', span.name, span.start - self._origin, span.duration,
+                                threading.get_ident(), span.args))
+
+    def timed(self, name=None):
+        """Decorator, every call is a span (named after the function by default)."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name or func.__qualname__):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] += n
+            self.events.append(('C', name, time.perf_counter() - self._origin, None, threading.get_ident(),
+                                {name: self.counters[name]}))
+
+    def reset(self):
+        with self._lock:
+            self.stats.clear()
+            self.counters.clear()
+            self.events.clear()
+
+    def summary(self):
+        """Table of all spans (sorted by total time) and counters."""
+        with self._lock:
+            stats = sorted(self.stats.items(), key=lambda item: -item[1][1])
+            counters = sorted(self.counters.items())
+        lines = ["{:<24s} {:>7s} {:>10s} {:>10s} {:>10s} {:>10s}".format(
+                 'span', 'count', 'total ms', 'mean ms', 'min ms', 'max ms')]
+        for name, (number, total, minimum, maximum) in stats:
+            lines.append("{:<24s} {:>7d} {:>10.1f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                         name, number, total*1e3, total/number*1e3, minimum*1e3, maximum*1e3))
+        for name, value in counters:
+            lines.append("{:<24s} {:>7d}".format(name, value))
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path):
+        """Write the recorded spans and counters in the Chrome trace event format."""
+        pid = os.getpid()
+        with self._lock:
+            events = list(self.events)
+        trace = []
+        for phase, name, start, duration, tid, args in events:
+            event = dict(name=name, ph=phase, ts=start*1e6, pid=pid, tid=tid, args=args)
+            if duration is not None:
+                event['dur'] = duration*1e6
+            trace.append(event)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(dict(traceEvents=trace, displayTimeUnit='ms'), f, default=str)
+
+
+instruments = Instrumentation()
+span = instruments.span
+timed = instruments.timed
+count = instruments.count
+summary = instruments.summary
+export_chrome_trace = instruments.export_chrome_trace
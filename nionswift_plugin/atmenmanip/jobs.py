@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Job scheduler of the plug-in.
+
+Everything started from the panel runs as a job in one bounded thread pool,
+instead of in a thread per button. Every job has a slot (e.g. 'maxima',
+'bonds', 'paths'). A job submitted to a busy slot either supersedes the job
+in it (which is cancelled, e.g. when the parameters changed) or queues behind
+it, and in both cases only starts once the old job has stopped, so two jobs
+of a slot never run at the same time.
+
+Jobs can depend on other jobs (maxima -> bonds -> paths) and are only handed
+to the pool once those finished, so no worker is blocked waiting. If a
+dependency failed or was cancelled, the dependent job is cancelled too,
+unless the dependency was superseded: then it waits for its successor.
+
+Cancellation is cooperative. Job functions call checkpoint() (the pipeline
+does so before every stage it computes), which raises Cancelled once the job
+was cancelled and reports progress to the panel on the way:
+
+    scheduler = jobs.Scheduler(max_workers=2, on_progress=show)
+    scheduler.submit('maxima', find_maxima)
+
+    def find_maxima():
+        jobs.checkpoint("Blurring")
+        ...
+"""
+
+# standard libraries
+import os
+import logging
+import threading
+import concurrent.futures
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+
+_local = threading.local()
+
+
+class Cancelled(Exception):
+    pass
+
+
+def current():
+    """The job running in this thread (None outside of jobs)."""
+    return getattr(_local, 'job', None)
+
+
+def checkpoint(message=None, fraction=None):
+    """Report progress of the current job, raises Cancelled if it was cancelled."""
+    job = current()
+    if job is not None:
+        job.report(message, fraction)
+
+
+class Job:
+
+    def __init__(self, scheduler, slot, func, args, kwargs):
+        self.scheduler = scheduler
+        self.slot = slot
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.state = QUEUED
+        self.message = None
+        self.fraction = None
+        self.future = concurrent.futures.Future()
+        self.successor = None # job that superseded this one
+        self._cancel_event = threading.Event()
+        self._on_cancel = []
+        self._waiting = set()
+        self._finished = False
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Job {} {}>".format(self.slot, self.state)
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    @property
+    def cancel_event(self):
+        """Set when the job is cancelled, e.g. for code that already takes a stop event."""
+        return self._cancel_event
+
+    def done(self):
+        return self.future.done()
+
+    def add_cancel_callback(self, callback):
+        """callback() is called once if the job is cancelled, e.g. to interrupt a blocking wait."""
+        with self._lock:
+            if not self.cancelled:
+                self._on_cancel.append(callback)
+                return
+        callback()
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled or self.done():
+                return
+            self._cancel_event.set()
+            callbacks, self._on_cancel = self._on_cancel, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logging.exception("Cancel callback of {} failed".format(self))
+        # not started yet: finished right away
+        if self.state == QUEUED:
+            self.scheduler._finish(self, CANCELLED)
+
+    def report(self, message=None, fraction=None):
+        if self.cancelled:
+            raise Cancelled()
+        if message is not None:
+            self.message = message
+        self.fraction = fraction
+        self.scheduler._progress(self)
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+
+class Scheduler:
+    """
+    Bounded pool of jobs with slots, dependencies and cooperative cancellation.
+
+    on_progress(job) is called (from the worker threads) whenever a job
+    changes state or reports progress.
+    """
+
+    def __init__(self, max_workers=None, on_progress=None):
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.on_progress = on_progress
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers,
+                                                               thread_name_prefix='atmenmanip')
+        self._slots = dict() # slot -> last submitted job
+        self._lock = threading.RLock()
+
+    def submit(self, slot, func, *args, depends=(), supersede=True, **kwargs):
+        """
+        Run func(*args, **kwargs) as a job in slot, after the jobs in depends
+        (None entries are ignored). A job still in the slot is cancelled if
+        supersede, otherwise the new job queues behind it.
+        """
+        job = Job(self, slot, func, args, kwargs)
+        with self._lock:
+            previous = self._slots.get(slot)
+            self._slots[slot] = job
+            waits = [(d, True) for d in depends if d is not None]
+            if previous is not None and not previous.done():
+                waits.append((previous, False))
+                if supersede:
+                    previous.successor = job
+                    previous.cancel()
+            job._waiting = set(id(d) for d, _ in waits)
+        self._progress(job)
+        if not waits:
+            self._start(job)
+        for dependency, propagate in waits:
+            self._after(job, id(dependency), dependency, propagate)
+        return job
+
+    def _after(self, job, key, dependency, propagate):
+        def finished(future):
+            if propagate and dependency.state != DONE:
+                # a superseded dependency is replaced by the job that superseded it
+                if dependency.state == CANCELLED and dependency.successor is not None:
+                    self._after(job, key, dependency.successor, propagate)
+                    return
+                job.cancel()
+                return
+            with job._lock:
+                job._waiting.discard(key)
+                ready = not job._waiting
+            if ready:
+                self._start(job)
+        dependency.future.add_done_callback(finished)
+
+    def _start(self, job):
+        if job.cancelled:
+            return
+        try:
+            self._executor.submit(self._run, job)
+        except RuntimeError: # shut down
+            self._finish(job, CANCELLED)
+
+    def _run(self, job):
+        with job._lock:
+            if job.cancelled:
+                return
+            job.state = RUNNING
+        self._progress(job)
+        _local.job = job
+        try:
+            value = job.func(*job.args, **job.kwargs)
+        except Cancelled:
+            self._finish(job, CANCELLED)
+        except Exception as e:
+            logging.exception("Job {} failed".format(job.slot))
+            self._finish(job, FAILED, exception=e)
+        else:
+            self._finish(job, CANCELLED if job.cancelled else DONE, value=value)
+        finally:
+            _local.job = None
+
+    def _finish(self, job, state, value=None, exception=None):
+        with job._lock:
+            if job._finished:
+                return
+            job._finished = True
+            job.state = state
+        self._progress(job)
+        if exception is not None:
+            job.future.set_exception(exception)
+        elif state == CANCELLED:
+            job.future.set_exception(Cancelled())
+        else:
+            job.future.set_result(value)
+
+    def _progress(self, job):
+        if self.on_progress is not None:
+            try:
+                self.on_progress(job)
+            except Exception:
+                logging.exception("Progress callback failed")
+
+    def active(self, slot):
+        """The unfinished job of slot, or None."""
+        with self._lock:
+            job = self._slots.get(slot)
+        return job if job is not None and not job.done() else None
+
+    def is_busy(self, slot):
+        return self.active(slot) is not None
+
+    def cancel(self, slot=None):
+        """Cancel the job of slot, or all jobs."""
+        with self._lock:
+            slots = [slot] if slot is not None else list(self._slots)
+            cancelled = [self._slots[s] for s in slots if s in self._slots]
+        for job in cancelled:
+            job.cancel()
+
+    def wait(self, slot=None, timeout=None):
+        """Wait until the job of slot (or all jobs) finished, True if they did in time."""
+        with self._lock:
+            waiting = [self._slots[slot]] if slot is not None and slot in self._slots else \
+                      list(self._slots.values()) if slot is None else []
+        _, not_done = concurrent.futures.wait([job.future for job in waiting], timeout)
+        return not not_done
+
+    def shutdown(self, wait=False):
+        self.cancel()
+        self._executor.shutdown(wait=wait)
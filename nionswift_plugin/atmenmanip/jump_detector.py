@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Jump detection in the frames, as a fast alternative to the Keithley.
+
+While the probe pulls an atom, every new frame is compared with the frame
+taken before the step, in small windows around the atom's site and its
+neighbours (one of which is the target). The (brighter) dopant leaving its
+site makes that window darker and a neighbour's brighter. Both changes are
+normalised by the contrast of the dopant against carbon in the first frame,
+so the evidence is ~1 for a complete jump and ~0 without one, independent of
+dose and detector gain. If the sites themselves moved together by more than
+max_drift, the frame drifted.
+"""
+
+# standard libraries
+import time
+import threading
+import numpy as np
+
+# local libraries
+from . import devices
+from . import tracking
+
+
+class ImageJumpDetector(devices.FeedbackDevice):
+    """
+    Feedback device reporting "j" as soon as the evidence of a jump in a new
+    frame exceeds jump_threshold, "d" for a drift of more than max_drift
+    pixels and "to" if neither happened within the timeout.
+
+    Frames come from grab (a function returning a list of xdata, by default
+    scan_device.grab_next_to_finish). radius is the window radius around the
+    sites, less than half a bond length. If grab returns no frame, it is
+    asked again after min_retry_delay seconds, doubled up to max_retry_delay.
+    """
+
+    min_retry_delay = 0.005
+    max_retry_delay = 0.2
+
+    def __init__(self, scan_device, lattice, radius=None, jump_threshold=0.5, max_drift=None, grab=None):
+        self.grab = grab if grab is not None else scan_device.grab_next_to_finish
+        self.lattice = lattice
+        self.locator = tracking.SiteTracker(lattice, radius=radius)
+        self.radius = self.locator.radius
+        self.jump_threshold = jump_threshold
+        self.max_drift = max_drift if max_drift is not None else self.radius / 2
+        self.sites = None # atom's site first, then its neighbours
+        self.reference = None # window intensities of the sites before the step
+        self.evidence = 0.0
+        self.last_frame = None # frame of the last "j" or "d"
+        self._cancel = threading.Event()
+
+    def set_sites(self, atom, target, xdata_list=None):
+        self.sites = np.concatenate(([atom], self.lattice.neighbours(atom))).astype(np.int32)
+        self.reference = None
+        self.last_frame = None
+        if xdata_list:
+            self.reference = self.intensities(xdata_list[0].data)
+
+    def intensities(self, image):
+        """Gaussian weighted mean intensity of the window of every site, all at once."""
+        image = np.asarray(image)
+        centers = self.lattice.coords[self.sites].astype(float)
+        r = int(np.ceil(self.radius))
+        windows, ys, xs = tracking.cut_windows(image, centers, r)
+        distances2 = (ys - centers[:, 0, np.newaxis, np.newaxis])**2 + (xs - centers[:, 1, np.newaxis, np.newaxis])**2
+        weights = np.exp(-distances2 / (2 * (self.radius / 2)**2))
+        return np.sum(windows * weights, axis=(1, 2)) / np.sum(weights, axis=(1, 2))
+
+    def drift(self, image):
+        """Common shift of the sites in image (median of their re-located positions)."""
+        expected = self.lattice.coords[self.sites]
+        positions, _ = tracking.relocate(image, expected, self.radius, self.locator.sigma)
+        return np.median(positions - expected, axis=0)
+
+    def check(self, image):
+        """"j", "d" or None for a new frame (the first one becomes the reference)."""
+        current = self.intensities(image)
+        if self.reference is None:
+            self.reference = current
+            return None
+        if np.linalg.norm(self.drift(image)) > self.max_drift:
+            return "d"
+        reference = self.reference
+        # dopant against carbon before the step, normalises the changes
+        contrast = max(reference[0] - np.median(reference[1:]), 1e-6 * abs(reference[0]) + 1e-12)
+        fall = (reference[0] - current[0]) / contrast
+        rise = (current[1:] - reference[1:]) / contrast
+        self.evidence = 0.5 * (fall + rise.max()) if len(rise) else fall
+        return "j" if self.evidence > self.jump_threshold else None
+
+    def waitforjump(self, timeout):
+        if self.sites is None:
+            raise RuntimeError("set_sites() has to be called before waitforjump()")
+        self._cancel.clear()
+        deadline = time.monotonic() + timeout
+        delay = self.min_retry_delay
+        while time.monotonic() < deadline and not self._cancel.is_set():
+            xdata_list = self.grab()
+            if not xdata_list:
+                # no frame yet, wait before asking again (cancel wakes up), at most until the deadline
+                self._cancel.wait(min(delay, max(deadline - time.monotonic(), 0)))
+                delay = min(2 * delay, self.max_retry_delay)
+                continue
+            delay = self.min_retry_delay
+            feedback = self.check(xdata_list[0].data)
+            if feedback is not None:
+                self.last_frame = xdata_list
+                return feedback
+        return "to"
+
+    def cancel(self):
+        self._cancel.set()
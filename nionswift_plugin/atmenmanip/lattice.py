@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Array based construction of the site/bond lattice.
+
+Sites are given as an (N, 2) array of (y, x) pixel coordinates, bonds are
+returned as an (M, 2) array of site indices with i < j.
+"""
+
+# standard libraries
+import numpy as np
+
+# third party libraries
+from scipy.spatial import cKDTree
+
+
+def find_bonds(coords, maxlength):
+    """Return all pairs of sites closer than maxlength as an (M, 2) index array."""
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    if len(coords) < 2:
+        return np.empty((0, 2), dtype=np.int32)
+    pairs = cKDTree(coords).query_pairs(maxlength, output_type='ndarray')
+    pairs = pairs.astype(np.int32, copy=False)
+    # deterministic order, independent of the tree layout
+    return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+
+def shortened_segments(coords, bonds, drawn_fraction):
+    """Start and end points of the bonds shortened to drawn_fraction of their length."""
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    p1 = coords[bonds[:, 0]]
+    p2 = coords[bonds[:, 1]]
+    w = (1 - drawn_fraction) / 2 # weight of the other position
+    starts = p1*(1-w) + p2*w
+    ends = p1*w + p2*(1-w)
+    return starts, ends
+
+
+def bonds_to_csr(n_sites, bonds):
+    """Symmetric CSR adjacency (indptr, indices) of an (M, 2) bond index array."""
+    bonds = np.asarray(bonds, dtype=np.int32).reshape(-1, 2)
+    heads = np.concatenate((bonds[:, 0], bonds[:, 1]))
+    tails = np.concatenate((bonds[:, 1], bonds[:, 0]))
+    order = np.lexsort((tails, heads))
+    indices = np.ascontiguousarray(tails[order], dtype=np.int32)
+    indptr = np.zeros(n_sites + 1, dtype=np.int32)
+    np.cumsum(np.bincount(heads, minlength=n_sites), out=indptr[1:])
+    return indptr, indices
+
+
+class Lattice:
+    """
+    Compact store of sites, bonds, sources, targets and paths.
+
+    Sites are rows of the float32 array coords ((y, x) in pixels), everything
+    else refers to them by integer index. Bonds are kept both as an (M, 2)
+    array and as CSR adjacency (indptr, indices). Graphics in Swift are mapped
+    to sites through their uuid.
+    """
+
+    def __init__(self, coords, bonds, csr=None):
+        self.coords = np.ascontiguousarray(np.reshape(coords, (-1, 2)), dtype=np.float32)
+        self.bonds = np.ascontiguousarray(np.reshape(bonds, (-1, 2)), dtype=np.int32)
+        # csr: (indptr, indices) of the bonds if already known, e.g. from a saved session
+        self.indptr, self.indices = csr if csr is not None else bonds_to_csr(len(self.coords), self.bonds)
+        self.sources = np.empty(0, dtype=np.int32)
+        self.targets = np.empty(0, dtype=np.int32)
+        self.paths = [] # one site index array per path, starting at its source
+        self.graphics = dict() # graphic uuid -> site index
+        self.index = None # lattice_index.LatticeIndex of the bonds, set once they are final
+        self._tree = None
+
+    @classmethod
+    def from_maxima(cls, maxima, maxlength):
+        coords = np.asarray(maxima, dtype=float).reshape(-1, 2)
+        return cls(coords, find_bonds(coords, maxlength))
+
+    def __len__(self):
+        return len(self.coords)
+
+    @property
+    def number_bonds(self):
+        return len(self.bonds)
+
+    def neighbours(self, idx):
+        return self.indices[self.indptr[idx]:self.indptr[idx+1]]
+
+    def degrees(self):
+        return np.diff(self.indptr)
+
+    def nearest_site(self, y, x):
+        if self._tree is None:
+            self._tree = cKDTree(self.coords)
+        return int(self._tree.query((y, x))[1])
+
+    def move_sites(self, indices, positions):
+        self.coords[indices] = positions
+        self._tree = None
+
+    def shift_sites(self, offset):
+        self.coords += np.asarray(offset, dtype=np.float32)
+        self._tree = None
+
+    def add_sources(self, indices):
+        self.sources = np.concatenate((self.sources, np.asarray(indices, dtype=np.int32).ravel()))
+
+    def add_targets(self, indices):
+        self.targets = np.concatenate((self.targets, np.asarray(indices, dtype=np.int32).ravel()))
+
+    def bind_graphic(self, uuid, idx):
+        self.graphics[uuid] = int(idx)
+
+    def site_of_graphic(self, uuid):
+        return self.graphics.get(uuid)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Hop-distance index of a lattice, built once per set of sites and bonds.
+
+Small lattices keep the full table of jumps between all sites, larger ones
+the distances from a few landmarks, which give lower bounds on the distance
+of any two sites (ALT: |d(l, u) - d(l, v)| <= d(u, v)). Distances are stored
+as uint16 and the index is saved as .npz, keyed by the data item it belongs
+to and checked against the bonds when it is loaded again.
+"""
+
+# standard libraries
+import os
+import numpy as np
+
+# third party libraries
+from scipy.sparse import csgraph
+
+# local libraries
+from . import detection
+from . import assignment
+
+UNREACHABLE = np.iinfo(np.uint16).max
+
+
+def fingerprint(lattice):
+    return detection.frame_key(np.concatenate(([len(lattice)], lattice.bonds.ravel())).astype(np.int64))
+
+
+def bfs_distances(lattice, indices, chunk_size=256):
+    """uint16 jumps from the given sites to all sites, UNREACHABLE if not connected."""
+    graph = assignment.bond_graph(lattice)
+    indices = np.asarray(indices, dtype=np.int32)
+    result = np.empty((len(indices), len(lattice)), dtype=np.uint16)
+    # in chunks, the float64 output of csgraph is 4x larger
+    for start in range(0, len(indices), chunk_size):
+        distances = csgraph.shortest_path(graph, unweighted=True, indices=indices[start:start+chunk_size])
+        distances[~np.isfinite(distances)] = UNREACHABLE
+        result[start:start+chunk_size] = np.minimum(distances, UNREACHABLE)
+    return result
+
+
+def select_landmarks(lattice, number_landmarks):
+    """Farthest-point landmarks: every new one is as many jumps as possible away from the others."""
+    n = len(lattice)
+    landmarks = []
+    nearest = bfs_distances(lattice, [0])[0].astype(np.int32)
+    for _ in range(min(number_landmarks, n)):
+        landmark = int(np.argmax(nearest))
+        if landmarks and nearest[landmark] == 0:
+            break
+        landmarks.append(landmark)
+        nearest = np.minimum(nearest, bfs_distances(lattice, [landmark])[0])
+    return np.array(landmarks, dtype=np.int32)
+
+
+class LatticeIndex:
+    """
+    Exact hop distances (table) or landmark lower bounds (ALT) on the bond graph.
+
+    lower_bounds(goal) gives an admissible A* heuristic towards goal for all
+    sites at once; with the full table it is the exact number of jumps.
+    """
+
+    def __init__(self, distances, landmarks, key):
+        self.distances = distances # (number of landmarks or sites, number of sites) uint16
+        self.landmarks = landmarks # None for the full table
+        self.key = key
+
+    @property
+    def exact(self):
+        return self.landmarks is None
+
+    @classmethod
+    def build(cls, lattice, number_landmarks=16, max_table_sites=4096):
+        if len(lattice) <= max_table_sites:
+            return cls(bfs_distances(lattice, np.arange(len(lattice))), None, fingerprint(lattice))
+        landmarks = select_landmarks(lattice, number_landmarks)
+        return cls(bfs_distances(lattice, landmarks), landmarks, fingerprint(lattice))
+
+    def matches(self, lattice):
+        return self.key == fingerprint(lattice)
+
+    def lower_bounds(self, goal):
+        """Lower bound of the jumps from every site to goal (float, inf if unreachable)."""
+        if self.exact:
+            bounds = self.distances[goal].astype(np.float64)
+        else:
+            column = self.distances[:, goal:goal+1].astype(np.int32)
+            bounds = np.abs(self.distances.astype(np.int32) - column).max(axis=0).astype(np.float64)
+        bounds[bounds >= UNREACHABLE] = np.inf
+        return bounds
+
+    def bound(self, u, v):
+        if self.exact:
+            d = float(self.distances[u, v])
+        else:
+            d = float(np.abs(self.distances[:, u].astype(np.int32) - self.distances[:, v]).max())
+        return np.inf if d >= UNREACHABLE else d
+
+    def hop_distances(self, sources, targets):
+        """Jumps from every source to every target, None if the index only holds bounds."""
+        if not self.exact:
+            return None
+        d = self.distances[np.ix_(np.asarray(sources), np.asarray(targets))].astype(np.float64)
+        d[d >= UNREACHABLE] = np.inf
+        return d
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        landmarks = self.landmarks if self.landmarks is not None else np.empty(0, dtype=np.int32)
+        with open(path, 'wb') as f:
+            np.savez(f, distances=self.distances, landmarks=landmarks, exact=self.exact, key=self.key)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            landmarks = None if bool(f['exact']) else f['landmarks']
+            return cls(f['distances'], landmarks, str(f['key']))
+
+
+def index_path(directory, uuid):
+    return os.path.join(directory, "{}.npz".format(uuid))
+
+
+def load_or_build(lattice, directory, uuid, **kwargs):
+    """Index of lattice from directory if it was saved for the same bonds, otherwise built and saved."""
+    path = index_path(directory, uuid)
+    if os.path.exists(path):
+        try:
+            index = LatticeIndex.load(path)
+            if index.matches(lattice):
+                return index
+        except (OSError, ValueError, KeyError):
+            pass
+    index = LatticeIndex.build(lattice, **kwargs)
+    try:
+        index.save(path)
+    except OSError as e:
+        print("Could not save the lattice index: {}".format(e))
+    return index
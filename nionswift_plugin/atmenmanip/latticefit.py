@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Fit of an ideal honeycomb (graphene) lattice to a frame.
+
+The two first-order spots of the hexagonal pattern in the power spectrum of
+the blurred frame give the reciprocal lattice vectors, and from them the real
+space basis a1, a2 (60 degrees apart). Honeycomb sites are
+o + n a1 + m a2 + s (a1 + a2) / 3 with s = 0, 1 for the two sublattices. Few
+periods fit in a frame, so the spots are only coarsely resolved: the
+reciprocal vectors g1, g2 dual to a1, a2 are refined on the detected maxima,
+as the maxima of their structure factor sum(exp(2 pi i g.p)). Its phase is
+2 pi g.o + pi/3 for a honeycomb, which gives the origin o.
+
+The ideal grid is snapped to the maxima in one KD-tree query. Ideal sites
+without a maximum are vacancies, maxima without an ideal site outliers
+(adatoms, contamination, noise). The basis and origin are then refined by a
+least squares fit to the matched maxima. Bonds follow from the grid indices:
+site (n, m, 0) is bonded to (n, m, 1), (n-1, m, 1) and (n, m-1, 1).
+"""
+
+# standard libraries
+import numpy as np
+
+# third party libraries
+from scipy import ndimage
+from scipy import fft as sp_fft
+from scipy.spatial import cKDTree
+
+# local libraries
+from . import drift
+
+
+def reciprocal_vectors(image, min_frequency=None, number_candidates=20):
+    """
+    Two first-order reciprocal lattice vectors (cycles per pixel, (y, x)) 60 degrees apart.
+
+    min_frequency (cycles per pixel) excludes the low frequencies, by default
+    those of features larger than a quarter of the frame.
+    """
+    image = np.asarray(image, dtype=np.float32)
+    shape = np.array(image.shape)
+    power = np.abs(sp_fft.fft2((image - image.mean()) * drift.hann_window(image.shape), workers=-1))**2
+    power = sp_fft.fftshift(power)
+    fy = sp_fft.fftshift(sp_fft.fftfreq(image.shape[0]))[:, np.newaxis]
+    fx = sp_fft.fftshift(sp_fft.fftfreq(image.shape[1]))[np.newaxis, :]
+    min_frequency = min_frequency if min_frequency is not None else 4.0 / shape.min()
+    power[fy**2 + fx**2 < min_frequency**2] = 0
+    # the upper half plane is enough, the spectrum is symmetric
+    power[:image.shape[0] // 2, :] = 0
+    peaks = np.argwhere((power == ndimage.maximum_filter(power, size=3)) & (power > 0))
+    peaks = peaks[np.argsort(-power[peaks[:, 0], peaks[:, 1]])][:number_candidates]
+    if len(peaks) < 2:
+        raise ValueError("No lattice found in the power spectrum")
+
+    def frequency(peak):
+        # centre of mass of the 3x3 neighbourhood
+        window = power[peak[0]-1:peak[0]+2, peak[1]-1:peak[1]+2]
+        offset = np.array(ndimage.center_of_mass(window)) - 1 if window.shape == (3, 3) else np.zeros(2)
+        return (peak + offset - shape // 2) / shape
+
+    g1 = frequency(peaks[0])
+    for peak in peaks[1:]:
+        g2 = frequency(peak)
+        ratio = np.linalg.norm(g2) / np.linalg.norm(g1)
+        angle = np.degrees(np.arccos(np.clip(np.dot(g1, g2) / np.linalg.norm(g1) / np.linalg.norm(g2), -1, 1)))
+        # a spot of the same order 60 or 120 degrees away (the latter is -(g1 - g2))
+        if 0.85 < ratio < 1.15 and (abs(angle - 60) < 12 or abs(angle - 120) < 12):
+            return g1, g2
+    raise ValueError("No hexagonal lattice found in the power spectrum")
+
+
+def real_space_basis(g1, g2):
+    """Basis a1, a2 (rows, in pixels) dual to g1, g2, made 60 degrees apart."""
+    basis = np.linalg.inv(np.array((g1, g2))).T
+    if np.dot(basis[0], basis[1]) < 0:
+        basis[1] += basis[0]
+    return basis
+
+
+class LatticeFit:
+    """
+    Ideal honeycomb sites of a frame.
+
+    coords: (N, 2) site positions, the maximum's position for occupied sites
+    and the ideal one for vacancies. grid: (N, 3) indices (n, m, sublattice).
+    occupied: (N,) bool. outliers: indices of maxima without a site.
+    maximum: (N,) index of the maximum of every occupied site (-1 for vacancies).
+    """
+
+    def __init__(self, basis, origin, grid, ideal, coords, occupied, maximum, outliers):
+        self.basis = basis
+        self.origin = origin
+        self.grid = grid
+        self.ideal = ideal
+        self.coords = coords
+        self.occupied = occupied
+        self.maximum = maximum
+        self.outliers = outliers
+
+    @property
+    def bond_length(self):
+        return float(np.linalg.norm(self.basis.sum(axis=0)) / 3)
+
+    @property
+    def vacancies(self):
+        return np.flatnonzero(~self.occupied)
+
+    def bonds(self, sites=None):
+        """(M, 2) bonds between the given sites (default all), as indices into sites."""
+        sites = np.arange(len(self.grid)) if sites is None else np.asarray(sites)
+        if len(sites) == 0:
+            return np.empty((0, 2), dtype=np.int32)
+        grid = self.grid[sites]
+        low = grid[:, :2].min(axis=0)
+        size = grid[:, :2].max(axis=0) - low + 2
+        lookup = np.full((size[0], size[1], 2), -1, dtype=np.int64)
+        lookup[grid[:, 0] - low[0] + 1, grid[:, 1] - low[1] + 1, grid[:, 2]] = np.arange(len(sites))
+        a = np.flatnonzero(grid[:, 2] == 0)
+        n, m = grid[a, 0] - low[0] + 1, grid[a, 1] - low[1] + 1
+        bonds = []
+        for dn, dm in ((0, 0), (-1, 0), (0, -1)):
+            b = lookup[n + dn, m + dm, 1]
+            bonds.append(np.stack((a[b >= 0], b[b >= 0]), axis=1))
+        bonds = np.sort(np.concatenate(bonds), axis=1).astype(np.int32)
+        return bonds[np.lexsort((bonds[:, 1], bonds[:, 0]))]
+
+
+def ideal_sites(basis, origin, shape, margin=0.0):
+    """Grid indices (n, m, s) and positions of all honeycomb sites within the frame."""
+    corners = np.array([(0, 0), (0, shape[1]), (shape[0], 0), (shape[0], shape[1])], dtype=float)
+    fractional = (corners - origin) @ np.linalg.inv(basis)
+    low = np.floor(fractional.min(axis=0)).astype(int) - 1
+    high = np.ceil(fractional.max(axis=0)).astype(int) + 1
+    n, m, s = np.meshgrid(np.arange(low[0], high[0] + 1), np.arange(low[1], high[1] + 1), (0, 1), indexing='ij')
+    grid = np.stack((n.ravel(), m.ravel(), s.ravel()), axis=1)
+    positions = origin + (grid[:, :2] + grid[:, 2:] / 3) @ basis
+    inside = np.all((positions >= -margin) & (positions < np.array(shape) - 1 + margin), axis=1)
+    return grid[inside], positions[inside]
+
+
+def structure_factor(points, g):
+    """sum(exp(2 pi i g.p)) over the points for every g, (K, 2) -> (K,)."""
+    return np.exp(2j * np.pi * (points @ np.asarray(g).T)).sum(axis=0)
+
+
+def refine_reciprocal(points, g, step, number_steps=11, levels=2):
+    """g maximising the structure factor of the points, searched on ever finer grids of +-step."""
+    for _ in range(levels):
+        offsets = np.linspace(-step, step, number_steps)
+        candidates = g + np.stack(np.meshgrid(offsets, offsets, indexing='ij'), axis=-1).reshape(-1, 2)
+        g = candidates[np.argmax(np.abs(structure_factor(points, candidates)))]
+        step = 2 * step / (number_steps - 1)
+    return g
+
+
+def find_origin(points, basis):
+    """Origin of the honeycomb from the phases of the structure factor at the reciprocal vectors."""
+    reciprocal = np.linalg.inv(basis).T
+    phases = np.angle(structure_factor(points, reciprocal)) / (2 * np.pi)
+    return (phases - 1 / 6) @ basis
+
+
+def fit_lattice(blurred, maxima, tolerance=0.3, iterations=2):
+    """
+    LatticeFit of the maxima (sub-pixel (y, x)) of a blurred frame.
+
+    tolerance is the largest distance of a maximum from its ideal site, as a
+    fraction of the bond length.
+    """
+    maxima = np.asarray(maxima, dtype=float).reshape(-1, 2)
+    shape = np.asarray(blurred).shape
+    basis = real_space_basis(*reciprocal_vectors(blurred))
+    if len(maxima) < 3:
+        raise ValueError("Too few maxima to fit a lattice")
+    step = 1.0 / min(shape)
+    reciprocal = np.array([refine_reciprocal(maxima, g, step) for g in np.linalg.inv(basis).T])
+    basis = np.linalg.inv(reciprocal).T
+    bond_length = np.linalg.norm(basis.sum(axis=0)) / 3
+    origin = find_origin(maxima, basis)
+    tree = cKDTree(maxima)
+    for i in range(iterations + 1):
+        grid, ideal = ideal_sites(basis, origin, shape, margin=tolerance * bond_length)
+        distances, nearest = tree.query(ideal, distance_upper_bound=tolerance * bond_length)
+        matched = np.isfinite(distances)
+        if i == iterations or np.sum(matched) < 3:
+            break
+        # least squares: maximum = origin + (n + s/3) a1 + (m + s/3) a2
+        design = np.column_stack((np.ones(np.sum(matched)), grid[matched, :2] + grid[matched, 2:] / 3))
+        solution = np.linalg.lstsq(design, maxima[nearest[matched]], rcond=None)[0]
+        origin, basis = solution[0], solution[1:]
+
+    # sites of the margin only count if there is a maximum
+    inside = np.all((ideal >= 0) & (ideal < np.array(shape) - 1), axis=1) | matched
+    grid, ideal, matched, nearest = grid[inside], ideal[inside], matched[inside], nearest[inside]
+    maximum = np.where(matched, nearest, -1)
+    coords = ideal.copy()
+    coords[matched] = maxima[nearest[matched]]
+    outliers = np.setdiff1d(np.arange(len(maxima)), maximum[matched])
+    return LatticeFit(basis, origin, grid, ideal, coords, matched, maximum, outliers)
@@ -4,20 +4,31 @@
 # standard libraries
 import gettext
 import logging
-import threading
+import os
 import time
 import numpy as np
-import copy
-from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
 #from scipy import ndimage
 #import cv2 # for noise filters
 #import imp
 
 # specific application classes
-from pathfindlib import pfl_interface as pf
-from pathfindlib import pfl_plot as pfplt
-from imgrecoglib import irl_interface as ir
 from . import auto_manipulator as am
+from . import overlay
+from . import lattice
+from . import detection
+from . import pipeline
+from . import planning
+from . import assignment
+from . import lattice_index
+from . import session
+from . import sweep
+from . import dopants
+from . import latticefit
+from . import instrumentation
+from . import jobs
 
 # third party libraries
 # None
@@ -40,14 +51,29 @@ class AtomManipDelegate:
         self.sigma = 9 # Kernel of the Gaussian blut in pixels
         self.noise_tolerance = 1e-5
         self.maxlength = 50 # Bond max length in pixels
+        self.dopant_threshold = 2.0 # Intensity of a dopant relative to its neighbours
         self.drawn_fraction = 1/3
+        self.marker_radius = 2 # Radius of the maxima markers in pixels
+        self.tile_size = 1024 # Larger frames are processed in tiles on all cores
+        self.subpixel = True # Sites are refined to sub-pixel positions by Gaussian fits
+        self.ideal_lattice = False # Sites and bonds from a honeycomb fitted to the maxima instead of max. bond length
+        self.streaming = False # Auto-Manipulator tracks the sites in live frames
+        self.image_feedback = False # Jumps are detected in the frames instead of by the Keithley
+        self.path_time_budget = 5.0 # Seconds the path finding may take
+        self.path_seed = 0 # Same seed, same paths
+        self.index_directory = os.path.join(os.path.expanduser("~"), "atmenmanip", "lattice_indices")
+        self.minimise_makespan = False # Assign the targets for the shortest longest path instead of fewest jumps
+        self.session_directory = os.path.join(os.path.expanduser("~"), "atmenmanip", "sessions")
+        self.trace_directory = os.path.join(os.path.expanduser("~"), "atmenmanip", "traces")
         
         # GUI elements
         self.sigma_field = None
         self.noise_tolerance_field = None    
         self.maxlength_field = None
         self.drawn_fraction_field = None
+        self.dopant_threshold_field = None
         self.find_maxima_button = None
+        self.tune_parameters_button = None
         self.set_sites_and_bonds_button = None
         self.auto_detect_sources_button = None
         self.add_sources_button = None
@@ -56,25 +82,55 @@ class AtomManipDelegate:
         self.open_conceptional_plot_button = None
         self.call_auto_manipulator_button = None
         self.stop_auto_manipulator_button = None
+        self.streaming_checkbox = None
+        self.image_feedback_checkbox = None
+        self.ideal_lattice_checkbox = None
+        self.makespan_checkbox = None
+        self.save_session_button = None
+        self.load_session_button = None
+        self.show_timings_button = None
+        self.cancel_jobs_button = None
+        self.status_label = None
         
         # Objects that are needed to be saved
         self.source_data_item = None
-        self.processed_data_item = None
-        self.picobj = None
-        self.sites = None
-        self.bonds = None
-        self.sources = None
-        self.targets = None
-        self.paths = None
-        
-        # Threads
-        self.t1 = None
-        self.t2 = None
-        self.t3 = None
-        self.t4 = None
-        self.t5 = None
-        
-        self.t6 = None
+        self.processed_data_item = None # filtered image (float)
+        self.overlay_data_item = None # filtered image with maxima and bonds (RGB) and the site markers
+        self.blur_engine = detection.BlurEngine()
+        self.blurred = None
+        self.maxima = None
+        self.lattice = None # sites, bonds, sources, targets and paths
+        self.lattice_sites_version = None
+        self.auto_manipulator = None
+        
+        # source image -> blurred -> maxima -> sites -> lattice (bonds) -> index -> assignment -> paths
+        #                                                        lattice -> dopant features
+        # A cancelled job stops before the next stage
+        self.pipeline = pipeline.Pipeline(checkpoint=lambda name: jobs.checkpoint("computing " + name))
+        self.pipeline.add_stage('blurred', self.blur_stage, params=('source', 'sigma'))
+        self.pipeline.add_stage('maxima', self.maxima_stage, depends=('blurred',),
+                                params=('source', 'sigma', 'noise_tolerance'))
+        self.pipeline.add_stage('sites', self.sites_stage, depends=('maxima', 'blurred'), params=('sigma', 'subpixel'))
+        self.pipeline.add_stage('lattice', self.lattice_stage, depends=('sites', 'blurred'),
+                                params=('maxlength', 'ideal_lattice'))
+        self.pipeline.add_stage('index', self.index_stage, depends=('lattice',))
+        self.pipeline.add_stage('dopant_features', self.dopant_features_stage, depends=('blurred', 'lattice'),
+                                params=('source', 'sigma'))
+        self.pipeline.add_stage('assignment', self.assignment_stage, depends=('lattice', 'index'),
+                                params=('sources', 'targets', 'objective'))
+        self.pipeline.add_stage('paths', self.paths_stage, depends=('lattice', 'assignment'))
+        
+        # Displayed state
+        self.processed_key = None
+        self.overlay_key = None
+        self.markers = dict() # (sites version, 'source'/'target', site index) -> graphic
+        
+        # Jobs of the buttons, in one bounded pool (the Auto-Manipulator occupies a worker while it runs)
+        self.jobs = jobs.Scheduler(max_workers=3, on_progress=self.show_progress)
+        
+    # Called by Swift when the panel is closed
+    def close(self):
+        self.jobs.shutdown()
 
     def create_panel_widget(self, ui, document_controller):
         self.dc = document_controller
@@ -82,28 +138,37 @@ class AtomManipDelegate:
         # Callback functions
         def sigma_finished(text):
             if len(text) > 0:
+                previous = self.sigma
                 try:
                     self.sigma = float(text)
                 except ValueError:
                     pass
                 finally:
                     self.sigma_field.text = "{:.2f}".format(self.sigma)
+                if self.sigma != previous:
+                    self.rerun_stale('maxima', 'bonds')
         def noise_tolerance_finished(text):
             if len(text) > 0:
+                previous = self.noise_tolerance
                 try:
                     self.noise_tolerance = float(text)
                 except ValueError:
                     pass
                 finally:
                     self.noise_tolerance_field.text = str(self.noise_tolerance)
+                if self.noise_tolerance != previous:
+                    self.rerun_stale('maxima', 'bonds')
         def maxlength_finished(text):
             if len(text) > 0:
+                previous = self.maxlength
                 try:
                     self.maxlength = float(text)
                 except ValueError:
                     pass
                 finally:
                     self.maxlength_field.text = "{:.2f}".format(self.maxlength)
+                if self.maxlength != previous:
+                    self.rerun_stale('bonds')
         def drawn_fraction_finished(text):
             if len(text) > 0:
                 try:
@@ -112,9 +177,20 @@ class AtomManipDelegate:
                     pass
                 finally:
                     self.drawn_fraction_field.text = "{:.2f}".format(self.drawn_fraction)
+        def dopant_threshold_finished(text):
+            if len(text) > 0:
+                try:
+                    self.dopant_threshold = float(text)
+                except ValueError:
+                    pass
+                finally:
+                    self.dopant_threshold_field.text = "{:.2f}".format(self.dopant_threshold)
         def find_maxima_clicked():
             self.get_source_image()
             self.process_and_show()
+        def tune_parameters_clicked():
+            self.get_source_image()
+            self.tune_parameters()
         def set_sites_bonds_clicked():
             self.set_sites_and_bonds()
         def auto_detect_sources_clicked():
@@ -131,14 +207,34 @@ class AtomManipDelegate:
             self.open_conceptional_plot()
         def call_auto_manipulator_clicked():
             self.call_auto_manipulator()
+        def streaming_changed(checked):
+            self.streaming = checked
+        def image_feedback_changed(checked):
+            self.image_feedback = checked
+        def ideal_lattice_changed(checked):
+            self.ideal_lattice = checked
+            self.rerun_stale('bonds')
+        def makespan_changed(checked):
+            self.minimise_makespan = checked
         def stop_auto_manipulator_clicked():
-            #self.stop_auto_manipulator()
-            pass
+            self.stop_auto_manipulator()
+        def save_session_clicked():
+            self.save_session()
+        def load_session_clicked():
+            self.get_source_image()
+            self.load_session()
+        def show_timings_clicked():
+            self.show_timings()
+        def cancel_jobs_clicked():
+            self.jobs.cancel()
             
         # GUI buttons
         self.find_maxima_button = ui.create_push_button_widget('Determine Maxima')
         self.find_maxima_button.on_clicked = find_maxima_clicked
         
+        self.tune_parameters_button = ui.create_push_button_widget(_('Auto-tune'))
+        self.tune_parameters_button.on_clicked = tune_parameters_clicked
+        
         self.set_sites_and_bonds_button = ui.create_push_button_widget('Set Sites and Bonds')
         self.set_sites_and_bonds_button.on_clicked = set_sites_bonds_clicked
          
@@ -153,6 +249,10 @@ class AtomManipDelegate:
         
         self.find_paths_button = ui.create_push_button_widget(_('Find paths'))
         self.find_paths_button.on_clicked = find_paths_clicked
+        
+        self.makespan_checkbox = ui.create_check_box_widget(_('Minimise longest path'))
+        self.makespan_checkbox.checked = self.minimise_makespan
+        self.makespan_checkbox.on_checked_changed = makespan_changed
  
         self.open_conceptional_plot_button = ui.create_push_button_widget('Conceptional plot')
         self.open_conceptional_plot_button.on_clicked = open_conceptional_plot_clicked
@@ -163,6 +263,20 @@ class AtomManipDelegate:
         self.stop_auto_manipulator_button = ui.create_push_button_widget(_('Stop Auto-Manipulator'))
         self.stop_auto_manipulator_button.on_clicked = stop_auto_manipulator_clicked
         
+        self.save_session_button = ui.create_push_button_widget(_('Save session'))
+        self.save_session_button.on_clicked = save_session_clicked
+        
+        self.load_session_button = ui.create_push_button_widget(_('Load session'))
+        self.load_session_button.on_clicked = load_session_clicked
+        
+        self.show_timings_button = ui.create_push_button_widget(_('Timings'))
+        self.show_timings_button.on_clicked = show_timings_clicked
+        
+        self.cancel_jobs_button = ui.create_push_button_widget(_('Cancel'))
+        self.cancel_jobs_button.on_clicked = cancel_jobs_clicked
+        
+        self.status_label = ui.create_label_widget(_('Ready'))
+        
         # GUI labels and inputs
         self.sigma_field = ui.create_line_edit_widget()
         self.sigma_field.text = "{:.2f}".format(self.sigma)
@@ -178,6 +292,22 @@ class AtomManipDelegate:
         self.drawn_fraction_field.text = "{:.2f}".format(self.drawn_fraction)
         self.drawn_fraction_field.on_editing_finished = drawn_fraction_finished
         
+        self.ideal_lattice_checkbox = ui.create_check_box_widget(_('Fit ideal lattice'))
+        self.ideal_lattice_checkbox.checked = self.ideal_lattice
+        self.ideal_lattice_checkbox.on_checked_changed = ideal_lattice_changed
+        
+        self.dopant_threshold_field = ui.create_line_edit_widget()
+        self.dopant_threshold_field.text = "{:.2f}".format(self.dopant_threshold)
+        self.dopant_threshold_field.on_editing_finished = dopant_threshold_finished
+        
+        self.streaming_checkbox = ui.create_check_box_widget(_('Track live frames'))
+        self.streaming_checkbox.checked = self.streaming
+        self.streaming_checkbox.on_checked_changed = streaming_changed
+        
+        self.image_feedback_checkbox = ui.create_check_box_widget(_('Detect jumps in frames'))
+        self.image_feedback_checkbox.checked = self.image_feedback
+        self.image_feedback_checkbox.on_checked_changed = image_feedback_changed
+        
         # GUI init
         main_col = ui.create_column_widget()
         
@@ -201,6 +331,8 @@ class AtomManipDelegate:
         
         ir_row_button_col.add_spacing(15)
         ir_row_button_col.add(self.find_maxima_button)
+        ir_row_button_col.add_spacing(2)
+        ir_row_button_col.add(self.tune_parameters_button)
         ir_row_button_col.add_stretch()
     
         ir_row.add_spacing(5)
@@ -229,6 +361,8 @@ class AtomManipDelegate:
         
         sb_row_button_col.add_spacing(15)
         sb_row_button_col.add(self.set_sites_and_bonds_button)
+        sb_row_button_col.add_spacing(2)
+        sb_row_button_col.add(self.ideal_lattice_checkbox)
         sb_row_button_col.add_stretch()
     
         sb_row.add_spacing(5)
@@ -245,12 +379,17 @@ class AtomManipDelegate:
         st_row.add(self.add_sources_button)
         st_row.add_spacing(2)
         st_row.add(self.auto_detect_sources_button)
+        st_row.add_spacing(2)
+        st_row.add(ui.create_label_widget(_('Dopant contrast ')))
+        st_row.add(self.dopant_threshold_field)
         st_row.add_stretch()
         
         # Path finding row
         pf_row = ui.create_row_widget()
         pf_row.add_spacing(5)
         pf_row.add(self.find_paths_button)
+        pf_row.add_spacing(2)
+        pf_row.add(self.makespan_checkbox)
         pf_row.add_stretch()
         
         # Conceptional plot row
@@ -265,8 +404,30 @@ class AtomManipDelegate:
         am_row.add(self.call_auto_manipulator_button)
         am_row.add_spacing(2)
         am_row.add(self.stop_auto_manipulator_button)
+        am_row.add_spacing(2)
+        am_row.add(self.streaming_checkbox)
+        am_row.add_spacing(2)
+        am_row.add(self.image_feedback_checkbox)
         am_row.add_stretch()
         
+        # Session and timings row
+        ss_row = ui.create_row_widget()
+        ss_row.add_spacing(5)
+        ss_row.add(self.save_session_button)
+        ss_row.add_spacing(2)
+        ss_row.add(self.load_session_button)
+        ss_row.add_spacing(2)
+        ss_row.add(self.show_timings_button)
+        ss_row.add_stretch()
+        
+        # Jobs row
+        jb_row = ui.create_row_widget()
+        jb_row.add_spacing(5)
+        jb_row.add(self.cancel_jobs_button)
+        jb_row.add_spacing(2)
+        jb_row.add(self.status_label)
+        jb_row.add_stretch()
+        
         # Placeholder for new rows
         pass
         
@@ -282,6 +443,10 @@ class AtomManipDelegate:
         main_col.add(cp_row)
         main_col.add_spacing(4)
         main_col.add(am_row)
+        main_col.add_spacing(4)
+        main_col.add(ss_row)
+        main_col.add_spacing(4)
+        main_col.add(jb_row)
         pass #TODO new rows come added here
         main_col.add_stretch()
 
@@ -293,264 +458,481 @@ class AtomManipDelegate:
         except AttributeError:
             self.source_data_item = None
     
+    # Progress of the jobs in the panel
+    def show_progress(self, job):
+        if self.status_label is None:
+            return
+        if job.state == jobs.RUNNING and job.message:
+            text = "{}: {}".format(job.slot, job.message)
+            if job.fraction is not None:
+                text += " ({:.0%})".format(job.fraction)
+        else:
+            text = "{}: {}".format(job.slot, job.state)
+        def set_text():
+            self.status_label.text = text
+        self.__api.queue_task(set_text)
+        
+    # A job still computing with the previous parameters is superseded by one
+    # with the new parameters
+    def rerun_stale(self, *slots):
+        if 'maxima' in slots and self.jobs.is_busy('maxima'):
+            self.process_and_show()
+        if 'bonds' in slots and self.jobs.is_busy('bonds'):
+            self.set_sites_and_bonds()
+        
     # Determine maxima       
     def process_and_show(self):
         if self.source_data_item is None:
             print("No data item selected.")
             return
             
-        if self.t1 is not None and self.t1.is_alive():
-            print('Still working. Wait until finished.')
-            return
-            
         def do_this():
-            if self.processed_data_item is None:
-                xdata = copy.deepcopy(self.source_data_item.xdata)
-                self.processed_data_item = self.dc.create_data_item_from_data_and_metadata(xdata,
-                                                                title='Local Maxima of ' + self.source_data_item.title)
-            self.processed_data_item.title = 'Local Maxima of ' + self.source_data_item.title
-            
-            #TOOD debug this. get calibration data from source data item
-            #self.processed_data_item.set_dimensional_calibrations(
-            #        self.source_data_item.dimensional_calibrations)
-            
-            self.picobj = ir.Picture(self.source_data_item.data, self.source_data_item.title,\
-                                self.sigma, self.noise_tolerance)
+            self.update_params()
             print(' Blurring and finding maxima...')
-            self.picobj.blur_image()
-            self.picobj.detect_maxima()
-            #picobj._plot()
+            self.blurred = self.pipeline.get('blurred')
+            self.maxima = self.pipeline.get('maxima')
+            logging.info('Found {:.0f} maxima'.format(len(self.maxima)))
             
-            maxima = self.picobj.maxima[-1] #TODO: change array-behavior in image_recognition
-            number_maxima = len(maxima)
-
-            self.processed_data_item.set_data(self.picobj.pic_filtered[-1])
-            if number_maxima < 3000:
-                #logging.info('Found {:.0f} maxima'.format(number_maxima))
-                pass
+            if not self.pipeline.is_current('lattice'):
+                self.lattice = None
+            self.update_display()
+            self.processed_data_item.title = 'Filtered ' + self.source_data_item.title
+            self.overlay_data_item.title = 'Local Maxima of ' + self.source_data_item.title
+        
+        self.jobs.submit('maxima', do_this)
+        
+    # Sweep sigma, noise tolerance and bond length around the current values
+    # and take the ones giving the most regular lattice
+    def tune_parameters(self):
+        if self.source_data_item is None:
+            print("No data item selected.")
+            return
+        
+        def do_this():
+            t = time.time()
+            jobs.checkpoint("sweeping")
+            sweeper = sweep.Sweep(self.source_data_item.data, tile_size=self.tile_size)
+            # current values first, they win ties (the sort is stable)
+            results = sweeper.grid(self.sigma * np.array((1, 0.85, 1.15, 0.7, 1.3)),
+                                   self.noise_tolerance * 10**np.array((0, -0.5, 0.5, -1, 1)),
+                                   self.maxlength * np.array((1, 0.9, 1.1, 0.8, 1.2)))
+            jobs.checkpoint()
+            best = results[0]
+            logging.info("Swept {:d} parameter sets in {:.2f} s".format(len(results), time.time() - t))
+            logging.info("Best: sigma {:.2f}, noise tolerance {:.2g}, max. bond length {:.1f} "
+                  "({:.0%} 3-coordinated sites, bond length spread {:.1%})".format(
+                  best['sigma'], best['noise_tolerance'], best['maxlength'], best['fraction_three'],
+                  best['bond_length_spread']))
+            self.sigma = float(best['sigma'])
+            self.noise_tolerance = float(best['noise_tolerance'])
+            self.maxlength = float(best['maxlength'])
+            self.show_params()
+        
+        self.jobs.submit('tune', do_this)
+        
+    # Show the current parameters in the fields, from any thread
+    def show_params(self):
+        if self.sigma_field is None:
+            return
+        sigma, noise_tolerance, maxlength = self.sigma, self.noise_tolerance, self.maxlength
+        drawn_fraction = self.drawn_fraction
+        def set_text():
+            self.sigma_field.text = "{:.2f}".format(sigma)
+            self.noise_tolerance_field.text = str(noise_tolerance)
+            self.maxlength_field.text = "{:.2f}".format(maxlength)
+            self.drawn_fraction_field.text = "{:.2f}".format(drawn_fraction)
+        self.__api.queue_task(set_text)
+        
+    # Pipeline stages, only recomputed when their inputs changed
+    def update_params(self):
+        data = self.source_data_item.data
+        self.pipeline.set_param('source', data, key=(self.source_data_item.uuid, detection.frame_key(data)))
+        self.pipeline.set_param('sigma', self.sigma)
+        self.pipeline.set_param('noise_tolerance', self.noise_tolerance)
+        self.pipeline.set_param('maxlength', self.maxlength)
+        self.pipeline.set_param('subpixel', self.subpixel)
+        self.pipeline.set_param('ideal_lattice', self.ideal_lattice)
+        
+    @instrumentation.timed('blur')
+    def blur_stage(self, source, sigma):
+        if max(source.shape) > self.tile_size:
+            return detection.blur_tiled(source, sigma, tile_size=self.tile_size, engine=self.blur_engine)
+        return self.blur_engine.blur(source, sigma)
+        
+    @instrumentation.timed('maxima')
+    def maxima_stage(self, blurred, source, sigma, noise_tolerance):
+        return detection.frame_maxima(source, blurred, sigma, noise_tolerance, tile_size=self.tile_size)
+        
+    @instrumentation.timed('sites')
+    def sites_stage(self, maxima, blurred, sigma, subpixel):
+        if subpixel:
+            return detection.refine_maxima(blurred, maxima, sigma).astype(np.float32)
+        return np.asarray(maxima, dtype=np.float32).reshape(-1, 2)
+        
+    @instrumentation.timed('bonds')
+    def lattice_stage(self, sites, blurred, maxlength, ideal_lattice):
+        new_lattice = None
+        if ideal_lattice:
+            # Ideal honeycomb sites that have a maximum, vacancies are left out
+            try:
+                fit = latticefit.fit_lattice(blurred, sites)
+            except ValueError as e:
+                print("No ideal lattice ({}), bonds by max. bond length instead.".format(e))
             else:
-                logging.info(
-                        'Found {:.0f} maxima (only showing {:.0f} for performance reasons)'.format(number_maxima,
-                                                                             number_maxima//((number_maxima//3000)+1)))
-            
+                occupied = np.flatnonzero(fit.occupied)
+                new_lattice = lattice.Lattice(fit.ideal[occupied].astype(np.float32), fit.bonds(occupied))
+                print("Ideal lattice: bond length {:.2f} px, {} vacancies, {} outliers".format(
+                      fit.bond_length, len(fit.vacancies), len(fit.outliers)))
+        if new_lattice is None:
+            ideal_lattice = False
+            new_lattice = lattice.Lattice(sites, lattice.find_bonds(sites, maxlength))
+        # Same sites (only maxlength changed): keep sources, targets and graphics
+        sites_version = (self.pipeline.version('sites'), ideal_lattice)
+        if self.lattice is not None and self.lattice_sites_version == sites_version:
+            new_lattice.sources = self.lattice.sources
+            new_lattice.targets = self.lattice.targets
+            new_lattice.graphics = self.lattice.graphics
+        self.lattice_sites_version = sites_version
+        return new_lattice
+        
+    # Hop distances of the lattice, saved per source data item so that they
+    # are built once per lattice and experiment
+    def index_stage(self, lat):
+        with instrumentation.span('lattice index') as span:
+            lat.index = lattice_index.load_or_build(lat, self.index_directory, self.source_data_item.uuid)
+        logging.info("Lattice index ready after {:.2f} s".format(span.duration))
+        return lat.index
+        
+    @instrumentation.timed('dopant features')
+    def dopant_features_stage(self, blurred, lat, source, sigma):
+        return dopants.intensity_features(source, blurred, lat, sigma)
+        
+    @instrumentation.timed('assignment')
+    def assignment_stage(self, lat, index, sources, targets, objective):
+        return assignment.assign(lat, sources, targets, objective)
+        
+    @instrumentation.timed('path finding')
+    def paths_stage(self, lat, assigned):
+        sources, targets, _ = assigned
+        # 20-50 dopants are planned faster in this job than in worker processes
+        planner = planning.MultiPathPlanner(lat, time_budget=self.path_time_budget, seed=self.path_seed)
+        paths = planner.plan(sources, targets)
+        if not planner.optimal:
+            print("Time budget used up, paths are the best found so far.")
+        return paths
+        
+    # Update the display as a diff: the filtered image and the overlay are only
+    # replaced if their inputs changed, source and target markers are
+    # added/removed individually
+    @instrumentation.timed('display')
+    def update_display(self):
+        processed_key = self.pipeline.version('blurred')
+        lattice_version = self.pipeline.version('lattice') if self.lattice is not None else None
+        overlay_key = (self.pipeline.version('maxima'), lattice_version,
+                       self.drawn_fraction, self.marker_radius)
+        if self.processed_data_item is None:
+            self.processed_data_item = self.create_processed_data_item(self.blurred,
+                                                                       'Filtered ' + self.source_data_item.title)
+            self.processed_key = processed_key
+        if self.overlay_data_item is None:
+            self.overlay_data_item = self.create_processed_data_item(self.render_overlay(),
+                                                'Local Maxima of ' + self.source_data_item.title)
+            self.overlay_key = overlay_key
+        if processed_key != self.processed_key:
             with self.dc.library.data_ref_for_data_item(self.processed_data_item):
-                shape = self.processed_data_item.xdata.data_shape
-                for region in self.processed_data_item.regions:
-                    if region.type in ('point-region', 'ellipse-region', 'line-region', 'rectangle-region'):
-                        try:
-                            self.processed_data_item.remove_region(region)
-                        except:
-                            pass
-                for i in range(number_maxima):
-                    if number_maxima < 3000 or i%((number_maxima//3000)+1) == 0:
-                        loc = maxima[i]
-                        self.processed_data_item.add_point_region(
-                                loc[0]/shape[0], loc[1]/shape[1])
-        
-        self.t1 = threading.Thread(target = do_this, name = 'dothis')
-        self.t1.start()
+                self.processed_data_item.set_data(self.blurred)
+            self.processed_key = processed_key
+        with self.dc.library.data_ref_for_data_item(self.overlay_data_item):
+            if overlay_key != self.overlay_key:
+                self.overlay_data_item.set_data(self.render_overlay())
+                self.overlay_key = overlay_key
+            self.sync_markers()
+            
+    # The processed data items are created directly from their data, calibrations
+    # and metadata of the source are shared instead of deep-copying its xdata
+    def create_processed_data_item(self, data, title):
+        xdata = self.source_data_item.xdata
+        processed_xdata = self.__api.create_data_and_metadata(data,
+                                intensity_calibration = xdata.intensity_calibration,
+                                dimensional_calibrations = list(xdata.dimensional_calibrations),
+                                metadata = dict(xdata.metadata))
+        return self.dc.create_data_item_from_data_and_metadata(processed_xdata, title=title)
+            
+    def sync_markers(self):
+        wanted = set()
+        if self.lattice is not None:
+            sites_version = self.pipeline.version('sites')
+            wanted.update((sites_version, 'source', int(i)) for i in self.lattice.sources)
+            wanted.update((sites_version, 'target', int(i)) for i in self.lattice.targets)
+        removed = [key for key in self.markers if key not in wanted]
+        added = wanted - set(self.markers)
+        with instrumentation.span('regions', removed=len(removed), added=len(added)):
+            for key in removed:
+                graphic = self.markers.pop(key)
+                if self.lattice is not None:
+                    self.lattice.graphics.pop(graphic.uuid, None)
+                try:
+                    self.overlay_data_item.remove_region(graphic)
+                except:
+                    pass
+            for key in added:
+                self.markers[key] = self.add_site_marker(key[2], key[1])
+        instrumentation.count('regions removed', len(removed))
+        instrumentation.count('regions added', len(added))
+            
+    # Render filtered image, bonds and maxima as one RGB overlay
+    # (instead of one point or line region each), the filtered image itself stays in the processed data item
+    @instrumentation.timed('render overlay')
+    def render_overlay(self):
+        rgb = overlay.grey_to_rgb(self.blurred)
+        if self.lattice is not None:
+            starts, ends = lattice.shortened_segments(self.lattice.coords, self.lattice.bonds,
+                                                      self.drawn_fraction)
+            overlay.draw_segments(rgb, starts, ends)
+        overlay.draw_points(rgb, self.maxima, radius=self.marker_radius)
+        return rgb
+        
+    # Site belonging to a graphic: either a marker we created or the closest site
+    def site_index_of(self, graphic):
+        idx_site = self.lattice.site_of_graphic(graphic.uuid)
+        if idx_site is None:
+            shape = self.overlay_data_item.xdata.data_shape
+            loc = graphic.position
+            idx_site = self.lattice.nearest_site(loc[0]*shape[0], loc[1]*shape[1])
+        return idx_site
+        
+    # Rectangle (source) or ellipse (target) marker on a site
+    def add_site_marker(self, idx_site, kind):
+        shape = self.overlay_data_item.xdata.data_shape
+        loc = self.lattice.coords[idx_site]
+        ellipse_relative_size = 0.05
+        if kind == 'source':
+            add_region = self.overlay_data_item.add_rectangle_region
+        else:
+            add_region = self.overlay_data_item.add_ellipse_region
+        reg = add_region(loc[0]/shape[0], loc[1]/shape[1],
+                         ellipse_relative_size, ellipse_relative_size)
+        self.lattice.bind_graphic(reg.uuid, idx_site)
+        return reg
         
     # Sites and bonds
-    #TODO: secure that site-graphics assignment stays consistent, look near the comment lines "# Mutual assignment"
     def set_sites_and_bonds(self):
-        if self.processed_data_item is None:
+        if self.processed_data_item is None and not self.jobs.is_busy('maxima'):
             print("Aborted! Determine maxima first.")
             return
-        if self.t2 is not None and self.t2.is_alive():
-            print('Still working. Wait until finished.')
-            return
-        
-        maxima = self.picobj.maxima[-1] #TODO see above
         
         def thread_this():
-            #TODO
-            # Probably it would be better to set the sites in a regular manner
-            # in order to match the graphene structure.
-            # (tddnqu: Relocate when compared to the actual maxima)
-
-            # Create and assign sites and bonds
-            self.sites = []
+            # Set sites and bonds (optionally of an ideal honeycomb snapped to the maxima)
+            print("======= Set sites and bonds =======")
+            self.update_params()
+            self.lattice = self.pipeline.get('lattice')
+            self.pipeline.get('index')
+            self.blurred = self.pipeline.get('blurred')
+            self.maxima = self.pipeline.get('maxima')
             
-            with self.dc.library.data_ref_for_data_item(self.processed_data_item):
-                shape = self.processed_data_item.xdata.data_shape
-                
-                # Delete old 
-                for region in self.processed_data_item.regions:
-                    if region.type in ('line-region', 'rectangle-region', 'ellipse-region'):
-                        try:
-                            self.processed_data_item.remove_region(region)
-                        except:
-                            pass
-                self.sources = np.array([])
-                self.targets = np.array([])
-                
-                # Set sites
-                print("======= Set sites =======")
-                for i in range(len(maxima)):
-                    thissite = pf.Site(maxima[i][0], maxima[i][1],
-                                          max_bond_radius = self.maxlength)
-                    self.sites.append(thissite)
-                    
-                    # Mutual assignment
-                    self.sites[-1].uuid_graphics = self.processed_data_item.regions[i].uuid #TODO: rework! not sure whether correct point_graphics is taken.
-                    self.processed_data_item.regions[i].graphic_id = len(self.sites) #TODO: maybe change somehow. Attribute graphic_id is abused
-
-                # Set bonds
-                print("======= Set and display bonds =======")
-                self.bonds = pf.Bonds(self.sites, self.maxlength)
-
-                for b in self.bonds.members:
-                    y1 = b.coords()[0][0]
-                    x1 = b.coords()[0][1]
-                    y2 = b.coords()[1][0]
-                    x2 = b.coords()[1][1]
-                    # shorten the display of the bond
-                    w = (1 - self.drawn_fraction) / 2 # weight of the other position
-                    #TODO: This does not work exact. Swift issue?
-                    y1 = y1*(1-w) + y2*w
-                    x1 = x1*(1-w) + x2*w
-                    y2 = y1*w + y2*(1-w)
-                    x2 = x1*w + x2*(1-w)
-                    # scale
-                    y1 /= shape[0]
-                    y2 /= shape[0]
-                    x1 /= shape[1]
-                    x2 /= shape[1]
-                    self.processed_data_item.add_line_region(y1, x1, y2, x2)
-        self.t2 = threading.Thread(target = thread_this, name = 'dothat')
-        self.t2.start()
+            print("======= Display bonds =======")
+            self.update_display()
+        self.jobs.submit('bonds', thread_this, depends=(self.jobs.active('maxima'),))
     
     # Auto-detect and display sources
     def auto_detect_sources(self):
-        maxima = self.picobj.maxima[-1] #TODO see above
-        self.picobj.detect_substitutionals()
-        indx_foreigns = self.picobj.indx_substitutionals[-1] #TODO change array-behavior
-        print("indices foreigns  " + str(indx_foreigns))
+        if self.lattice is None and not self.jobs.is_busy('bonds'):
+            print("Aborted! Set sites and bonds first.")
+            return
         
-        shape = self.processed_data_item.xdata.data_shape
-        ellipse_relative_size = 0.05
-        for i in indx_foreigns:
-            loc = maxima[i] #TODO: probably change to self.sites[i].coords
-            #TODO: rework!!! unsure if correct point_graphics is taken
-            thisatom = pf.Atom(self.sites[i], 'dummy-element')
-            self.sources = np.append(self.sources, thisatom)
-            reg = self.processed_data_item.add_rectangle_region(
-                            loc[0]/shape[0], loc[1]/shape[1],
-                            ellipse_relative_size, ellipse_relative_size)
-                    
-            # Mutual assignment
-            reg.graphic_id = np.size(self.sources)
-            self.sources[-1].uuid_graphic = reg.uuid #TODO: see above
+        def thread_this():
+            # the features are cached, only changing the threshold costs nothing
+            features = self.pipeline.get('dopant_features')
+            indx_foreigns = dopants.classify(features, self.dopant_threshold)
+            print("indices foreigns  " + str(indx_foreigns.tolist()))
+            self.lattice.add_sources(np.setdiff1d(indx_foreigns, self.lattice.sources))
+            self.update_display()
+        
+        self.jobs.submit('sources', thread_this, depends=(self.jobs.active('bonds'),), supersede=False)
             
     # Add sources
     def add_sources(self, selection):
-        if self.processed_data_item is None:
-            print("Aborted! Determine maxima first.")
-            return
-        if self.t3 is not None and self.t3.is_alive():
-            print('Still working. Wait until finished.')
+        if self.lattice is None and not self.jobs.is_busy('bonds'):
+            print("Aborted! Set sites and bonds first.")
             return
         
         def thread_this():
-            if self.sources is None:
-                self.sources = np.array([])
-            
-            ellipse_relative_size = 0.05
-            for s in selection:
-                loc = s.position
-                thisatom = pf.Atom(self.sites[eval(s.graphic_id)], 'dummy-element')
-                self.sources = np.append(self.sources, thisatom) 
-                reg = self.processed_data_item.add_rectangle_region(
-                        loc[0], loc[1],
-                        ellipse_relative_size, ellipse_relative_size)
-                
-                # Mutual assignment
-                reg.graphic_id = np.size(self.sources) #TODO: attribute graphic_id is abused
-                self.sources[-1].uuid_graphic = reg.uuid #TODO: see above
+            indices = [self.site_index_of(s) for s in selection]
+            self.lattice.add_sources(indices)
+            self.update_display()
                 
-        self.t3 = threading.Thread(target = thread_this)
-        self.t3.start()
+        self.jobs.submit('sources', thread_this, depends=(self.jobs.active('bonds'),), supersede=False)
         
     # Add targets
     def add_targets(self, selection):
-        if self.processed_data_item is None:
-            print("Aborted! Determine maxima first.")
-            return
-        if self.t4 is not None and self.t4.is_alive():
-            print('Still working. Wait until finished.')
+        if self.lattice is None and not self.jobs.is_busy('bonds'):
+            print("Aborted! Set sites and bonds first.")
             return
         
         def thread_this():
-            if self.targets is None:
-                self.targets = np.array([])
-            
-            ellipse_relative_size = 0.05
-            for s in selection:
-                loc = s.position
-                idx_site = eval(s.graphic_id)
-                thissite = self.sites[idx_site]
-                self.targets = np.append(self.targets, thissite)
-                reg = self.processed_data_item.add_ellipse_region(
-                        loc[0], loc[1],
-                        ellipse_relative_size, ellipse_relative_size)
-                
-                # Mutual assignment
-                reg.graphic_id = idx_site #TODO: attribute graphic_id is abused
-                #TODO: not sure whether idx of self.targets-array or self.sites-array should be taken
-                self.targets[-1].uuid_graphic = reg.uuid #TODO: see above
+            indices = [self.site_index_of(s) for s in selection]
+            self.lattice.add_targets(indices)
+            self.update_display()
                 
-        self.t4 = threading.Thread(target = thread_this)
-        self.t4.start()  
+        self.jobs.submit('targets', thread_this, depends=(self.jobs.active('bonds'),), supersede=False)
     
     # Path finding
     def find_paths(self):
-        if (self.sources is None) or (self.targets is None):
+        pending = [self.jobs.active(slot) for slot in ('bonds', 'sources', 'targets')]
+        if not any(pending) and ((self.lattice is None) or len(self.lattice.sources) == 0
+                                 or len(self.lattice.targets) == 0):
             print("Aborted! Set sources and targets.")
             return
-        if self.t5 is not None and self.t5.is_alive():
-            print('Still working. Wait until finished.')
-            return
         
         def thread_this():
+            if (self.lattice is None) or len(self.lattice.sources) == 0 or len(self.lattice.targets) == 0:
+                print("Aborted! Set sources and targets.")
+                return
+            self.pipeline.set_param('sources', tuple(self.lattice.sources))
+            self.pipeline.set_param('targets', tuple(self.lattice.targets))
+            self.pipeline.set_param('objective', 'makespan' if self.minimise_makespan else 'sum')
             try:
-                print(len(self.sources))
-                print(len(self.targets))
-                self.paths = pf.MultiplePaths_NoOverlap(self.sources, self.targets)
+                _, _, jumps = self.pipeline.get('assignment')
+                print("Expected number of jumps: {:.0f} in total, {:.0f} for the longest path".format(
+                                                                        jumps.sum(), jumps.max()))
+                self.lattice.paths = self.pipeline.get('paths')
             except ValueError as e:
                 print(e)
-                return
-            else:
-                self.paths.determine_paths()
-        self.t5 = threading.Thread(target = thread_this)
-        self.t5.start()
+        self.jobs.submit('paths', thread_this, depends=pending)
         
-    # Auto-Manipulator
+    # Auto-Manipulator, stopped by cancelling its job
     def call_auto_manipulator(self):
+        if self.jobs.is_busy('manipulator'):
+            print('Auto-Manipulator is running. Stop it first.')
+            return
         def thread_that():
+            job = jobs.current()
             try:
-                am.AM(self.paths, self.api)
                 logging.info("Calling Auto-Manipulator...")
+                # drift is measured from the frame the lattice was detected in,
+                # an earlier run on this lattice has already moved it
+                previous = self.auto_manipulator
+                shift = previous.drift_shift() if previous is not None and previous.lattice is self.lattice else None
+                self.auto_manipulator = am.AutoManipulator(self.lattice, self.__api, self.dc,
+                                                           streaming=self.streaming, sigma=self.sigma,
+                                                           image_feedback=self.image_feedback,
+                                                           reference=self.source_data_item.data,
+                                                           reference_shift=shift)
+                job.add_cancel_callback(self.auto_manipulator.stop)
+                self.auto_manipulator.run(stop_event=job.cancel_event)
             except:
                 logging.info("Error #002")
-        self.t6 = threading.Thread(target = thread_that)
-        self.t6.start()
+        self.jobs.submit('manipulator', thread_that, depends=(self.jobs.active('paths'),))
+        
+    def stop_auto_manipulator(self):
+        self.jobs.cancel('manipulator')
+        
+    # Session: blurred image, maxima and lattice of the source data item on disk,
+    # keyed by its uuid and data
+    def session_path(self):
+        return session.session_path(self.session_directory, self.source_data_item.uuid,
+                                    detection.frame_key(self.source_data_item.data))
+        
+    def save_session(self):
+        if self.maxima is None:
+            print("Aborted! Determine maxima first.")
+            return
+        
+        def thread_this():
+            t = time.time()
+            params = dict(sigma=self.sigma, noise_tolerance=self.noise_tolerance,
+                          maxlength=self.maxlength, drawn_fraction=self.drawn_fraction)
+            try:
+                session.save(self.session_path(), params, self.blurred, self.maxima, self.lattice)
+            except OSError as e:
+                print("Could not save the session: {}".format(e))
+                return
+            logging.info("Session saved after {:.2f} s".format(time.time() - t))
+        self.jobs.submit('session', thread_this, supersede=False)
         
-    # Conceptional plot
+    def load_session(self):
+        if self.source_data_item is None:
+            print("No data item selected.")
+            return
+        
+        def thread_this():
+            t = time.time()
+            restored = session.load(self.session_path())
+            if restored is None or restored.maxima is None:
+                print("No saved session for this data item.")
+                return
+            self.sigma = restored.params['sigma']
+            self.noise_tolerance = restored.params['noise_tolerance']
+            self.maxlength = restored.params['maxlength']
+            self.drawn_fraction = restored.params['drawn_fraction']
+            self.show_params()
+            
+            # The restored values become the pipeline results for the current
+            # parameters, so that nothing is recomputed
+            self.update_params()
+            self.pipeline.invalidate()
+            if restored.blurred is not None:
+                self.pipeline.put('blurred', restored.blurred)
+            self.blurred = self.pipeline.get('blurred')
+            self.pipeline.put('maxima', restored.maxima)
+            self.maxima = restored.maxima
+            self.lattice = restored.lattice
+            if self.lattice is not None:
+                self.pipeline.put('sites', self.lattice.coords)
+                self.pipeline.put('lattice', self.lattice)
+                self.lattice_sites_version = (self.pipeline.version('sites'), self.ideal_lattice)
+            logging.info("Session loaded after {:.2f} s".format(time.time() - t))
+            self.update_display()
+        # the restored results replace whatever is being computed
+        self.jobs.cancel('maxima')
+        self.jobs.cancel('bonds')
+        self.jobs.submit('session', thread_this, supersede=False)
+        
+    # Time spent per stage so far, also written as Chrome trace (chrome://tracing)
+    def show_timings(self):
+        print("Timings:\n" + instrumentation.summary())
+        path = os.path.join(self.trace_directory, time.strftime("trace-%Y%m%d-%H%M%S.json"))
+        try:
+            instrumentation.export_chrome_trace(path)
+            print("Trace written to " + path)
+        except OSError as e:
+            print("Could not write the trace: {}".format(e))
+        
+    # Conceptional plot, rendered off-screen in a job and shown as an RGB data item
+    # (pyplot windows only work in the main thread)
     def open_conceptional_plot(self):
-        def pfplt_func():
-            fig = plt.figure() # 57 = pf
+        if self.lattice is None and not self.jobs.is_busy('bonds'):
+            print("Aborted! Set sites and bonds first.")
+            return
+        def plot_func():
+            lat = self.lattice
+            fig = Figure(figsize=(8, 8), dpi=100)
+            canvas = FigureCanvasAgg(fig)
             ax = fig.add_subplot(1, 1, 1)
-            pfplt.plt_sites(ax, self.sites)
-            pfplt.plt_bonds(ax, self.bonds)
-            pfplt.plt_sources(ax, self.sources)
-            pfplt.plt_targets(ax, self.targets)
-            plt.gca().invert_yaxis()
-            try:
-                plt.show()
-            except:
-                pass
-        pfplt_func() # This does only work in the main thread !
-        print("Opening conceptional plot finished.")
+            # sites and bonds
+            ax.plot(lat.coords[:, 1], lat.coords[:, 0], 'kx')
+            ax.add_collection(LineCollection(lat.coords[lat.bonds][..., ::-1],
+                                             colors="red", linestyles="dotted", alpha=0.4))
+            # sources and targets
+            ax.plot(lat.coords[lat.sources, 1], lat.coords[lat.sources, 0], 'o', mfc="none", ms=10)
+            ax.plot(lat.coords[lat.targets, 1], lat.coords[lat.targets, 0], 'bo', mfc="1", ms=20, alpha=0.5)
+            # paths
+            for i, path in enumerate(lat.paths):
+                jobs.checkpoint("drawing paths", i / len(lat.paths))
+                ax.plot(lat.coords[path, 1], lat.coords[path, 0], lw=2, label="Path %d" % i)
+            ax.axis('equal')
+            ax.invert_yaxis()
+            canvas.draw()
+            rgb = np.array(canvas.buffer_rgba())[..., :3]
+            xdata = self.__api.create_data_and_metadata(rgb)
+            title = 'Conceptional plot'
+            if self.source_data_item is not None:
+                title += ' of ' + self.source_data_item.title
+            def show():
+                self.dc.create_data_item_from_data_and_metadata(xdata, title=title)
+                print("Opening conceptional plot finished.")
+            self.__api.queue_task(show)
+        self.jobs.submit('plot', plot_func, depends=[self.jobs.active(slot) for slot in ('bonds', 'paths')])
         
 
 class AtomManipExtension(object):
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk overlay rendering for the processed data item.
+
+Instead of adding one Swift graphic per maximum, all markers are burnt into an
+RGB composite of the filtered image. Swift expects RGB data as uint8 arrays of
+shape (height, width, 3) in BGR channel order.
+"""
+
+# standard libraries
+import numpy as np
+
+# Colors as (R, G, B)
+MAXIMA_COLOR = (255, 40, 40)
+BOND_COLOR = (255, 200, 0)
+
+
+def grey_to_rgb(image, clip_percentiles=(0.5, 99.5)):
+    """Convert a 2D image to a grey uint8 BGR array with robust contrast."""
+    image = np.asarray(image)
+    # the contrast limits are estimated on at most ~1M pixels
+    step = max(1, int(np.sqrt(image.size / 1e6)))
+    lo, hi = np.percentile(image[::step, ::step], clip_percentiles)
+    if hi <= lo:
+        hi = lo + 1
+    grey = np.empty(image.shape, dtype=np.float32)
+    np.subtract(image, lo, out=grey, casting='unsafe')
+    grey *= 255 / (hi - lo)
+    np.clip(grey, 0, 255, out=grey)
+    return np.repeat(grey.astype(np.uint8)[..., np.newaxis], 3, axis=2)
+
+
+def _set_pixels(rgb, ys, xs, color):
+    inside = (ys >= 0) & (ys < rgb.shape[0]) & (xs >= 0) & (xs < rgb.shape[1])
+    rgb[ys[inside], xs[inside]] = color[::-1] # BGR
+
+
+def draw_points(rgb, coords, color=MAXIMA_COLOR, radius=2):
+    """Stamp a filled disk of the given radius at every (y, x) in coords."""
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    if len(coords) == 0:
+        return rgb
+    r = int(np.ceil(radius))
+    dy, dx = np.mgrid[-r:r+1, -r:r+1]
+    disk = dy**2 + dx**2 <= radius**2
+    dy = dy[disk]
+    dx = dx[disk]
+    centers = np.rint(coords).astype(np.intp)
+    ys = (centers[:, 0, np.newaxis] + dy).ravel()
+    xs = (centers[:, 1, np.newaxis] + dx).ravel()
+    _set_pixels(rgb, ys, xs, color)
+    return rgb
+
+
+def draw_segments(rgb, starts, ends, color=BOND_COLOR):
+    """Rasterize all line segments from starts[i] to ends[i] (both (y, x)) at once."""
+    starts = np.asarray(starts, dtype=float).reshape(-1, 2)
+    ends = np.asarray(ends, dtype=float).reshape(-1, 2)
+    if len(starts) == 0:
+        return rgb
+    n = int(np.ceil(np.max(np.abs(ends - starts)))) + 1
+    t = np.linspace(0, 1, n)[np.newaxis, :, np.newaxis]
+    points = starts[:, np.newaxis, :] * (1 - t) + ends[:, np.newaxis, :] * t
+    points = np.rint(points.reshape(-1, 2)).astype(np.intp)
+    _set_pixels(rgb, points[:, 0], points[:, 1], color)
+    return rgb
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Lazily evaluated, dependency tracked processing pipeline.
+
+A stage is recomputed only if one of its parameters or one of the stages it
+depends on changed since it was last computed. Parameters are compared by a
+key (by default the value itself, e.g. a data hash for image data).
+
+checkpoint(name), if given, is called before a stage is computed, e.g. to
+report progress or to stop a cancelled job between stages.
+"""
+
+# standard libraries
+import itertools
+import threading
+
+
+class Pipeline:
+    """
+    Stages are computed without holding the lock of the pipeline, so reading
+    parameters, versions or current results from another thread (e.g. the UI)
+    does not wait for a slow stage. Every stage has a lock of its own, so
+    a stage requested by two threads at once is only computed once.
+    """
+
+    def __init__(self, checkpoint=None):
+        self.checkpoint = checkpoint
+        self._params = dict() # name -> (value, key)
+        self._stages = dict() # name -> (func, depends, params)
+        self._results = dict() # name -> (key, version, value)
+        self._stage_locks = dict() # name -> lock held while the stage is computed
+        self._lock = threading.RLock()
+        self._versions = itertools.count()
+
+    def add_stage(self, name, func, depends=(), params=()):
+        """func is called with the values of the depends stages followed by the params."""
+        self._stages[name] = (func, tuple(depends), tuple(params))
+        self._stage_locks[name] = threading.Lock()
+
+    def set_param(self, name, value, key=None):
+        """Set a parameter, returns True if its key changed."""
+        key = value if key is None else key
+        with self._lock:
+            changed = name not in self._params or self._params[name][1] != key
+            self._params[name] = (value, key)
+        return changed
+
+    def param(self, name):
+        return self._params[name][0]
+
+    def _key(self, name):
+        func, depends, params = self._stages[name]
+        return (tuple(self._results[d][1] if d in self._results else None for d in depends),
+                tuple(self._params[p][1] for p in params))
+
+    def is_current(self, name):
+        """True if get(name) would return the cached value without recomputation."""
+        with self._lock:
+            depends = self._stages[name][1]
+            return (name in self._results and all(self.is_current(d) for d in depends)
+                    and self._results[name][0] == self._key(name))
+
+    def get(self, name):
+        return self._get(name)[1]
+
+    def _get(self, name):
+        """(version, value) of a stage, computed from the upstream results it was called with."""
+        func, depends, params = self._stages[name]
+        upstream = [self._get(d) for d in depends]
+        with self._stage_locks[name]:
+            with self._lock:
+                key = (tuple(version for version, _ in upstream), tuple(self._params[p][1] for p in params))
+                values = [self._params[p][0] for p in params]
+                cached = self._results.get(name)
+                if cached is not None and cached[0] == key:
+                    return cached[1], cached[2]
+            if self.checkpoint is not None:
+                self.checkpoint(name)
+            value = func(*(result for _, result in upstream), *values)
+            with self._lock:
+                version = next(self._versions)
+                self._results[name] = (key, version, value)
+            return version, value
+
+    def put(self, name, value):
+        """Store value as the result of a stage for the current inputs, e.g. when restored from disk."""
+        with self._lock:
+            self._results[name] = (self._key(name), next(self._versions), value)
+
+    def version(self, name):
+        """Changes every time the stage is recomputed (None if never computed)."""
+        result = self._results.get(name)
+        return result[1] if result is not None else None
+
+    def invalidate(self, name=None):
+        with self._lock:
+            if name is None:
+                self._results.clear()
+            else:
+                self._results.pop(name, None)
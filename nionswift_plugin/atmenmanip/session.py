@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Saving and loading of the analysis state of a data item.
+
+A session is a directory of .npy files (blurred image, maxima, sites, bonds
+with their CSR adjacency, sources, targets and paths) and a JSON manifest,
+named after the uuid of the source data item and a hash of its data. The
+arrays are memory-mapped when a session is loaded, so that reloading takes
+milliseconds instead of detecting the lattice again. Paths are stored as one
+concatenated site index array and the offsets of the paths in it.
+"""
+
+# standard libraries
+import json
+import os
+import shutil
+import numpy as np
+
+# local libraries
+from . import lattice
+
+MANIFEST = "session.json"
+VERSION = 1
+
+
+def session_path(directory, uuid, data_key):
+    return os.path.join(directory, "{}-{}".format(uuid, data_key))
+
+
+def pack_paths(paths):
+    """Concatenated site indices and the (len(paths) + 1) offsets of the paths."""
+    offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+    np.cumsum([len(path) for path in paths], out=offsets[1:])
+    sites = np.concatenate([np.asarray(path, dtype=np.int32) for path in paths]) if paths else \
+            np.empty(0, dtype=np.int32)
+    return sites, offsets
+
+
+def unpack_paths(sites, offsets):
+    return [sites[offsets[i]:offsets[i+1]] for i in range(len(offsets) - 1)]
+
+
+class Session:
+    """Analysis state restored from disk, arrays that were not saved are None."""
+
+    def __init__(self, params, blurred=None, maxima=None, lattice=None):
+        self.params = params
+        self.blurred = blurred
+        self.maxima = maxima
+        self.lattice = lattice
+
+
+def save(path, params, blurred=None, maxima=None, lat=None):
+    """
+    Write a session to the directory path, replacing an older one.
+
+    params is a dict of JSON serialisable values (sigma, noise tolerance, ...).
+    The session is written next to path first and only then moved in place,
+    so an interrupted save never leaves a broken session behind.
+    """
+    arrays = dict()
+    if blurred is not None:
+        arrays['blurred'] = np.asarray(blurred, dtype=np.float32)
+    if maxima is not None:
+        arrays['maxima'] = np.asarray(maxima, dtype=np.float32).reshape(-1, 2)
+    if lat is not None:
+        arrays['coords'] = lat.coords
+        arrays['bonds'] = lat.bonds
+        arrays['indptr'] = lat.indptr
+        arrays['indices'] = lat.indices
+        arrays['sources'] = lat.sources
+        arrays['targets'] = lat.targets
+        arrays['path_sites'], arrays['path_offsets'] = pack_paths(lat.paths)
+
+    partial = path + ".partial"
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    for name, array in arrays.items():
+        np.save(os.path.join(partial, name + ".npy"), np.ascontiguousarray(array))
+    with open(os.path.join(partial, MANIFEST), 'w') as f:
+        json.dump({'version': VERSION, 'params': params, 'arrays': sorted(arrays)}, f, indent=1)
+
+    # the old session may still be memory-mapped, it is moved away before deleting it
+    if os.path.exists(path):
+        old = path + ".old"
+        shutil.rmtree(old, ignore_errors=True)
+        os.rename(path, old)
+        os.rename(partial, path)
+        shutil.rmtree(old, ignore_errors=True)
+    else:
+        os.rename(partial, path)
+
+
+def load(path):
+    """
+    Session saved in the directory path, None if there is none.
+
+    Arrays are memory-mapped copy-on-write: changes (e.g. drift correction of
+    the sites) stay in memory and do not alter the saved session.
+    """
+    try:
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != VERSION:
+        return None
+    arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode='c') for name in manifest['arrays']}
+
+    lat = None
+    if 'coords' in arrays:
+        lat = lattice.Lattice(arrays['coords'], arrays['bonds'], csr=(arrays['indptr'], arrays['indices']))
+        lat.sources = arrays['sources']
+        lat.targets = arrays['targets']
+        lat.paths = unpack_paths(arrays['path_sites'], arrays['path_offsets'])
+    return Session(manifest['params'], arrays.get('blurred'), arrays.get('maxima'), lat)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated STEM and jump feedback for running the Auto-Manipulator offline.
+
+SimulatedSample holds a lattice taken from a real image (e.g. the demo
+frames) and a set of dopant sites. SimulatedSTEM renders noisy frames of it,
+SimulatedFeedback moves dopants that sit next to the probe at random times
+and reports "j", "d" or "to" like the Keithley does.
+"""
+
+# standard libraries
+import time
+import threading
+import numpy as np
+
+# third party libraries
+from scipy import ndimage
+
+# local libraries
+from . import devices
+from . import detection
+from . import lattice as lat
+
+
+class XData:
+    """Minimal stand-in for a Swift DataAndMetadata."""
+
+    def __init__(self, data, metadata=None):
+        self.data = data
+        self.metadata = metadata if metadata is not None else dict()
+
+    @property
+    def data_shape(self):
+        return self.data.shape
+
+
+class SimulatedSample:
+
+    def __init__(self, lattice, shape, dopants, sigma=3.0, seed=None):
+        self.lattice = lattice
+        self.shape = tuple(shape)
+        self.dopants = np.asarray(dopants, dtype=np.int32)
+        self.sigma = sigma
+        self.drift = np.zeros(2)
+        self.probe = np.zeros(2)
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_image(cls, image, sigma, noise_tolerance, maxlength, number_dopants=5, seed=None):
+        """Lattice of the maxima of a real image, dopants are placed on random fully bonded sites."""
+        image = np.asarray(image)
+        _, maxima = detection.detect_maxima(image, sigma, noise_tolerance)
+        # maxima right at the frame border are artefacts of the blur
+        inside = np.all((maxima >= sigma) & (maxima < np.array(image.shape) - sigma), axis=1)
+        lattice = lat.Lattice.from_maxima(maxima[inside], maxlength)
+        degrees = lattice.degrees()
+        bulk = np.flatnonzero(degrees == degrees.max())
+        rng = np.random.default_rng(seed)
+        dopants = rng.choice(bulk, size=min(number_dopants, len(bulk)), replace=False)
+        return cls(lattice, image.shape, dopants, sigma=sigma / 3, seed=seed)
+
+    def site_positions(self):
+        return self.lattice.coords + self.drift
+
+    def render(self, dose=50.0):
+        """Poisson-noise frame: carbon sites weight 1, dopants weight 2."""
+        weights = np.ones(len(self.lattice), dtype=np.float32)
+        with self.lock:
+            weights[self.dopants] = 2
+            positions = self.site_positions()
+        # every site is split over its four nearest pixels, so the drift is not rounded to whole pixels
+        corner = np.floor(positions).astype(np.intp)
+        fraction = (positions - corner).astype(np.float32)
+        image = np.zeros(self.shape, dtype=np.float32)
+        for dy in (0, 1):
+            for dx in (0, 1):
+                y, x = corner[:, 0] + dy, corner[:, 1] + dx
+                inside = (y >= 0) & (y < self.shape[0]) & (x >= 0) & (x < self.shape[1])
+                weight = (fraction[:, 0] if dy else 1 - fraction[:, 0]) * (fraction[:, 1] if dx else 1 - fraction[:, 1])
+                np.add.at(image, (y[inside], x[inside]), (weights * weight)[inside])
+        image = ndimage.gaussian_filter(image, self.sigma) * (2 * np.pi * self.sigma**2)
+        return self.rng.poisson(image * dose + 1).astype(np.float32) / dose
+
+    def probed_site(self):
+        """Index of the site nearest to the probe."""
+        positions = self.site_positions()
+        return int(np.argmin(np.sum((positions - self.probe)**2, axis=1)))
+
+
+class SimulatedSTEM(devices.ScanDevice):
+    """
+    Renders a frame of the sample per record().
+
+    With physics (a SimulatedFeedback), every frame takes frame_duration
+    seconds of simulated beam time in which the dopants may jump, so that the
+    jumps can be seen in the frames (jump_detector).
+    """
+
+    def __init__(self, sample, frame_time=0.0, dose=50.0, physics=None, frame_duration=1.0):
+        self.sample = sample
+        self.frame_time = frame_time
+        self.dose = dose
+        self.physics = physics
+        self.frame_duration = frame_duration
+
+    def record(self):
+        if self.frame_time:
+            time.sleep(self.frame_time)
+        if self.physics is not None:
+            self.physics.advance(self.frame_duration)
+        return [XData(self.sample.render(self.dose))]
+
+    def grab_next_to_finish(self):
+        return self.record()
+
+    @property
+    def probe_position(self):
+        return tuple(self.sample.probe)
+
+    def set_probe_target(self, y, x):
+        with self.sample.lock:
+            self.sample.probe = np.array((y, x), dtype=float)
+
+
+class SimulatedFeedback(devices.FeedbackDevice):
+    """
+    Poisson process of jumps and drift events.
+
+    A dopant next to the probed site jumps with jump_rate (1/s). With
+    probability misjump_probability it lands on another neighbour instead of
+    the probed site. Drift events shift the sample by drift_step pixels.
+    time_scale scales the simulated waiting time into real sleeping time
+    (0 runs as fast as possible).
+    """
+
+    def __init__(self, sample, jump_rate=0.5, drift_rate=0.01, misjump_probability=0.1,
+                 drift_step=2.0, time_scale=0.0):
+        self.sample = sample
+        self.jump_rate = jump_rate
+        self.drift_rate = drift_rate
+        self.misjump_probability = misjump_probability
+        self.drift_step = drift_step
+        self.time_scale = time_scale
+        self.simulated_time = 0.0
+        self.jumps = 0
+
+    def advance(self, timeout):
+        """Simulate until the next event or timeout, returns the feedback and the simulated time taken."""
+        sample = self.sample
+        with sample.lock:
+            probed = sample.probed_site()
+            neighbours = sample.lattice.neighbours(probed)
+            pulling = [d for d in np.flatnonzero(np.isin(sample.dopants, neighbours))]
+            jump_rate = self.jump_rate if pulling and probed not in sample.dopants else 0.0
+            total_rate = jump_rate + self.drift_rate
+            wait = sample.rng.exponential(1 / total_rate) if total_rate > 0 else np.inf
+            if wait > timeout:
+                feedback, wait = "to", timeout
+            elif sample.rng.random() < jump_rate / total_rate:
+                # with several dopants next to the probe, either one may jump
+                i = sample.rng.choice(pulling)
+                destination = probed
+                if sample.rng.random() < self.misjump_probability:
+                    choices = [n for n in sample.lattice.neighbours(sample.dopants[i])
+                               if n != probed and n not in sample.dopants]
+                    if choices:
+                        destination = sample.rng.choice(choices)
+                sample.dopants[i] = destination
+                self.jumps += 1
+                feedback = "j"
+            else:
+                sample.drift += sample.rng.normal(size=2) * self.drift_step
+                feedback = "d"
+        self.simulated_time += wait
+        return feedback, wait
+
+    def waitforjump(self, timeout):
+        feedback, wait = self.advance(timeout)
+        if self.time_scale:
+            time.sleep(wait * self.time_scale)
+        return feedback
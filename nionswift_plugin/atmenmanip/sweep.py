@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Parameter sweep over sigma, noise tolerance and max. bond length on a frame.
+
+Every combination is scored by the regularity of the lattice it gives: the
+fraction of 3-coordinated sites (graphene) away from the frame border and the
+spread of the bond lengths. The blur is computed once per sigma and shared by
+all noise tolerances, the maxima once per (sigma, noise tolerance) and shared
+by all bond lengths, for which the neighbour pairs are found once at the
+largest length and then only filtered.
+
+Either the full grid is evaluated (grid) or only the most promising points of
+it, chosen by a Gaussian process with expected improvement (bayesian).
+"""
+
+# standard libraries
+import os
+import math
+import threading
+import collections
+import concurrent.futures
+import numpy as np
+
+# third party libraries
+from scipy import special
+from scipy.spatial import cKDTree
+
+# local libraries
+from . import detection
+
+
+def lattice_quality(coords, bonds, shape, margin):
+    """
+    Quality metrics of the lattice given by sites and bonds.
+
+    Only sites at least margin (the max. bond length) from the frame border
+    are counted, the others are missing neighbours outside the frame.
+    score = fraction of 3-coordinated sites * (1 - relative spread of the bond lengths).
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    degrees = np.bincount(bonds.ravel(), minlength=len(coords))
+    interior = np.all((coords >= margin) & (coords < np.array(shape) - margin), axis=1)
+    histogram = np.bincount(np.minimum(degrees[interior], 6), minlength=7)
+    lengths = np.linalg.norm(coords[bonds[:, 0]] - coords[bonds[:, 1]], axis=1)
+    fraction_three = histogram[3] / histogram.sum() if histogram.sum() else 0.0
+    spread = lengths.std() / lengths.mean() if len(lengths) else 1.0
+    return dict(number_sites=len(coords), number_bonds=len(bonds), degree_histogram=histogram,
+                fraction_three=float(fraction_three), bond_length=float(lengths.mean()) if len(lengths) else 0.0,
+                bond_length_spread=float(spread), score=float(fraction_three * max(0.0, 1 - spread)))
+
+
+class Sweep:
+    """
+    Evaluation of detection parameters on one frame, with the blurred images
+    and maxima cached for the points that follow.
+
+    Evaluations run in a thread pool (the filters release the GIL), at most
+    max_blurred blurred frames are kept.
+    """
+
+    def __init__(self, image, tile_size=1024, workers=None, max_blurred=4):
+        self.image = np.asarray(image)
+        self.tile_size = tile_size
+        self.workers = workers or os.cpu_count() or 1
+        self.max_blurred = max_blurred
+        self.engine = detection.BlurEngine()
+        self._blurred = collections.OrderedDict() # sigma -> blurred image
+        self._maxima = dict() # (sigma, noise_tolerance) -> maxima
+        self._pairs = dict() # (sigma, noise_tolerance) -> (maxlength, pairs, lengths)
+        self._locks = collections.defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def _cached(self, cache, key, compute):
+        with self._lock:
+            lock = self._locks[(id(cache), key)]
+        # only one thread computes a value, the others wait for it
+        with lock:
+            if key in cache:
+                return cache[key]
+            value = compute()
+            with self._lock:
+                cache[key] = value
+                if cache is self._blurred:
+                    while len(cache) > self.max_blurred:
+                        cache.popitem(last=False)
+            return value
+
+    def blurred(self, sigma):
+        def compute():
+            if max(self.image.shape) > self.tile_size:
+                return detection.blur_tiled(self.image, sigma, tile_size=self.tile_size, workers=1,
+                                            engine=self.engine)
+            return self.engine.blur(self.image, sigma)
+        return self._cached(self._blurred, sigma, compute)
+
+    def maxima(self, sigma, noise_tolerance):
+        # the panel's detector, so the best parameters mean the same there
+        return self._cached(self._maxima, (sigma, noise_tolerance), lambda: detection.frame_maxima(
+                            self.image, self.blurred(sigma), sigma, noise_tolerance, self.tile_size, workers=1))
+
+    def pairs(self, sigma, noise_tolerance, maxlength):
+        """All pairs of maxima closer than maxlength and their distances."""
+        key = (sigma, noise_tolerance)
+        cached = self._pairs.get(key)
+        if cached is None or cached[0] < maxlength:
+            coords = self.maxima(sigma, noise_tolerance).astype(float)
+            pairs = cKDTree(coords).query_pairs(maxlength, output_type='ndarray').astype(np.int32)
+            lengths = np.linalg.norm(coords[pairs[:, 0]] - coords[pairs[:, 1]], axis=1)
+            cached = self._pairs[key] = (maxlength, pairs, lengths)
+        _, pairs, lengths = cached
+        return pairs[lengths <= maxlength]
+
+    def evaluate(self, sigma, noise_tolerance, maxlength):
+        bonds = self.pairs(sigma, noise_tolerance, maxlength)
+        result = lattice_quality(self.maxima(sigma, noise_tolerance), bonds, self.image.shape, maxlength)
+        result.update(sigma=sigma, noise_tolerance=noise_tolerance, maxlength=maxlength)
+        return result
+
+    def _evaluate_all(self, points):
+        """Results of a list of (sigma, noise tolerance, maxlength), in the same order."""
+        # the bond lengths of one (sigma, noise tolerance) are evaluated together, largest first
+        groups = collections.defaultdict(list)
+        for point in points:
+            groups[point[:2]].append(point[2])
+        def evaluate_group(key):
+            return [self.evaluate(*key, maxlength) for maxlength in sorted(groups[key], reverse=True)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = {(r['sigma'], r['noise_tolerance'], r['maxlength']): r
+                       for group in executor.map(evaluate_group, groups) for r in group}
+        return [results[tuple(point)] for point in points]
+
+    def grid(self, sigmas, noise_tolerances, maxlengths):
+        """Results (dicts of parameters and metrics) of all combinations, best first."""
+        points = [(s, n, m) for s in sigmas for n in noise_tolerances for m in maxlengths]
+        return sorted(self._evaluate_all(points), key=lambda r: -r['score'])
+
+    def bayesian(self, sigmas, noise_tolerances, maxlengths, number_evaluations=25, number_initial=None,
+                 seed=0):
+        """
+        Results of the number_evaluations most promising grid points, best first.
+
+        After number_initial random points, batches of one point per worker
+        are chosen by expected improvement under a Gaussian process fitted to
+        the scores so far (the batch is filled assuming the predicted scores).
+        """
+        points = [(s, n, m) for s in sigmas for n in noise_tolerances for m in maxlengths]
+        features = normalised_features(points)
+        rng = np.random.default_rng(seed)
+        number_evaluations = min(number_evaluations, len(points))
+        number_initial = min(number_initial or max(self.workers, 5), number_evaluations)
+        chosen = list(rng.choice(len(points), number_initial, replace=False))
+        results = self._evaluate_all([points[i] for i in chosen])
+        scores = [r['score'] for r in results]
+        while len(chosen) < number_evaluations:
+            batch = []
+            believed = list(scores)
+            for _ in range(min(self.workers, number_evaluations - len(chosen))):
+                candidates = np.setdiff1d(np.arange(len(points)), chosen + batch)
+                mean, std = gp_predict(features[chosen + batch], np.array(believed), features[candidates])
+                best = candidates[np.argmax(expected_improvement(mean, std, max(believed)))]
+                batch.append(int(best))
+                believed.append(float(mean[candidates == best][0]))
+            batch_results = self._evaluate_all([points[i] for i in batch])
+            chosen += batch
+            results += batch_results
+            scores += [r['score'] for r in batch_results]
+        return sorted(results, key=lambda r: -r['score'])
+
+
+def normalised_features(points):
+    """Points scaled to [0, 1] per parameter, sigma and noise tolerance on a log scale."""
+    points = np.array(points, dtype=float)
+    x = np.column_stack((np.log(points[:, 0]), np.log(points[:, 1]), points[:, 2]))
+    span = x.max(axis=0) - x.min(axis=0)
+    return (x - x.min(axis=0)) / np.where(span > 0, span, 1)
+
+
+def gp_predict(x, y, x_new, length_scale=0.3, noise=1e-4):
+    """Mean and standard deviation of a Gaussian process (RBF kernel, standardised y) at x_new."""
+    def kernel(a, b):
+        return np.exp(-0.5 * np.sum((a[:, None] - b[None]) ** 2, axis=-1) / length_scale**2)
+    offset, scale = y.mean(), y.std() or 1.0
+    factor = np.linalg.cholesky(kernel(x, x) + noise * np.eye(len(x)))
+    alpha = np.linalg.solve(factor.T, np.linalg.solve(factor, (y - offset) / scale))
+    k = kernel(x, x_new)
+    v = np.linalg.solve(factor, k)
+    mean = k.T @ alpha
+    variance = np.maximum(1 - np.sum(v**2, axis=0), 1e-12)
+    return offset + scale * mean, scale * np.sqrt(variance)
+
+
+def expected_improvement(mean, std, best):
+    z = (mean - best) / std
+    return (mean - best) * 0.5 * special.erfc(-z / math.sqrt(2)) + std * np.exp(-0.5 * z**2) / math.sqrt(2 * math.pi)
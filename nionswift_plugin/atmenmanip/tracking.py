@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Live-frame tracking for the Auto-Manipulator.
+
+Frames are consumed from a bounded queue that is filled by a grabbing thread,
+and only small windows around the sites of interest are searched for maxima.
+"""
+
+# standard libraries
+import queue
+import threading
+import numpy as np
+
+# third party libraries
+from scipy import ndimage
+
+
+class FrameStream:
+    """
+    Bounded frame queue filled by a background thread.
+
+    grab() is called repeatedly and must return a list of frames (e.g.
+    superscan.grab_next_to_finish, the acquisition has to be running, see
+    ScanDevice.start_streaming). If the consumer is too slow, the oldest
+    frames are dropped so that get() always returns recent data.
+    """
+
+    def __init__(self, grab, maxsize=2):
+        self.grab = grab
+        self.frames = queue.Queue(maxsize=maxsize)
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._produce, name='frame-stream', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _produce(self):
+        while not self._stop_event.is_set():
+            for frame in self.grab() or ():
+                while True:
+                    try:
+                        self.frames.put_nowait(frame)
+                        break
+                    except queue.Full:
+                        try:
+                            self.frames.get_nowait()
+                        except queue.Empty:
+                            pass
+
+    def clear(self):
+        while True:
+            try:
+                self.frames.get_nowait()
+            except queue.Empty:
+                return
+
+    def get_fresh(self, timeout=None):
+        """First frame that was started after this call, or None after timeout."""
+        self.clear()
+        # the frame being grabbed right now was started before
+        if self.get(timeout=timeout) is None:
+            return None
+        return self.get(timeout=timeout)
+
+    def get(self, timeout=None):
+        """Next frame, or None after timeout."""
+        try:
+            return self.frames.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def __iter__(self):
+        while not self._stop_event.is_set():
+            frame = self.get(timeout=0.1)
+            if frame is not None:
+                yield frame
+
+
+def cut_windows(image, centers, r):
+    """
+    (N, 2r+1, 2r+1) float32 stack of the windows around the centers.
+
+    Windows are shifted inwards at the frame border. Also returns the pixel
+    coordinates ys (N, k, 1) and xs (N, 1, k) of the windows.
+    """
+    k = 2 * r + 1
+    y0 = np.clip(np.rint(centers[:, 0]).astype(np.intp) - r, 0, max(image.shape[0] - k, 0))
+    x0 = np.clip(np.rint(centers[:, 1]).astype(np.intp) - r, 0, max(image.shape[1] - k, 0))
+    ys = y0[:, np.newaxis, np.newaxis] + np.arange(min(k, image.shape[0]))[np.newaxis, :, np.newaxis]
+    xs = x0[:, np.newaxis, np.newaxis] + np.arange(min(k, image.shape[1]))[np.newaxis, np.newaxis, :]
+    return image[ys, xs].astype(np.float32), ys, xs
+
+
+def relocate(image, centers, radius, sigma=None, subpixel=False):
+    """
+    Position of the brightest (blurred) pixel within radius of every center.
+
+    All windows are cut out and searched at once. Returns the new (y, x)
+    positions as an (N, 2) float array and the peak values. With subpixel,
+    the positions are the vertices of parabolas through the brightest pixel
+    and its neighbours along y and x.
+    """
+    image = np.asarray(image)
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    # windows include a margin so that the blur is not affected by their border
+    r = int(np.ceil(radius)) + (int(np.ceil(3 * sigma)) if sigma else 0)
+    windows, ys, xs = cut_windows(image, centers, r)
+    y0, x0 = ys[:, 0, 0], xs[:, 0, 0]
+    if sigma:
+        windows = ndimage.gaussian_filter(windows, (0, sigma, sigma), mode='nearest')
+    # only accept pixels within radius of the expected position
+    outside = (ys - centers[:, 0, np.newaxis, np.newaxis])**2 + (xs - centers[:, 1, np.newaxis, np.newaxis])**2 > radius**2
+    flat = np.where(outside, -np.inf, windows).reshape(len(centers), -1)
+    best = np.argmax(flat, axis=1)
+    dy, dx = np.unravel_index(best, windows.shape[1:])
+    positions = np.stack((y0 + dy, x0 + dx), axis=1).astype(float)
+    if subpixel:
+        positions += parabola_offsets(windows, dy, dx)
+    return positions, flat[np.arange(len(centers)), best]
+
+
+def parabola_offsets(windows, dy, dx):
+    """(N, 2) sub-pixel offsets of the peaks at (dy, dx) of a stack of windows, within [-0.5, 0.5]."""
+    n = np.arange(len(windows))
+    h, w = windows.shape[1:]
+    offsets = []
+    for p, lower, upper, size in ((dy, (dy - 1, dx), (dy + 1, dx), h), (dx, (dy, dx - 1), (dy, dx + 1), w)):
+        # no neighbour on one side at the window border
+        border = (p == 0) | (p == size - 1)
+        left = windows[n, np.clip(lower[0], 0, h - 1), np.clip(lower[1], 0, w - 1)].astype(np.float64)
+        center = windows[n, dy, dx].astype(np.float64)
+        right = windows[n, np.clip(upper[0], 0, h - 1), np.clip(upper[1], 0, w - 1)].astype(np.float64)
+        denominator = left - 2 * center + right
+        with np.errstate(invalid='ignore', divide='ignore'):
+            offset = np.where((denominator < 0) & ~border, 0.5 * (left - right) / denominator, 0.0)
+        offsets.append(np.clip(offset, -0.5, 0.5))
+    return np.stack(offsets, axis=1)
+
+
+class SiteTracker:
+    """Re-locates selected lattice sites in live frames and updates their coordinates in place."""
+
+    def __init__(self, lattice, radius=None, sigma=None):
+        self.lattice = lattice
+        if radius is None:
+            # less than half a bond, so that the neighbours are never picked
+            bond_lengths = np.linalg.norm(np.diff(lattice.coords[lattice.bonds], axis=1)[:, 0], axis=1)
+            radius = 0.4 * float(np.median(bond_lengths)) if len(bond_lengths) else 5.0
+        self.radius = radius
+        self.sigma = sigma if sigma is not None else radius / 2 # should match the detection sigma
+
+    def sites_near(self, *indices):
+        """The given sites and their bonded neighbours."""
+        near = [np.asarray(indices, dtype=np.int32)]
+        near.extend(self.lattice.neighbours(i) for i in indices)
+        return np.unique(np.concatenate(near))
+
+    def update(self, image, indices):
+        indices = np.asarray(indices, dtype=np.int32)
+        positions, _ = relocate(image, self.lattice.coords[indices], self.radius, self.sigma)
+        self.lattice.move_sites(indices, positions)
+        return positions
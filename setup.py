@@ -17,8 +17,10 @@ setuptools.setup(
     packages=["nionswift_plugin.atmenmanip", "atmenmanip_demo"],
     py_modules = [],
     ext_modules = [],
+    entry_points={"console_scripts": ["atmenmanip-batch=nionswift_plugin.atmenmanip.batch:main"]},
     install_requires=["dedcode_imgrecog", "dedcode_pathfind",\
                       "numpy", "scipy", "matplotlib"],
+    extras_require={"batch": ["tifffile", "pillow"]},
     license='GPLv3',
     classifiers=[
         "Development Status :: 1 - Alpha",
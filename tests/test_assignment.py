@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the assignment of targets to sources.
+"""
+
+# standard libraries
+import itertools
+
+# third party libraries
+import numpy as np
+import pytest
+
+# local libraries
+from nionswift_plugin.atmenmanip import assignment
+from nionswift_plugin.atmenmanip import lattice as lat
+
+
+def square_grid(size=6, spacing=10.0):
+    """Lattice of a square grid, the hop distance is the Manhattan distance."""
+    coords = np.stack(np.meshgrid(np.arange(size), np.arange(size), indexing='ij'), axis=-1).reshape(-1, 2) * spacing
+    return lat.Lattice(coords, lat.find_bonds(coords, 1.05 * spacing))
+
+
+def two_chains(length=5, spacing=10.0):
+    """Two unconnected chains of sites, sites 0..length-1 and length..2*length-1."""
+    coords = np.array([(row * 100.0, i * spacing) for row in (0, 1) for i in range(length)])
+    return lat.Lattice(coords, lat.find_bonds(coords, 1.05 * spacing))
+
+
+def brute_force(cost):
+    """Smallest sum and smallest largest cost over all permutations."""
+    permutations = [cost[np.arange(len(cost)), list(p)] for p in itertools.permutations(range(cost.shape[1]),
+                                                                                          len(cost))]
+    return min(p.sum() for p in permutations), min(p.max() for p in permutations)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_bottleneck_assignment_is_optimal(seed):
+    rng = np.random.default_rng(seed)
+    n = rng.integers(2, 7)
+    # few distinct values, so that there are ties
+    cost = rng.integers(0, 5, size=(n, n + rng.integers(0, 2))).astype(float)
+    rows, cols = assignment.bottleneck_assignment(cost)
+    assert len(set(cols.tolist())) == n and sorted(rows.tolist()) == list(range(n))
+    _, best_max = brute_force(cost)
+    assert cost[rows, cols].max() == best_max
+    # smallest sum among the assignments with that largest cost
+    limited = np.where(cost <= best_max, cost, np.inf)
+    assert cost[rows, cols].sum() == brute_force(limited)[0]
+
+
+def test_bottleneck_assignment_avoids_unreachable_targets():
+    cost = np.array([[1, np.inf, 9],
+                     [np.inf, 2, np.inf],
+                     [3, np.inf, 4]])
+    rows, cols = assignment.bottleneck_assignment(cost)
+    assert cols.tolist() == [0, 1, 2]
+    with pytest.raises(ValueError):
+        # both sources can only reach the first target
+        assignment.bottleneck_assignment(np.array([[1, np.inf], [2, np.inf]]))
+    with pytest.raises(ValueError):
+        assignment.bottleneck_assignment(np.full((2, 2), np.inf))
+
+
+def test_bottleneck_assignment_with_more_sources_than_targets():
+    with pytest.raises(ValueError):
+        assignment.bottleneck_assignment(np.ones((3, 2)))
+
+
+@pytest.mark.parametrize('objective', ['sum', 'makespan'])
+@pytest.mark.parametrize('seed', range(10))
+def test_assign_is_optimal_on_the_bond_graph(objective, seed):
+    lattice = square_grid()
+    sites = np.random.default_rng(seed).choice(len(lattice), 10, replace=False)
+    sources, targets = sites[:5], sites[5:]
+    assigned_sources, assigned_targets, jumps = assignment.assign(lattice, sources, targets, objective)
+    assert sorted(assigned_sources.tolist()) == sorted(sources.tolist())
+    assert sorted(assigned_targets.tolist()) == sorted(targets.tolist())
+    # the hop distance on the grid is the Manhattan distance
+    manhattan = np.abs(lattice.coords[assigned_sources] - lattice.coords[assigned_targets]).sum(axis=1) / 10
+    assert np.allclose(jumps, manhattan)
+    best_sum, best_max = brute_force(assignment.hop_distances(lattice, sources, targets))
+    if objective == 'sum':
+        assert jumps.sum() == best_sum
+    else:
+        assert jumps.max() == best_max
+
+
+def test_assign_with_tied_costs():
+    lattice = square_grid()
+    # every source ((0, 1) and (2, 1)) is two jumps from every target ((1, 0) and (1, 2))
+    sources, targets = [1, 13], [6, 8]
+    for objective in ('sum', 'makespan'):
+        _, assigned_targets, jumps = assignment.assign(lattice, sources, targets, objective)
+        assert jumps.tolist() == [2, 2]
+        assert sorted(assigned_targets.tolist()) == [6, 8]
+
+
+@pytest.mark.parametrize('objective', ['sum', 'makespan'])
+def test_assign_pairs_atoms_on_their_own_component(objective):
+    lattice = two_chains()
+    sources, targets, jumps = assignment.assign(lattice, [0, 5], [9, 4], objective)
+    assert dict(zip(sources.tolist(), targets.tolist())) == {0: 4, 5: 9}
+    assert jumps.tolist() == [4, 4]
+    # a source without a reachable target
+    with pytest.raises(ValueError):
+        assignment.assign(lattice, [0, 1], [8, 9], objective)
+
+
+def test_assign_with_more_sources_than_targets():
+    with pytest.raises(ValueError):
+        assignment.assign(square_grid(), [0, 1, 2], [20, 21])
+    sources, targets, jumps = assignment.assign(square_grid(), [], [])
+    assert len(sources) == len(targets) == len(jumps) == 0
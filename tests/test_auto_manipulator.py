@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the Auto-Manipulator with the simulated devices.
+"""
+
+# standard libraries
+import os
+
+# third party libraries
+import numpy as np
+
+# local libraries
+from nionswift_plugin.atmenmanip import auto_manipulator as am
+from nionswift_plugin.atmenmanip import simulator
+
+DEMO = os.path.join(os.path.dirname(__file__), os.pardir, 'atmenmanip_demo')
+
+
+def make_manipulator(number_dopants=1, seed=0, scan_device=None, streaming=False):
+    sample = simulator.SimulatedSample.from_image(np.load(os.path.join(DEMO, 'GonQF_01.npy')), 9, 1e-5, 50,
+                                                  number_dopants=number_dopants, seed=seed)
+    stem = (scan_device or simulator.SimulatedSTEM)(sample)
+    feedback = simulator.SimulatedFeedback(sample, drift_rate=0.0)
+    manipulator = am.AutoManipulator(sample.lattice, None, None, streaming=streaming, sigma=9, scan_device=stem,
+                                     feedback_device=feedback, drift_correction=False)
+    return sample, manipulator
+
+
+def stem_frame(sample):
+    return simulator.XData(sample.render(dose=1000.0))
+
+
+def test_locate_atom_ignores_unplanned_dopant_next_to_it():
+    sample, manipulator = make_manipulator()
+    lattice = sample.lattice
+    atom = int(sample.dopants[0])
+    target, other = lattice.neighbours(atom)[:2]
+    lattice.paths = [np.array((atom, target), dtype=np.int32)]
+    # a dopant without a path sits next to the atom
+    sample.dopants = np.array((atom, other), dtype=np.int32)
+    before = stem_frame(sample)
+    manipulator._before = (before, np.zeros(2))
+    assert manipulator.locate_atom(before, atom) == atom
+
+    sample.dopants[0] = target
+    assert manipulator.locate_atom(stem_frame(sample), atom) == target
+
+
+def test_stalled_atom_stops_the_run():
+    sample, manipulator = make_manipulator()
+    atom = int(sample.dopants[0])
+    target = int(sample.lattice.neighbours(atom)[0])
+    sample.lattice.paths = [np.array((atom, target), dtype=np.int32)]
+    # the atom can not jump, every step times out
+    manipulator.feedback_device.jump_rate = 0.0
+    manipulator.feedback_device.drift_rate = 0.0
+    manipulator.run(frametimeout=1)
+    assert manipulator.atoms_moved == 0
+    assert manipulator.retries == manipulator.max_retries
+
+
+def test_atom_already_on_its_target_is_skipped():
+    sample, manipulator = make_manipulator(number_dopants=2)
+    first, second = (int(d) for d in sample.dopants)
+    target = int(sample.lattice.neighbours(second)[0])
+    # the assignment paired the first atom with its own site
+    sample.lattice.paths = [np.array((first,), dtype=np.int32), np.array((second, target), dtype=np.int32)]
+    manipulator.feedback_device.misjump_probability = 0.0
+    manipulator.run(frametimeout=100)
+    assert manipulator.atoms_moved == 1
+    assert target in sample.dopants
+
+
+class ScanView(simulator.SimulatedSTEM):
+    """Simulated scan that only delivers live frames while its view is playing."""
+
+    def __init__(self, sample):
+        super().__init__(sample)
+        self.is_playing = False
+        self.states = []
+
+    def grab_next_to_finish(self):
+        assert self.is_playing
+        return super().grab_next_to_finish()
+
+    def start_streaming(self):
+        self.states.append('start')
+        self.is_playing = True
+
+    def stop_streaming(self):
+        self.states.append('stop')
+        self.is_playing = False
+
+
+def test_streaming_plays_the_view_while_it_runs():
+    sample, manipulator = make_manipulator(scan_device=ScanView, streaming=True)
+    atom = int(sample.dopants[0])
+    sample.lattice.paths = [np.array((atom, int(sample.lattice.neighbours(atom)[0])), dtype=np.int32)]
+    manipulator.run(frametimeout=100)
+    assert manipulator.atoms_moved == 1
+    assert manipulator.scan_device.states == ['start', 'stop']
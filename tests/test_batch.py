@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the batch analysis.
+"""
+
+# third party libraries
+import numpy as np
+import pytest
+
+# local libraries
+from nionswift_plugin.atmenmanip import batch
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def test_tiff_stack_is_read_page_by_page(tmp_path, monkeypatch):
+    path = str(tmp_path / 'stack.tif')
+    stack = np.random.default_rng(0).integers(0, 1000, size=(5, 32, 48)).astype(np.int32)
+    pages = [Image.fromarray(frame) for frame in stack]
+    pages[0].save(path, save_all=True, append_images=pages[1:], compression='tiff_deflate')
+    # the Pillow fallback
+    monkeypatch.setattr(batch, 'tifffile', None)
+    monkeypatch.setattr(batch, 'Image', Image, raising=False)
+
+    frames = batch.open_frames(path)
+    assert isinstance(frames, batch.PageStack)
+    assert frames.shape == stack.shape
+    for index in range(len(stack)):
+        assert np.array_equal(frames[index], stack[index])
+    assert list(batch.list_frames([path])) == [(path, index) for index in range(len(stack))]
+
+
+def test_resumed_run_skips_the_frames_already_analysed(tmp_path, capsys):
+    frames = tmp_path / 'frames'
+    frames.mkdir()
+    rng = np.random.default_rng(0)
+    for name in ('a', 'b', 'c'):
+        np.save(str(frames / (name + '.npy')), rng.random((64, 64)).astype(np.float32))
+    output = str(tmp_path / 'results.csv')
+    arguments = (2, 1e-3, 10)
+    assert batch.run([str(frames / 'a.npy')], output, *arguments, workers=1) == 1
+    capsys.readouterr()
+
+    assert batch.run([str(frames)], output, *arguments, workers=1) == 2
+    summary = capsys.readouterr().out.splitlines()[-1]
+    assert summary.startswith("Analysed 2 frames") and summary.endswith("(1 skipped)")
+    assert batch.run([str(frames)], output, *arguments, workers=1) == 0
+    assert capsys.readouterr().out.splitlines()[-1].endswith("(3 skipped)")
+    # the rows of an earlier run are not counted as skipped in this one
+    assert batch.run([str(frames / 'b.npy')], output, *arguments, workers=1) == 0
+    assert capsys.readouterr().out.splitlines()[-1].endswith("(1 skipped)")
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the maxima detection.
+"""
+
+# standard libraries
+import os
+
+# third party libraries
+import numpy as np
+import pytest
+from scipy.spatial import cKDTree
+
+# local libraries
+from nionswift_plugin.atmenmanip import detection
+
+DEMO = os.path.join(os.path.dirname(__file__), os.pardir, 'atmenmanip_demo')
+
+
+def load_frame(name):
+    return np.load(os.path.join(DEMO, name))
+
+
+@pytest.mark.parametrize('name', ['GonQF_01.npy', 'GonQF_02.npy'])
+@pytest.mark.parametrize('sigma', [4, 9])
+@pytest.mark.parametrize('tile_size', [100, 200])
+def test_tiled_maxima_equal_whole_frame(name, sigma, tile_size):
+    image = load_frame(name)
+    blurred, maxima = detection.detect_maxima(image, sigma, 5e-4)
+    tiled_blurred, tiled_maxima = detection.detect_maxima_tiled(image, sigma, 5e-4, tile_size=tile_size, workers=2)
+    assert np.array_equal(tiled_blurred, blurred)
+    assert np.array_equal(tiled_maxima, maxima)
+
+
+def test_tiled_separable_blur_equal_whole_frame():
+    image = load_frame('GonQF_01.npy')
+    sigma = 1
+    assert detection.BlurEngine.choose_method(image.shape, sigma) == 'separable'
+    assert np.array_equal(detection.blur_tiled(image, sigma, tile_size=64, workers=2),
+                          detection.blur(image, sigma))
+
+
+@pytest.mark.parametrize('sigma', [4, 9])
+def test_forced_separable_blur_is_tiled_exactly(sigma):
+    image = load_frame('GonQF_02.npy')
+    tiled = detection.blur_tiled(image, sigma, tile_size=100, workers=2, method='separable')
+    assert np.array_equal(tiled, detection.blur(image, sigma, method='separable'))
+
+
+@pytest.mark.parametrize('shape', [(512, 512), (300, 451)])
+@pytest.mark.parametrize('sigma', [1, 4, 9])
+def test_fft_blur_equals_separable_blur(shape, sigma):
+    image = load_frame('GonQF_01.npy')[:shape[0], :shape[1]]
+    engine = detection.BlurEngine()
+    fft = engine.blur(image, sigma, method='fft')
+    separable = engine.blur(image, sigma, method='separable')
+    assert fft.dtype == separable.dtype == np.float32
+    assert np.max(np.abs(fft - separable)) < 1e-6
+    # the kernel spectrum is cached for the second blur
+    assert len(engine._kernels) == 1
+    assert np.array_equal(engine.blur(image, sigma, method='fft'), fft)
+    assert len(engine._kernels) == 1
+
+
+@pytest.mark.parametrize('noise_tolerance', [1e-5, 5e-3, 2e-2])
+def test_frame_maxima_equal_tiled_and_untiled(noise_tolerance):
+    image = load_frame('GonQF_01.npy')
+    blurred = detection.blur(image, 8)
+    untiled = detection.frame_maxima(image, blurred, 8, noise_tolerance, tile_size=1024)
+    tiled = detection.frame_maxima(image, blurred, 8, noise_tolerance, tile_size=128, workers=2)
+    assert np.array_equal(tiled, untiled)
+    assert np.array_equal(untiled, detection.detect_maxima(image, 8, noise_tolerance)[1])
+
+
+def test_refine_maxima_finds_subpixel_peaks():
+    rng = np.random.default_rng(0)
+    sigma = 3
+    yy, xx = np.mgrid[:200, :200]
+    positions = np.stack(np.meshgrid(np.arange(20, 200, 30), np.arange(20, 200, 30), indexing='ij'), axis=-1)
+    positions = positions.reshape(-1, 2) + rng.uniform(-0.5, 0.5, (36, 2))
+    image = np.zeros((200, 200), dtype=np.float32)
+    for y, x in positions:
+        image += np.exp(-((yy - y)**2 + (xx - x)**2) / (2 * sigma**2))
+    maxima = np.round(positions).astype(int)
+
+    refined = detection.refine_maxima(image, maxima, sigma)
+    error = np.linalg.norm(refined - positions, axis=1)
+    assert error.max() < 0.05
+    assert error.mean() < np.linalg.norm(maxima - positions, axis=1).mean() / 10
+
+
+@pytest.mark.parametrize('name', ['GonQF_01.npy', 'GonQF_02.npy'])
+@pytest.mark.parametrize('sigma', [8, 9])
+def test_pyramid_maxima_agree_with_detect_maxima(name, sigma):
+    image = load_frame(name)
+    blurred, maxima = detection.detect_maxima(image, sigma, 1e-5)
+    reference = detection.refine_maxima(blurred, maxima, sigma)
+    positions, heights = detection.detect_maxima_pyramid(image, sigma, 1e-5)
+
+    assert len(positions) == len(heights)
+    distance = cKDTree(reference).query(positions)[0]
+    border = np.min(np.minimum(positions, np.array(image.shape) - 1 - positions), axis=1)
+    near_border = border < 3 * sigma
+    assert near_border.sum() >= 10
+    assert np.all(distance[near_border] < 2)
+    assert np.sum(distance >= 2) <= 1
+    assert np.sum(cKDTree(positions).query(reference)[0] >= 2) <= 2
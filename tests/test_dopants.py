@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the dopant detection.
+"""
+
+# third party libraries
+import numpy as np
+
+# local libraries
+from nionswift_plugin.atmenmanip import detection
+from nionswift_plugin.atmenmanip import dopants
+from nionswift_plugin.atmenmanip import lattice as lat
+from nionswift_plugin.atmenmanip import simulator
+
+BOND_LENGTH = 12.0
+SIGMA = 2.0
+
+
+def honeycomb_lattice(shape, bond_length=BOND_LENGTH):
+    points = []
+    for i in range(int(shape[1] / bond_length / 3) + 1):
+        for j in range(int(shape[0] / bond_length / np.sqrt(3)) + 1):
+            x, y = i * 3, j * np.sqrt(3)
+            points += [(y, x), (y, x + 1), (y + np.sqrt(3) / 2, x + 1.5), (y + np.sqrt(3) / 2, x + 2.5)]
+    coords = np.array(points) * bond_length + 6
+    coords = coords[np.all(coords < np.array(shape) - 6, axis=1)]
+    return lat.Lattice.from_maxima(coords, 1.1 * bond_length)
+
+
+def test_voronoi_cells_label_the_nearest_site():
+    coords = np.array([(2, 3), (10, 12), (15, 1)], dtype=float)
+    cells, distances = dopants.voronoi_cells((20, 16), coords)
+    yy, xx = np.mgrid[:20, :16]
+    squared = (yy[..., np.newaxis] - coords[:, 0])**2 + (xx[..., np.newaxis] - coords[:, 1])**2
+    assert np.allclose(distances, np.sqrt(squared.min(axis=-1)))
+    nearest = np.take_along_axis(squared, cells[..., np.newaxis] - 1, axis=-1)[..., 0]
+    assert np.array_equal(nearest, squared.min(axis=-1))
+
+
+def test_relative_to_neighbours():
+    lattice = lat.Lattice([(0, 0), (0, 1), (0, 2), (5, 5)], [(0, 1), (1, 2)])
+    contrast = dopants.relative_to_neighbours([1.0, 4.0, 2.0, 3.0], lattice)
+    # the isolated site is compared to the median
+    assert np.allclose(contrast, [1 / 4, 4 / 1.5, 2 / 4, 3 / 2.5])
+
+
+def test_one_bright_site_is_the_only_dopant():
+    shape = (160, 160)
+    lattice = honeycomb_lattice(shape)
+    bright = int(np.argmin(np.linalg.norm(lattice.coords - np.array(shape) / 2, axis=1)))
+    sample = simulator.SimulatedSample(lattice, shape, [bright], sigma=SIGMA, seed=0)
+    image = sample.render(dose=200.0)
+    blurred = detection.blur(image, SIGMA)
+
+    features = dopants.intensity_features(image, blurred, lattice, SIGMA)
+    assert all(len(values) == len(lattice) for values in features.values())
+    bulk = lattice.degrees() == 3
+    others = bulk & (np.arange(len(lattice)) != bright)
+    assert features['integrated'][bright] > 1.6 * np.median(features['integrated'][others])
+    assert features['peak_height'][bright] > 1.6 * np.median(features['peak_height'][others])
+    assert features['contrast'][bright] > 1.6
+    assert np.all(features['contrast'][others] < 1.4)
+    assert np.array_equal(dopants.classify(features, threshold=1.5), [bright])
+
+
+def test_features_of_empty_lattice():
+    features = dopants.intensity_features(np.zeros((10, 10)), np.zeros((10, 10)), lat.Lattice(np.empty((0, 2)), []), 2)
+    assert all(len(values) == 0 for values in features.values())
+    assert len(dopants.classify(features)) == 0
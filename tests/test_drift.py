@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the drift correction.
+"""
+
+# standard libraries
+import os
+
+# third party libraries
+import numpy as np
+import pytest
+
+# local libraries
+from nionswift_plugin.atmenmanip import detection
+from nionswift_plugin.atmenmanip import drift
+from nionswift_plugin.atmenmanip import lattice as lat
+from nionswift_plugin.atmenmanip import simulator
+
+DEMO = os.path.join(os.path.dirname(__file__), os.pardir, 'atmenmanip_demo')
+
+
+def drift_errors(refine, seed=0, number_frames=10):
+    """Absolute errors of the tracked drift for a random walk of sub-pixel drifts."""
+    sample = simulator.SimulatedSample.from_image(np.load(os.path.join(DEMO, 'GonQF_01.npy')), 9, 1e-5, 50,
+                                                  seed=seed)
+    _, maxima = detection.detect_maxima(sample.render(), 9, 1e-5)
+    tracker = drift.DriftTracker(lat.Lattice.from_maxima(maxima, 50), sigma=9, refine=refine)
+    tracker.update(sample.render())
+    rng = np.random.default_rng(seed)
+    errors = []
+    for _ in range(number_frames):
+        sample.drift += rng.normal(size=2) * 2
+        shift, _ = tracker.update(sample.render())
+        errors.append(np.abs(shift - sample.drift))
+    return np.array(errors)
+
+
+@pytest.mark.parametrize('seed', [0, 2])
+def test_refined_drift_is_sub_pixel(seed):
+    refined = drift_errors(True, seed)
+    assert refined.max() < 0.1
+    assert refined.mean() <= drift_errors(False, seed).mean()
+
+
+def test_drift_before_the_run_is_measured_from_the_detection_frame():
+    sample = simulator.SimulatedSample.from_image(np.load(os.path.join(DEMO, 'GonQF_01.npy')), 9, 1e-5, 50, seed=0)
+    detection_frame = sample.render()
+    _, maxima = detection.detect_maxima(detection_frame, 9, 1e-5)
+    lattice = lat.Lattice.from_maxima(maxima, 50)
+    coords = lattice.coords.copy()
+    tracker = drift.DriftTracker(lattice, sigma=9)
+    tracker.set_reference(detection_frame)
+    # the sample drifted between the detection and the first frame of the run
+    sample.drift = np.array((3.3, -2.6))
+    shift, _ = tracker.update(sample.render())
+    assert np.all(np.abs(shift - sample.drift) < 0.1)
+    assert np.all(np.abs(lattice.coords - coords - sample.drift) < 0.1)
+
+    # a second run on the moved lattice continues from the drift applied so far
+    tracker = drift.DriftTracker(lattice, sigma=9)
+    tracker.set_reference(detection_frame, shift)
+    sample.drift += (1.2, 0.7)
+    shift, _ = tracker.update(sample.render())
+    assert np.all(np.abs(shift - sample.drift) < 0.1)
+    assert np.all(np.abs(lattice.coords - coords - sample.drift) < 0.1)
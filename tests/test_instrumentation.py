@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the timing instrumentation.
+"""
+
+# standard libraries
+import os
+import json
+import time
+import threading
+
+# third party libraries
+import pytest
+
+# local libraries
+from nionswift_plugin.atmenmanip import instrumentation
+
+
+def test_spans_are_aggregated_per_name():
+    instruments = instrumentation.Instrumentation()
+    durations = []
+    for delay in (0.002, 0.01, 0.005):
+        with instruments.span('sleep', delay=delay) as span:
+            time.sleep(delay)
+        durations.append(span.duration)
+    with instruments.span('other'):
+        pass
+
+    number, total, minimum, maximum = instruments.stats['sleep']
+    assert number == 3
+    assert total == pytest.approx(sum(durations))
+    assert minimum == min(durations) >= 0.002
+    assert maximum == max(durations) >= 0.01
+    assert instruments.stats['other'][0] == 1
+    lines = instruments.summary().splitlines()
+    assert lines[1].split()[:2] == ['sleep', '3']
+
+
+def test_timed_and_spans_of_failing_code():
+    instruments = instrumentation.Instrumentation()
+
+    @instruments.timed()
+    def add(a, b):
+        return a + b
+
+    @instruments.timed('failing')
+    def fail():
+        raise RuntimeError
+
+    assert add(1, 2) == 3
+    with pytest.raises(RuntimeError):
+        fail()
+    assert instruments.stats[add.__qualname__][0] == 1
+    assert instruments.stats['failing'][0] == 1
+
+
+def test_counters_and_threads():
+    instruments = instrumentation.Instrumentation()
+
+    def work():
+        for _ in range(100):
+            instruments.count('frames')
+            with instruments.span('frame'):
+                pass
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    instruments.count('regions', 5)
+    assert instruments.counters == {'frames': 400, 'regions': 5}
+    assert instruments.stats['frame'][0] == 400
+    assert 'regions' in instruments.summary()
+
+
+def test_disabled_and_reset():
+    instruments = instrumentation.Instrumentation(enabled=False)
+    with instruments.span('blur') as span:
+        pass
+    instruments.count('frames')
+    assert span.duration is not None
+    assert not instruments.stats and not instruments.counters and not instruments.events
+
+    instruments = instrumentation.Instrumentation(max_events=10)
+    for _ in range(20):
+        instruments.count('frames')
+    assert len(instruments.events) == 10
+    instruments.reset()
+    assert not instruments.stats and not instruments.counters and not instruments.events
+
+
+def test_export_chrome_trace(tmp_path):
+    instruments = instrumentation.Instrumentation()
+    with instruments.span('outer', frame=3):
+        time.sleep(0.002)
+        with instruments.span('inner'):
+            time.sleep(0.001)
+    instruments.count('frames', 2)
+    path = os.path.join(str(tmp_path), 'traces', 'trace.json')
+    instruments.export_chrome_trace(path)
+
+    with open(path) as f:
+        trace = json.load(f)
+    assert trace['displayTimeUnit'] == 'ms'
+    inner, outer, counter = trace['traceEvents']
+    for event in (inner, outer):
+        assert event['ph'] == 'X'
+        assert event['pid'] == os.getpid() and event['tid'] == threading.get_ident()
+    assert (inner['name'], outer['name']) == ('inner', 'outer')
+    assert outer['args'] == {'frame': 3}
+    # microseconds, the inner span lies within the outer one
+    assert outer['dur'] >= 2000 and inner['dur'] >= 1000
+    assert outer['ts'] <= inner['ts'] and inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur']
+    assert counter['ph'] == 'C' and counter['name'] == 'frames'
+    assert counter['args'] == {'frames': 2} and 'dur' not in counter
+    assert counter['ts'] >= outer['ts'] + outer['dur']
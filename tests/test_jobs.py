@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the job scheduler.
+"""
+
+# standard libraries
+import threading
+
+# third party libraries
+import pytest
+
+# local libraries
+from nionswift_plugin.atmenmanip import jobs
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = jobs.Scheduler(max_workers=2)
+    yield scheduler
+    scheduler.shutdown(wait=True)
+
+
+def blocking(started, release):
+    """Job function that runs until release is set, with checkpoints."""
+    started.set()
+    while not release.wait(0.01):
+        jobs.checkpoint("waiting")
+    return 'done'
+
+
+def test_supersede_cancels_the_running_job(scheduler):
+    started, release = threading.Event(), threading.Event()
+    first = scheduler.submit('maxima', blocking, started, release)
+    assert started.wait(5)
+    second = scheduler.submit('maxima', lambda: 'second')
+    assert scheduler.wait('maxima', timeout=5)
+    assert first.state == jobs.CANCELLED
+    assert second.state == jobs.DONE and second.result() == 'second'
+    with pytest.raises(jobs.Cancelled):
+        first.result()
+
+
+def test_queued_job_waits_for_the_slot(scheduler):
+    started, release = threading.Event(), threading.Event()
+    order = []
+    first = scheduler.submit('session', lambda: (blocking(started, release), order.append(1)))
+    assert started.wait(5)
+    second = scheduler.submit('session', order.append, 2, supersede=False)
+    assert second.state == jobs.QUEUED
+    release.set()
+    assert scheduler.wait(timeout=5)
+    assert first.state == second.state == jobs.DONE
+    assert order == [1, 2]
+
+
+def test_cancel_propagates_to_dependent_jobs(scheduler):
+    started, release = threading.Event(), threading.Event()
+    maxima = scheduler.submit('maxima', blocking, started, release)
+    bonds = scheduler.submit('bonds', lambda: 'bonds', depends=(maxima,))
+    assert started.wait(5)
+    scheduler.cancel('maxima')
+    assert scheduler.wait(timeout=5)
+    assert maxima.state == bonds.state == jobs.CANCELLED
+
+
+def test_dependent_job_follows_the_superseding_job(scheduler):
+    started, release = threading.Event(), threading.Event()
+    maxima = scheduler.submit('maxima', blocking, started, release)
+    bonds = scheduler.submit('bonds', lambda: 'bonds', depends=(maxima,))
+    assert started.wait(5)
+    # new parameters: the maxima are recomputed and the bonds wait for them
+    scheduler.submit('maxima', lambda: 'new maxima')
+    assert scheduler.wait(timeout=5)
+    assert maxima.state == jobs.CANCELLED
+    assert bonds.state == jobs.DONE and bonds.result() == 'bonds'
+
+
+def test_failed_dependency_cancels_the_dependent_job(scheduler):
+    def fail():
+        raise RuntimeError("no maxima")
+    maxima = scheduler.submit('maxima', fail)
+    bonds = scheduler.submit('bonds', lambda: 'bonds', depends=(maxima,))
+    assert scheduler.wait(timeout=5)
+    assert maxima.state == jobs.FAILED
+    assert bonds.state == jobs.CANCELLED
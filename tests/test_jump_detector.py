@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the jump detection in the frames.
+"""
+
+# standard libraries
+import os
+import time
+import threading
+
+# third party libraries
+import numpy as np
+import pytest
+
+# local libraries
+from nionswift_plugin.atmenmanip import jump_detector
+from nionswift_plugin.atmenmanip import simulator
+
+DEMO = os.path.join(os.path.dirname(__file__), os.pardir, 'atmenmanip_demo')
+
+
+@pytest.fixture(scope='module')
+def sample():
+    return simulator.SimulatedSample.from_image(np.load(os.path.join(DEMO, 'GonQF_01.npy')), 9, 1e-5, 50,
+                                                number_dopants=1, seed=0)
+
+
+def frames(sample, dopant_sites, shift=(0, 0)):
+    """Frames of the sample with the dopant on each of the given sites in turn."""
+    result = []
+    dopants = sample.dopants
+    for site in dopant_sites:
+        sample.dopants = np.array([site], dtype=np.int32)
+        sample.drift = np.array(shift, dtype=float)
+        result.append([simulator.XData(sample.render(dose=1000.0))])
+    sample.dopants, sample.drift = dopants, np.zeros(2)
+    return result
+
+
+def detector_of(sample, grabbed):
+    """Detector whose grab returns the given frames, then no frame."""
+    grabbed = list(grabbed)
+    return jump_detector.ImageJumpDetector(None, sample.lattice, grab=lambda: grabbed.pop(0) if grabbed else [])
+
+
+def test_jump_to_the_target_is_detected(sample):
+    atom = int(sample.dopants[0])
+    target = int(sample.lattice.neighbours(atom)[0])
+    before, still, after = frames(sample, (atom, atom, target))
+    detector = detector_of(sample, [still, after])
+    detector.set_sites(atom, target, before)
+    assert detector.waitforjump(5) == "j"
+    assert detector.last_frame is after
+    assert 0.7 < detector.evidence < 1.3
+
+
+def test_no_jump_times_out(sample):
+    atom = int(sample.dopants[0])
+    target = int(sample.lattice.neighbours(atom)[0])
+    before, still, still_again = frames(sample, (atom, atom, atom))
+    detector = detector_of(sample, [still, still_again])
+    detector.set_sites(atom, target, before)
+    assert detector.waitforjump(0.2) == "to"
+    assert abs(detector.evidence) < 0.3
+    assert detector.last_frame is None
+
+
+def test_drift_is_reported(sample):
+    atom = int(sample.dopants[0])
+    target = int(sample.lattice.neighbours(atom)[0])
+    before, = frames(sample, (atom,))
+    drifted, = frames(sample, (atom,), shift=(0, 0.5 * detector_of(sample, []).radius + 2))
+    detector = detector_of(sample, [drifted])
+    detector.set_sites(atom, target, before)
+    assert detector.waitforjump(5) == "d"
+
+
+def test_waiting_without_frames_backs_off_and_times_out(sample):
+    calls = []
+    detector = jump_detector.ImageJumpDetector(None, sample.lattice, grab=lambda: calls.append(1) or [])
+    atom = int(sample.dopants[0])
+    detector.set_sites(atom, None)
+    starttime = time.monotonic()
+    assert detector.waitforjump(0.5) == "to"
+    duration = time.monotonic() - starttime
+    assert 0.5 <= duration < 0.7
+    # 5 ms doubled up to 0.2 s: a handful of calls instead of a busy loop
+    assert len(calls) <= 10
+
+
+def test_cancel_wakes_up_waiting_without_frames(sample):
+    detector = jump_detector.ImageJumpDetector(None, sample.lattice, grab=lambda: [])
+    detector.set_sites(int(sample.dopants[0]), None)
+    timer = threading.Timer(0.1, detector.cancel)
+    timer.start()
+    starttime = time.monotonic()
+    assert detector.waitforjump(10) == "to"
+    assert time.monotonic() - starttime < 1
+    timer.join()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the site/bond lattice.
+"""
+
+# third party libraries
+import numpy as np
+import pytest
+
+# local libraries
+from nionswift_plugin.atmenmanip import lattice as lat
+
+
+def brute_force_bonds(coords, maxlength):
+    distances = np.linalg.norm(coords[:, np.newaxis] - coords[np.newaxis], axis=-1)
+    i, j = np.nonzero(np.triu(distances <= maxlength, k=1))
+    return np.stack((i, j), axis=1)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('maxlength', [5.0, 12.0])
+def test_find_bonds_equal_brute_force(seed, maxlength):
+    coords = np.random.default_rng(seed).uniform(0, 100, (300, 2))
+    bonds = lat.find_bonds(coords, maxlength)
+    assert bonds.dtype == np.int32
+    assert np.array_equal(bonds, brute_force_bonds(coords, maxlength))
+
+
+def test_find_bonds_of_too_few_sites():
+    assert lat.find_bonds(np.empty((0, 2)), 10).shape == (0, 2)
+    assert lat.find_bonds([(1.0, 2.0)], 10).shape == (0, 2)
+
+
+def test_shortened_segments():
+    coords = np.array([(0, 0), (0, 10), (20, 10)], dtype=float)
+    bonds = np.array([(0, 1), (1, 2)])
+    starts, ends = lat.shortened_segments(coords, bonds, 0.6)
+    assert np.allclose(starts, [(0, 2), (4, 10)])
+    assert np.allclose(ends, [(0, 8), (16, 10)])
+    starts, ends = lat.shortened_segments(coords, bonds, 1.0)
+    assert np.allclose(starts, coords[bonds[:, 0]])
+    assert np.allclose(ends, coords[bonds[:, 1]])
+
+
+def random_lattice(seed=0, number_sites=200, maxlength=10.0):
+    coords = np.random.default_rng(seed).uniform(0, 100, (number_sites, 2))
+    return lat.Lattice.from_maxima(coords, maxlength)
+
+
+def assert_csr_equal_bonds(lattice):
+    adjacency = [set() for _ in range(len(lattice))]
+    for i, j in lattice.bonds:
+        adjacency[i].add(j)
+        adjacency[j].add(i)
+    assert np.array_equal(lattice.degrees(), [len(a) for a in adjacency])
+    for i in range(len(lattice)):
+        neighbours = lattice.neighbours(i)
+        assert np.all(np.diff(neighbours) > 0)
+        assert set(neighbours) == adjacency[i]
+
+
+def test_csr_neighbours_and_degrees():
+    lattice = random_lattice()
+    assert lattice.number_bonds > 0
+    assert lattice.coords.dtype == np.float32 and lattice.bonds.dtype == np.int32
+    assert_csr_equal_bonds(lattice)
+
+
+def test_csr_after_adding_and_removing_bonds():
+    lattice = random_lattice()
+    rng = np.random.default_rng(1)
+    removed = rng.choice(lattice.number_bonds, size=lattice.number_bonds // 3, replace=False)
+    fewer = lat.Lattice(lattice.coords, np.delete(lattice.bonds, removed, axis=0))
+    assert_csr_equal_bonds(fewer)
+    assert fewer.degrees().sum() == lattice.degrees().sum() - 2 * len(removed)
+    # a new, isolated site and a bond to it
+    coords = np.concatenate((lattice.coords, [(200, 200)]))
+    more = lat.Lattice(coords, np.concatenate((lattice.bonds, [(0, len(lattice))])))
+    assert_csr_equal_bonds(more)
+    assert np.array_equal(more.neighbours(len(lattice)), [0])
+    assert more.degrees()[0] == lattice.degrees()[0] + 1
+    # a known adjacency is taken as is
+    same = lat.Lattice(lattice.coords, lattice.bonds, csr=(lattice.indptr, lattice.indices))
+    assert_csr_equal_bonds(same)
+
+
+def test_sources_targets_and_graphics():
+    lattice = random_lattice()
+    lattice.add_sources([3, 4])
+    lattice.add_sources(7)
+    lattice.add_targets(np.array([[10], [11]]))
+    assert np.array_equal(lattice.sources, [3, 4, 7]) and lattice.sources.dtype == np.int32
+    assert np.array_equal(lattice.targets, [10, 11]) and lattice.targets.dtype == np.int32
+    lattice.bind_graphic('a', np.int64(5))
+    assert lattice.site_of_graphic('a') == 5 and type(lattice.site_of_graphic('a')) is int
+    assert lattice.site_of_graphic('b') is None
+
+
+def test_nearest_site_after_moving_sites():
+    lattice = random_lattice()
+    y, x = lattice.coords[12]
+    assert lattice.nearest_site(y, x) == 12
+    lattice.move_sites([12], [(300, 300)])
+    assert lattice.nearest_site(300.5, 299.5) == 12
+    assert lattice.nearest_site(y, x) != 12
+    lattice.shift_sites((-100, -100))
+    assert lattice.nearest_site(200, 200) == 12
+    assert np.allclose(lattice.coords[12], (200, 200))
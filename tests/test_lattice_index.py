@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the hop-distance index.
+"""
+
+# third party libraries
+import numpy as np
+import pytest
+from scipy.sparse import csgraph
+
+# local libraries
+from nionswift_plugin.atmenmanip import assignment
+from nionswift_plugin.atmenmanip import lattice as lat
+from nionswift_plugin.atmenmanip import lattice_index
+
+
+def honeycomb_with_isolated_site(columns=8, rows=10, bond_length=10.0):
+    """Lattice of a honeycomb and one site far away from it."""
+    points = []
+    for i in range(columns):
+        for j in range(rows):
+            x, y = i * 3, j * np.sqrt(3)
+            points += [(y, x), (y, x + 1), (y + np.sqrt(3) / 2, x + 1.5), (y + np.sqrt(3) / 2, x + 2.5)]
+    coords = np.concatenate((np.array(points) * bond_length, [(-100.0, -100.0)]))
+    return lat.Lattice(coords, lat.find_bonds(coords, 1.05 * bond_length))
+
+
+def true_distances(lattice):
+    return csgraph.shortest_path(assignment.bond_graph(lattice), unweighted=True)
+
+
+def test_full_table_holds_the_exact_distances():
+    lattice = honeycomb_with_isolated_site()
+    index = lattice_index.LatticeIndex.build(lattice)
+    assert index.exact and index.distances.dtype == np.uint16
+    assert index.distances.shape == (len(lattice), len(lattice))
+    expected = true_distances(lattice)
+    isolated = len(lattice) - 1
+    assert np.all(index.distances[isolated, :-1] == lattice_index.UNREACHABLE)
+    for goal in (0, 17, isolated):
+        assert np.array_equal(index.lower_bounds(goal), expected[:, goal])
+    sources, targets = [0, 5, isolated], [3, 100, 200]
+    assert np.array_equal(index.hop_distances(sources, targets), expected[np.ix_(sources, targets)])
+
+
+def test_landmark_bounds_are_admissible():
+    lattice = honeycomb_with_isolated_site()
+    index = lattice_index.LatticeIndex.build(lattice, number_landmarks=6, max_table_sites=100)
+    assert not index.exact and len(index.landmarks) == 6
+    assert index.distances.shape == (6, len(lattice)) and index.distances.dtype == np.uint16
+    assert index.hop_distances([0], [1]) is None
+    expected = true_distances(lattice)
+    connected = np.arange(len(lattice) - 1)
+    for goal in np.random.default_rng(0).choice(connected, 20, replace=False):
+        bounds = index.lower_bounds(goal)
+        # never above the true number of jumps, and a useful bound
+        assert np.all(bounds[connected] <= expected[connected, goal])
+        assert np.mean(bounds[connected] / np.maximum(expected[connected, goal], 1)) > 0.5
+        assert all(index.bound(u, goal) == bounds[u] for u in (0, 50, 150))
+    # from a landmark the bound is exact
+    landmark = index.landmarks[0]
+    assert np.array_equal(index.lower_bounds(landmark)[connected], expected[connected, landmark])
+
+
+def test_save_and_load(tmp_path):
+    lattice = honeycomb_with_isolated_site()
+    for kwargs in (dict(), dict(number_landmarks=4, max_table_sites=100)):
+        index = lattice_index.LatticeIndex.build(lattice, **kwargs)
+        path = str(tmp_path / 'index.npz')
+        index.save(path)
+        loaded = lattice_index.LatticeIndex.load(path)
+        assert loaded.exact == index.exact and loaded.key == index.key and loaded.matches(lattice)
+        assert np.array_equal(loaded.distances, index.distances) and loaded.distances.dtype == np.uint16
+        if not index.exact:
+            assert np.array_equal(loaded.landmarks, index.landmarks)
+        assert np.array_equal(loaded.lower_bounds(7), index.lower_bounds(7))
+
+
+def test_load_or_build_keeps_the_index_of_the_same_bonds(tmp_path, monkeypatch):
+    lattice = honeycomb_with_isolated_site()
+    directory = str(tmp_path / 'indices')
+    built = lattice_index.load_or_build(lattice, directory, 'item')
+    # loaded, not built again
+    monkeypatch.setattr(lattice_index.LatticeIndex, 'build', classmethod(lambda cls, *args, **kwargs: None))
+    loaded = lattice_index.load_or_build(lattice, directory, 'item')
+    assert loaded is not None and np.array_equal(loaded.distances, built.distances)
+    monkeypatch.undo()
+
+    # other bonds: built again and replaced
+    lattice = lat.Lattice(lattice.coords, lattice.bonds[1:])
+    rebuilt = lattice_index.load_or_build(lattice, directory, 'item')
+    assert rebuilt.matches(lattice) and not rebuilt.matches(honeycomb_with_isolated_site())
+    assert rebuilt.distances[tuple(honeycomb_with_isolated_site().bonds[0])] > 1
+    assert lattice_index.LatticeIndex.load(lattice_index.index_path(directory, 'item')).matches(lattice)
+
+    # an unreadable file is replaced as well
+    with open(lattice_index.index_path(directory, 'item'), 'wb') as f:
+        f.write(b'not an index')
+    assert lattice_index.load_or_build(lattice, directory, 'item').matches(lattice)
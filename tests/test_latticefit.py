@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the ideal lattice fit.
+"""
+
+# third party libraries
+import numpy as np
+from scipy.spatial import cKDTree
+
+# local libraries
+from nionswift_plugin.atmenmanip import detection
+from nionswift_plugin.atmenmanip import lattice as lat
+from nionswift_plugin.atmenmanip import latticefit
+from nionswift_plugin.atmenmanip import simulator
+
+BOND_LENGTH = 14.0
+SHAPE = (256, 256)
+
+
+def honeycomb_coords(shape, bond_length=BOND_LENGTH, angle=0.2, origin=(7.3, 4.1)):
+    """Sites of a rotated ideal honeycomb covering a frame."""
+    a1 = bond_length * np.sqrt(3) * np.array((np.sin(angle), np.cos(angle)))
+    a2 = bond_length * np.sqrt(3) * np.array((np.sin(angle + np.pi / 3), np.cos(angle + np.pi / 3)))
+    n, m, s = np.meshgrid(np.arange(-30, 30), np.arange(-30, 30), (0, 1), indexing='ij')
+    coords = np.array(origin) + (n.ravel()[:, np.newaxis] + s.ravel()[:, np.newaxis] / 3) * a1 \
+        + (m.ravel()[:, np.newaxis] + s.ravel()[:, np.newaxis] / 3) * a2
+    return coords[np.all((coords >= 0) & (coords < np.array(shape) - 1), axis=1)]
+
+
+def test_fit_lattice_finds_vacancies_and_outliers():
+    coords = honeycomb_coords(SHAPE)
+    centre = np.array(SHAPE) / 2
+    order = np.argsort(np.linalg.norm(coords - centre, axis=1))
+    vacancies = order[[0, 25, 60]]
+    present = np.setdiff1d(np.arange(len(coords)), vacancies)
+    sample = simulator.SimulatedSample(lat.Lattice(coords[present], np.empty((0, 2), dtype=np.int32)),
+                                       SHAPE, [], sigma=2.0, seed=0)
+    image = sample.render(dose=50.0)
+    blurred = detection.blur(image, 2.0)
+    _, maxima = detection.detect_maxima(image, 2.0, 1e-3)
+    maxima = detection.refine_maxima(blurred, maxima, 2.0)
+    # two points halfway along bonds, e.g. adatoms
+    sites = order[[10, 45]]
+    neighbours = cKDTree(coords).query(coords[sites], k=2)[1][:, 1]
+    maxima = np.concatenate((maxima, (coords[sites] + coords[neighbours]) / 2))
+
+    fit = latticefit.fit_lattice(blurred, maxima)
+
+    assert abs(fit.bond_length - BOND_LENGTH) < 0.05
+    assert set(fit.outliers) >= {len(maxima) - 2, len(maxima) - 1}
+    # the fitted vacancies are the removed sites (and sites cut off by the frame border)
+    vacant = fit.ideal[fit.vacancies]
+    assert np.all(cKDTree(vacant).query(coords[vacancies])[0] < 0.5)
+    interior = np.all((vacant > 2 * BOND_LENGTH) & (vacant < np.array(SHAPE) - 2 * BOND_LENGTH), axis=1)
+    assert interior.sum() == len(vacancies)
+    # ideal positions lie on the generating lattice (the margin also matches maxima at the frame border)
+    inside = np.all((fit.ideal >= 0) & (fit.ideal < np.array(SHAPE) - 1), axis=1)
+    assert cKDTree(coords).query(fit.ideal[fit.occupied & inside])[0].max() < 0.3
+    occupied = np.flatnonzero(fit.occupied)
+    degrees = lat.Lattice(fit.ideal[occupied], fit.bonds(occupied)).degrees()
+    bulk = np.all((fit.ideal[occupied] > 2 * BOND_LENGTH) & (fit.ideal[occupied] < np.array(SHAPE) - 2 * BOND_LENGTH),
+                  axis=1)
+    next_to_vacancy = cKDTree(coords[vacancies]).query(fit.ideal[occupied])[0] < 1.5 * BOND_LENGTH
+    assert np.all(degrees[bulk & ~next_to_vacancy] == 3)
+    assert np.all(degrees[bulk & next_to_vacancy] == 2)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the overlay rendering.
+"""
+
+# third party libraries
+import numpy as np
+
+# local libraries
+from nionswift_plugin.atmenmanip import overlay
+
+
+def test_grey_to_rgb():
+    image = np.linspace(-1, 1, 100 * 80).reshape(100, 80)
+    rgb = overlay.grey_to_rgb(image, clip_percentiles=(0, 100))
+    assert rgb.shape == (100, 80, 3)
+    assert rgb.dtype == np.uint8
+    assert np.array_equal(rgb[..., 0], rgb[..., 2])
+    assert rgb[0, 0, 0] == 0 and rgb[-1, -1, 0] == 255
+    assert np.all(np.diff(rgb[..., 0].ravel().astype(int)) >= 0)
+    # a constant image does not divide by zero
+    assert np.all(overlay.grey_to_rgb(np.ones((10, 10))) == 0)
+
+
+def test_draw_points():
+    rgb = np.zeros((20, 30, 3), dtype=np.uint8)
+    overlay.draw_points(rgb, [(5.2, 6.7), (19, 0)], color=(1, 2, 3), radius=2)
+    drawn = np.all(rgb == (3, 2, 1), axis=-1) # BGR
+    yy, xx = np.mgrid[:20, :30]
+    disk = (yy - 5)**2 + (xx - 7)**2 <= 4
+    corner = (yy - 19)**2 + xx**2 <= 4
+    assert np.array_equal(drawn, disk | corner)
+    assert np.all(rgb[~drawn] == 0)
+
+
+def test_draw_segments():
+    rgb = np.zeros((20, 30, 3), dtype=np.uint8)
+    overlay.draw_segments(rgb, [(2, 3), (5, 5), (0, 28)], [(2, 12), (15, 15), (0, 40)], color=(1, 2, 3))
+    drawn = np.all(rgb == (3, 2, 1), axis=-1)
+    expected = np.zeros((20, 30), dtype=bool)
+    expected[2, 3:13] = True
+    expected[np.arange(5, 16), np.arange(5, 16)] = True
+    # clipped at the image border
+    expected[0, 28:] = True
+    assert np.array_equal(drawn, expected)
+    assert overlay.draw_segments(rgb, np.empty((0, 2)), np.empty((0, 2))) is rgb
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the dependency tracked pipeline.
+"""
+
+# standard libraries
+import threading
+import collections
+
+# local libraries
+from nionswift_plugin.atmenmanip import pipeline
+
+
+def make_pipeline():
+    """source -> blurred -> maxima -> lattice, blurred -> features; counts the computations."""
+    calls = collections.Counter()
+    def stage(name):
+        def compute(*args):
+            calls[name] += 1
+            return (name,) + args
+        return compute
+    p = pipeline.Pipeline()
+    p.add_stage('blurred', stage('blurred'), params=('source', 'sigma'))
+    p.add_stage('maxima', stage('maxima'), depends=('blurred',), params=('noise_tolerance',))
+    p.add_stage('lattice', stage('lattice'), depends=('maxima',), params=('maxlength',))
+    p.add_stage('features', stage('features'), depends=('blurred',))
+    p.set_param('source', 'frame', key='hash of frame')
+    p.set_param('sigma', 9)
+    p.set_param('noise_tolerance', 1e-5)
+    p.set_param('maxlength', 50)
+    return p, calls
+
+
+def get_all(p):
+    return {name: p.get(name) for name in ('lattice', 'features')}
+
+
+def test_unchanged_stages_are_not_recomputed():
+    p, calls = make_pipeline()
+    first = get_all(p)
+    assert calls == dict(blurred=1, maxima=1, lattice=1, features=1)
+    # same values again
+    assert not p.set_param('sigma', 9)
+    assert not p.set_param('source', 'same frame, other object', key='hash of frame')
+    assert all(p.is_current(name) for name in ('blurred', 'maxima', 'lattice', 'features'))
+    assert get_all(p) == first
+    assert calls == dict(blurred=1, maxima=1, lattice=1, features=1)
+
+
+def test_a_parameter_only_invalidates_its_downstream_stages():
+    p, calls = make_pipeline()
+    get_all(p)
+    versions = {name: p.version(name) for name in ('blurred', 'maxima', 'lattice', 'features')}
+
+    assert p.set_param('maxlength', 40)
+    assert p.is_current('maxima') and not p.is_current('lattice')
+    get_all(p)
+    assert calls == dict(blurred=1, maxima=1, lattice=2, features=1)
+
+    assert p.set_param('noise_tolerance', 1e-4)
+    assert p.is_current('blurred') and p.is_current('features')
+    assert not p.is_current('maxima') and not p.is_current('lattice')
+    get_all(p)
+    assert calls == dict(blurred=1, maxima=2, lattice=3, features=1)
+    assert p.version('blurred') == versions['blurred'] and p.version('features') == versions['features']
+    assert p.version('maxima') != versions['maxima']
+
+    # a new frame invalidates everything
+    p.set_param('source', 'other frame', key='hash of other frame')
+    assert get_all(p)['features'] == ('features', ('blurred', 'other frame', 9))
+    assert calls == dict(blurred=2, maxima=3, lattice=4, features=2)
+
+
+def test_reads_do_not_wait_for_a_slow_stage():
+    p, calls = make_pipeline()
+    started, release = threading.Event(), threading.Event()
+    def slow_lattice(maxima, maxlength):
+        started.set()
+        assert release.wait(5)
+        return 'lattice'
+    p.add_stage('lattice', slow_lattice, depends=('maxima',), params=('maxlength',))
+    worker = threading.Thread(target=p.get, args=('lattice',))
+    worker.start()
+    try:
+        assert started.wait(5)
+        # the UI reads other stages and the state while the lattice is computed
+        result = []
+        reader = threading.Thread(target=lambda: result.append((p.get('maxima'), p.is_current('lattice'),
+                                                                p.set_param('sigma', 9))))
+        reader.start()
+        reader.join(1)
+        assert not reader.is_alive()
+        assert result == [(('maxima', ('blurred', 'frame', 9), 1e-5), False, False)]
+    finally:
+        release.set()
+        worker.join()
+    assert p.is_current('lattice')
+
+
+def test_a_stage_requested_twice_at_once_is_computed_once():
+    p, calls = make_pipeline()
+    barrier = threading.Barrier(4)
+    def get():
+        barrier.wait()
+        p.get('lattice')
+    threads = [threading.Thread(target=get) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == dict(blurred=1, maxima=1, lattice=1)
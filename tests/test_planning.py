@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the path planning.
+"""
+
+# third party libraries
+import numpy as np
+import pytest
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial.distance import cdist
+
+# local libraries
+from nionswift_plugin.atmenmanip import lattice as lat
+from nionswift_plugin.atmenmanip import planning
+
+
+def honeycomb(columns=12, rows=16, bond_length=20.0):
+    """Lattice of an ideal honeycomb."""
+    points = []
+    for i in range(columns):
+        for j in range(rows):
+            x, y = i * 3, j * np.sqrt(3)
+            points += [(y, x), (y, x + 1), (y + np.sqrt(3) / 2, x + 1.5), (y + np.sqrt(3) / 2, x + 2.5)]
+    coords = np.array(points) * bond_length
+    return lat.Lattice(coords, lat.find_bonds(coords, 1.05 * bond_length))
+
+
+def random_problem(lattice, number_atoms, seed):
+    """Random sources and targets, paired by the shortest total distance as the assignment does."""
+    sites = np.random.default_rng(seed).choice(len(lattice), 2 * number_atoms, replace=False)
+    sources, targets = sites[:number_atoms], sites[number_atoms:]
+    _, order = linear_sum_assignment(cdist(lattice.coords[sources], lattice.coords[targets]))
+    return sources, targets[order]
+
+
+def assert_valid(lattice, path, source, target):
+    assert path[0] == source and path[-1] == target
+    # every step is a jump along a bond
+    for u, v in zip(path[:-1], path[1:]):
+        assert v in lattice.neighbours(u)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_paths_are_valid_and_disjoint(seed):
+    lattice = honeycomb()
+    sources, targets = random_problem(lattice, 8, seed)
+    planner = planning.MultiPathPlanner(lattice, time_budget=10, seed=0)
+    paths = planner.plan(sources, targets)
+    assert len(paths) == len(sources)
+    for path, source, target in zip(paths, sources, targets):
+        assert_valid(lattice, path, source, target)
+    # no site is used by two paths
+    used = np.concatenate(paths)
+    assert len(np.unique(used)) == len(used)
+
+
+def test_paths_in_worker_pool_equal_in_process():
+    lattice = honeycomb()
+    sources, targets = random_problem(lattice, 6, 1)
+    in_process = planning.MultiPathPlanner(lattice, max_nodes=100, seed=0).plan(sources, targets)
+    pool = planning.WorkerPool(lattice, workers=2)
+    try:
+        planner = planning.MultiPathPlanner(lattice, max_nodes=100, seed=0, pool=pool, min_parallel_agents=1)
+        pooled = planner.plan(sources, targets)
+        # the workers hold the graph of their lattice only
+        with pytest.raises(ValueError):
+            planning.MultiPathPlanner(honeycomb(), pool=pool)
+    finally:
+        pool.shutdown()
+    assert all(np.array_equal(a, b) for a, b in zip(in_process, pooled))
+
+
+def test_repaired_path_avoids_the_other_atoms():
+    lattice = honeycomb()
+    sources, targets = random_problem(lattice, 4, 2)
+    lattice.paths = planning.MultiPathPlanner(lattice, time_budget=10, seed=0).plan(sources, targets)
+    replanner = planning.Replanner(lattice)
+    replanner.prepare()
+    # the first atom lands on a neighbour that is not on its path
+    path = lattice.paths[0]
+    landed = next(int(n) for n in lattice.neighbours(path[0]) if n not in path and n not in replanner.occupied(0))
+    replanner.repair(0, landed)
+    # the paths are walked one after the other, each around the sites the other atoms sit on meanwhile
+    for i, (source, target) in enumerate(zip([landed] + list(sources[1:]), targets)):
+        assert_valid(lattice, lattice.paths[i], source, target)
+        assert not set(lattice.paths[i].tolist()) & set(replanner.occupied(i))
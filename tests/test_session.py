@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of saving and loading sessions.
+"""
+
+# third party libraries
+import numpy as np
+
+# local libraries
+from nionswift_plugin.atmenmanip import lattice as lat
+from nionswift_plugin.atmenmanip import session
+
+
+def test_save_load_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    blurred = rng.random((64, 80), dtype=np.float32)
+    maxima = rng.integers(0, 64, size=(40, 2))
+    lattice = lat.Lattice.from_maxima(maxima, 15)
+    lattice.add_sources([1, 5])
+    lattice.add_targets([7, 9])
+    lattice.paths = [np.array((1, 3, 7), dtype=np.int32), np.array((5,), dtype=np.int32)]
+    params = dict(sigma=8.0, noise_tolerance=5e-4, maxlength=15.0, drawn_fraction=1/3)
+    path = session.session_path(str(tmp_path), 'uuid', 'key')
+
+    session.save(path, params, blurred, maxima, lattice)
+    restored = session.load(path)
+    assert restored.params == params
+    assert np.array_equal(restored.blurred, blurred)
+    assert np.array_equal(restored.maxima, maxima)
+    for name in ('coords', 'bonds', 'indptr', 'indices', 'sources', 'targets'):
+        assert np.array_equal(getattr(restored.lattice, name), getattr(lattice, name)), name
+    assert len(restored.lattice.paths) == len(lattice.paths)
+    assert all(np.array_equal(a, b) for a, b in zip(restored.lattice.paths, lattice.paths))
+
+    # changes of the loaded arrays stay in memory
+    restored.lattice.shift_sites((1, 1))
+    assert np.array_equal(session.load(path).lattice.coords, lattice.coords)
+
+
+def test_saving_again_replaces_the_session(tmp_path):
+    path = session.session_path(str(tmp_path), 'uuid', 'key')
+    session.save(path, dict(sigma=1.0), maxima=np.zeros((3, 2)))
+    session.save(path, dict(sigma=2.0))
+    restored = session.load(path)
+    assert restored.params == dict(sigma=2.0)
+    assert restored.maxima is None and restored.lattice is None
+
+
+def test_no_session(tmp_path):
+    assert session.load(str(tmp_path / 'missing')) is None
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the parameter sweep.
+"""
+
+# third party libraries
+import numpy as np
+import pytest
+
+# local libraries
+from nionswift_plugin.atmenmanip import lattice as lat
+from nionswift_plugin.atmenmanip import simulator
+from nionswift_plugin.atmenmanip import sweep
+
+BOND_LENGTH = 16.0
+GRID = ((1, 2, 3, 4, 6, 8), (1e-4, 1e-3, 1e-2, 0.1), (12, 16, 20, 24, 30))
+
+
+def honeycomb_coords(shape, bond_length=BOND_LENGTH):
+    """Sites of an ideal honeycomb covering a frame."""
+    points = []
+    for i in range(-1, int(shape[1] / bond_length / 3) + 2):
+        for j in range(-1, int(shape[0] / bond_length / np.sqrt(3)) + 2):
+            x, y = i * 3, j * np.sqrt(3)
+            points += [(y, x), (y, x + 1), (y + np.sqrt(3) / 2, x + 1.5), (y + np.sqrt(3) / 2, x + 2.5)]
+    coords = np.array(points) * bond_length + 5
+    return coords[np.all((coords >= 0) & (coords < np.array(shape) - 1), axis=1)]
+
+
+@pytest.fixture(scope='module')
+def frame():
+    shape = (256, 256)
+    sample = simulator.SimulatedSample(lat.Lattice(honeycomb_coords(shape), np.empty((0, 2), dtype=np.int32)),
+                                       shape, [], sigma=3.0, seed=0)
+    return sample.render(dose=20.0)
+
+
+def test_lattice_quality_of_ideal_honeycomb():
+    coords = honeycomb_coords((256, 256))
+    bonds = lat.find_bonds(coords, 1.1 * BOND_LENGTH)
+    quality = sweep.lattice_quality(coords, bonds, (256, 256), 1.1 * BOND_LENGTH)
+    assert quality['fraction_three'] == 1.0
+    assert quality['bond_length'] == pytest.approx(BOND_LENGTH)
+    assert quality['bond_length_spread'] == pytest.approx(0, abs=1e-9)
+    assert quality['score'] == pytest.approx(1.0)
+    # second neighbours bonded as well: 9-coordinated, counted as 6+
+    bonds = lat.find_bonds(coords, 1.8 * BOND_LENGTH)
+    quality = sweep.lattice_quality(coords, bonds, (256, 256), 1.8 * BOND_LENGTH)
+    assert quality['fraction_three'] == 0.0 and quality['degree_histogram'][6] > 0
+
+
+def test_grid_finds_the_known_parameters(frame):
+    results = sweep.Sweep(frame, workers=2).grid((1, 3, 10), (1e-3, 0.2), (12, 20, 30))
+    assert len(results) == 18
+    best = results[0]
+    # atom sigma 3 px, bond length 16 px
+    assert (best['sigma'], best['noise_tolerance'], best['maxlength']) == (3, 1e-3, 20)
+    assert best['score'] > 0.95
+    assert best['number_sites'] == len(honeycomb_coords(frame.shape))
+    assert [r['score'] for r in results] == sorted((r['score'] for r in results), reverse=True)
+
+
+def test_blur_is_computed_once_per_sigma(frame, monkeypatch):
+    s = sweep.Sweep(frame, workers=4)
+    blurred_sigmas = []
+    blur = s.engine.blur
+    def counting_blur(image, sigma, method=None):
+        blurred_sigmas.append(sigma)
+        return blur(image, sigma, method)
+    monkeypatch.setattr(s.engine, 'blur', counting_blur)
+    s.grid((2, 3), (1e-4, 1e-3, 1e-2), (16, 20, 24))
+    assert sorted(blurred_sigmas) == [2, 3]
+    assert sorted(s._maxima) == [(sigma, n) for sigma in (2, 3) for n in (1e-4, 1e-3, 1e-2)]
+
+
+def test_bayesian_search_reaches_the_best_grid_score(frame):
+    best = sweep.Sweep(frame, workers=2).grid(*GRID)[0]
+    results = sweep.Sweep(frame, workers=2).bayesian(*GRID, number_evaluations=30, seed=0)
+    assert len(results) == 30
+    assert len({(r['sigma'], r['noise_tolerance'], r['maxlength']) for r in results}) == 30
+    assert results[0]['score'] == pytest.approx(best['score'])